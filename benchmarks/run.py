@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# Offline benchmark of every factory stage on a synthetic collection.
+#
+#   python -m benchmarks.run                       # 1k, 10k and 100k tokens
+#   python -m benchmarks.run --save-baseline       # record the baseline at every default size
+#
+# Results are compared with the stored baseline and the run fails when a stage got slower
+# than the allowed tolerance.
+
+import argparse
+import json
+import os
+from pathlib import Path
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from benchmarks.synthetic import make_assets, make_config
+from factory.config import Config
+from factory.factory import Factory
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+COLLECTION_NAME = "benchmark"
+
+
+def measure(stage, items, fn, repeat=1):
+    # stages that finish in microseconds are repeated and the fastest run is kept
+    tracemalloc.start()
+    seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds = min(seconds, time.perf_counter() - start)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "stage": stage,
+        "items": items,
+        "seconds": seconds,
+        "throughput": items / seconds if seconds > 0 else float("inf"),
+        "peak_mb": peak / (1024 * 1024),
+        # render workers are separate processes, their peak resident size is tracked on its own.
+        # The OS only keeps the largest of every child waited for so far, so this is the peak of
+        # this stage and all stages before it
+        "children_max_rss_mb_cumulative": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def evaluate_rules(config, codes):
+    constraints = config.constraints
+    for layer_index in range(len(constraints.layer_names)):
+        if constraints.constrained[layer_index]:
+            constraints.candidate_weights(layer_index, codes)
+
+
+def run_scenario(args, workdir):
+    assets_path = workdir / "assets"
+    layer_names = make_assets(assets_path, args.layers, args.traits, args.image_size, args.seed)
+    config_path = workdir / "config.yaml"
+    make_config(config_path, assets_path, layer_names, args.traits, args.rules, max(args.sizes), args.seed)
+
+    results = [measure("config", 1, lambda: Config(config_path, collection_name=COLLECTION_NAME, cache=False))]
+    config = Config(config_path, collection_name=COLLECTION_NAME)
+    results.append(measure("config_cached", 1, lambda: Config(config_path, collection_name=COLLECTION_NAME)))
+    for size in args.sizes:
+        image_factory = Factory(config=config)
+        result = measure("generate", size, lambda: image_factory.generate(size, seed=args.seed))
+        results.append(dict(result, size=size))
+
+        codes = config.constraints.encode_metadata(image_factory.metadata)
+        result = measure("rules", size, lambda: evaluate_rules(config, codes), repeat=20)
+        results.append(dict(result, size=size))
+
+        if "render" in args.stages:
+            result = measure("render", size, image_factory.generate_images)
+            results.append(dict(result, size=size))
+            # the next size renders from scratch instead of reusing the manifest
+            for name in ("images", "manifest.json", "manifest.json.journal"):
+                path = workdir / "output" / COLLECTION_NAME / name
+                if path.is_dir():
+                    for entry in os.scandir(path):
+                        os.remove(entry.path)
+                elif path.is_file():
+                    os.remove(path)
+
+        if "stats" in args.stages:
+            result = measure("stats", size, image_factory.generate_stats)
+            results.append(dict(result, size=size))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # (regressions, results the baseline has nothing to compare with)
+    regressions = []
+    missing = []
+    previous = {(result["stage"], result.get("size")): result for result in baseline.get("results", [])}
+    for result in results:
+        key = (result["stage"], result.get("size"))
+        if key not in previous:
+            missing.append(result)
+            continue
+        ratio = result["throughput"] / previous[key]["throughput"]
+        result["baseline_ratio"] = ratio
+        if ratio < 1 - tolerance:
+            regressions.append(result)
+    return regressions, missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the factory on a synthetic collection")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="token counts to run every stage at")
+    parser.add_argument("--layers", type=int, default=8)
+    parser.add_argument("--traits", type=int, default=10, help="traits per layer")
+    parser.add_argument("--image-size", type=int, default=24, help="width and height of every asset in pixels")
+    parser.add_argument("--rules", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", nargs="+", default=["render", "stats"], choices=["render", "stats"], help="optional stages to include besides config, generate and rules")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed throughput drop against the baseline")
+    parser.add_argument("--output", type=Path, help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    cwd = Path.cwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        # the factory writes to output/<collection> relative to the working directory
+        os.chdir(workdir)
+        try:
+            results = run_scenario(args, workdir)
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        "scenario": {key: value for key, value in vars(args).items() if key in ("layers", "traits", "image_size", "rules", "seed")},
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "results": results,
+    }
+
+    regressions = []
+    if args.baseline.is_file() and not args.save_baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get("scenario") != report["scenario"]:
+            print("baseline was recorded for a different scenario, skipping comparison")
+        else:
+            if baseline.get("cpu_count") != report["cpu_count"]:
+                print("warning: baseline was recorded with {} CPUs, this machine has {}".format(baseline.get("cpu_count"), report["cpu_count"]))
+            regressions, missing = compare(results, baseline, args.tolerance)
+            for result in missing:
+                print("warning: no baseline for {} at {} tokens, it is not checked".format(result["stage"], result.get("size")))
+
+    for result in results:
+        ratio = " ({:.2f}x baseline)".format(result["baseline_ratio"]) if "baseline_ratio" in result else ""
+        print("{:<9} {:>7} {:>12.1f}/s {:>9.1f} MB peak{}".format(result["stage"], result.get("size", ""), result["throughput"], result["peak_mb"], ratio))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("baseline saved to {}".format(args.baseline))
+
+    if regressions:
+        for result in regressions:
+            print("regression: {} at {} tokens is {:.2f}x the baseline throughput".format(result["stage"], result.get("size"), result["baseline_ratio"]))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+from pathlib import Path
+import numpy as np
+from PIL import Image
+import yaml
+
+import factory.constants as constants
+
+
+def make_assets(root, layer_count=8, traits_per_layer=10, image_size=24, seed=0):
+    # the bottom layer is an opaque background, every other trait is a few random opaque
+    # rectangles on a transparent canvas, roughly what hand-drawn layers look like
+    rng = np.random.default_rng(seed)
+    root = Path(root)
+    layer_names = ["layer{}".format(index) for index in range(layer_count)]
+    for layer_index, layer_name in enumerate(layer_names):
+        layer_path = root / layer_name
+        layer_path.mkdir(parents=True, exist_ok=True)
+        for trait_index in range(traits_per_layer):
+            if layer_index == 0:
+                pixels = np.empty((image_size, image_size, 3), dtype=np.uint8)
+                pixels[:] = rng.integers(0, 256, 3)
+                img = Image.fromarray(pixels)
+            else:
+                pixels = np.zeros((image_size, image_size, 4), dtype=np.uint8)
+                for _ in range(rng.integers(1, 4)):
+                    x, y = rng.integers(0, image_size, 2)
+                    w, h = rng.integers(1, image_size // 2 + 2, 2)
+                    pixels[y:y + h, x:x + w, :3] = rng.integers(0, 256, 3)
+                    pixels[y:y + h, x:x + w, 3] = 255
+                img = Image.fromarray(pixels)
+            img.save(layer_path / "trait{}.png".format(trait_index))
+    return layer_names
+
+
+def make_config(path, assets_path, layer_names, traits_per_layer=10, rule_count=0, count=1000, seed=0, equals_share=0.1):
+    rng = np.random.default_rng(seed)
+    layers = []
+    for layer_index, layer_name in enumerate(layer_names):
+        layer = {constants.LAYER_NAME_KEY: layer_name, constants.LAYER_REQUIRED_KEY: layer_index < 2}
+        if layer_index == 1:
+            # one layer with explicit, uneven weights that sum to 100
+            weights = rng.integers(1, 10, traits_per_layer)
+            weights[0] += 100 - weights.sum()
+            while weights[0] < 1:
+                weights[np.argmax(weights)] -= 1
+                weights[0] += 1
+            layer[constants.LAYER_WEIGHTS_KEY] = {"trait{}".format(index): int(weight) for index, weight in enumerate(weights)}
+        layers.append(layer)
+
+    rules = []
+    seen = set()
+    while len(rules) < rule_count and len(seen) < rule_count * 10:
+        lower, upper = sorted(rng.choice(len(layer_names), 2, replace=False))
+        lower_value = "trait{}".format(rng.integers(traits_per_layer))
+        upper_value = "trait{}".format(rng.integers(traits_per_layer))
+        key = (lower, lower_value, upper, upper_value)
+        if key in seen:
+            continue
+        seen.add(key)
+        # mostly exclusions, with the occasional forced pairing
+        filter_type = constants.RULES_EQUALS_KEY if rng.random() < equals_share else constants.RULES_NOT_EQUALS_KEY
+        rules.append({
+            constants.RULES_FILTER_KEY: filter_type,
+            constants.TRAIT_1_KEY: {constants.RULE_TRAIT_NAME: layer_names[lower], constants.RULES_VALUE_KEY: lower_value},
+            constants.TRAIT_2_KEY: {constants.RULE_TRAIT_NAME: layer_names[upper], constants.RULES_VALUE_KEY: upper_value},
+        })
+
+    raw_cfg = {
+        constants.COLLECTION_COUNT_KEY: count,
+        constants.COLLECTION_FILETYPE_KEY: "png",
+        constants.ASSETS_KEY: {constants.ASSETS_PATH_KEY: str(assets_path), constants.LAYERS_KEY: layers},
+        constants.RULES_KEY: rules,
+    }
+    with open(path, 'w') as f:
+        yaml.safe_dump(raw_cfg, f, sort_keys=False)
+    return raw_cfg
@@ -0,0 +1,189 @@
+import io
+import json
+import os
+from pathlib import Path
+import queue
+import re
+import tarfile
+import threading
+
+from factory.manifest import combine_hashes, hash_bytes
+
+ARCHIVE_SUFFIX = ".tar"
+INDEX_SUFFIX = ".index.json"
+# encoded images waiting for the writer thread
+ARCHIVE_QUEUE_SIZE = 1024
+
+# images are appended to numbered tar archives of a bounded size instead of one file per token.
+# Every archive gets an index of the offset and size of each image's data beside it, so an image
+# is read back with one seek, and archives stay plain tar files any tool can extract. A token
+# rendered again goes to a newer archive, the newest copy of a name is the one that counts
+
+
+def archive_path(directory, prefix, number):
+    return Path(directory) / "{}-{:06d}{}".format(prefix, number, ARCHIVE_SUFFIX)
+
+
+def archive_paths(directory, prefix):
+    # the archives of one output folder, oldest first
+    pattern = re.compile(r"^{}-(\d+){}$".format(re.escape(prefix), re.escape(ARCHIVE_SUFFIX)))
+    numbered = []
+    if Path(directory).is_dir():
+        for entry in os.scandir(directory):
+            match = pattern.match(entry.name)
+            if match is not None:
+                numbered.append((int(match.group(1)), Path(entry.path)))
+    return [path for _, path in sorted(numbered)]
+
+
+def next_number(directory, prefix):
+    existing = archive_paths(directory, prefix)
+    return int(existing[-1].name[len(prefix) + 1:-len(ARCHIVE_SUFFIX)]) + 1 if existing else 0
+
+
+def index_path(path):
+    return Path(str(path) + INDEX_SUFFIX)
+
+
+class ArchiveWriter:
+    def __init__(self, directory, prefix, max_bytes):
+        self.directory = Path(directory)
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.number = next_number(directory, prefix)
+        self._tar = None
+        self._index = {}
+
+    def add(self, name, data):
+        if self._tar is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._path = archive_path(self.directory, self.prefix, self.number)
+            self._tar = tarfile.open(self._path, 'w', format=tarfile.USTAR_FORMAT)
+            self._index = {}
+        # fixed metadata, so the same images always give the same archive
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = 0o644
+        self._tar.addfile(info, io.BytesIO(data))
+        # the data ends the member, padded to whole tar blocks
+        blocks = -(-len(data) // tarfile.BLOCKSIZE)
+        self._index[name] = [self._tar.offset - blocks * tarfile.BLOCKSIZE, len(data)]
+        if self._tar.offset >= self.max_bytes:
+            self.close()
+
+    def close(self):
+        if self._tar is None:
+            return
+        self._tar.close()
+        write_index(self._path, self._index)
+        self._tar = None
+        self.number += 1
+
+
+def write_index(path, index):
+    tmp_path = index_path(path).with_name(index_path(path).name + ".tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path(path))
+
+
+def read_index(path):
+    # name -> [data offset, size] of an archive. An archive left without an index by a crash is
+    # scanned instead, members cut short at its end are left out
+    if index_path(path).is_file():
+        with open(index_path(path), 'r') as f:
+            return json.load(f)
+    index = {}
+    file_size = os.path.getsize(path)
+    try:
+        with tarfile.open(path, 'r') as tar:
+            for member in tar:
+                if member.isfile() and member.offset_data + member.size <= file_size:
+                    index[member.name] = [member.offset_data, member.size]
+    except tarfile.ReadError:
+        pass
+    return index
+
+
+def load_index(directory, prefix):
+    # name -> (archive path, data offset, size) of the newest copy of every image
+    members = {}
+    for path in archive_paths(directory, prefix):
+        for name, (offset, size) in read_index(path).items():
+            members[name] = (str(path), offset, size)
+    return members
+
+
+def read_member(member):
+    path, offset, size = member
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def hash_members(members):
+    # the combined hash of a token's archived outputs, as hash_files gives it for loose files
+    return combine_hashes([hash_bytes(read_member(member)) for member in members])
+
+
+def expand(directory, prefix, target, names):
+    # writes the newest archived copy of every given name as a loose file into target
+    Path(target).mkdir(parents=True, exist_ok=True)
+    members = load_index(directory, prefix)
+    for name in names:
+        if name in members:
+            with open(Path(target) / name, 'wb') as f:
+                f.write(read_member(members[name]))
+
+
+def move_archives(source, target, prefix):
+    # appends the archives of one folder after those already in another, e.g. when merging shards
+    Path(target).mkdir(parents=True, exist_ok=True)
+    for path in archive_paths(source, prefix):
+        index = read_index(path)
+        destination = archive_path(target, prefix, next_number(target, prefix))
+        os.replace(path, destination)
+        write_index(destination, index)
+        if index_path(path).is_file():
+            os.remove(index_path(path))
+
+
+class ArchiveSink:
+    # writes the images the render workers send back from a background thread, one archive
+    # writer per output folder, so the render loop never waits on the disk and every archive is
+    # written sequentially
+    def __init__(self, writers, filetype):
+        self.writers = writers
+        self.filetype = filetype
+        self._queue = queue.Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, index, datas):
+        # datas: the encoded image of every output folder, in output folder order
+        if self._error is not None:
+            raise self._error
+        self._queue.put((index, datas))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue
+            index, datas = item
+            try:
+                for writer, data in zip(self.writers, datas):
+                    writer.add(str(index) + "." + self.filetype, data)
+            except Exception as e:
+                self._error = e
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        for writer in self.writers:
+            writer.close()
+        if self._error is not None:
+            raise self._error
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+import numpy as np
+from PIL import Image
+
+from factory.manifest import hash_file
+from factory.profiling import profiler
+
+# modes an asset keeps when it is the bottom layer of a token, anything else is rendered as RGBA
+BASE_MODES = ("RGB", "RGBA")
+
+
+class AssetAtlas:
+    def __init__(self, path, rows, modes):
+        self.path = str(path)
+        # rows[layer_index][trait_code] is the atlas row of that trait, -1 when it has no image
+        self.rows = rows
+        self.modes = modes
+        self.pixels = np.load(self.path, mmap_mode='r')
+        self._images = {}
+
+    @classmethod
+    def build(cls, config, path):
+        with profiler.stage("asset_decode"):
+            return cls._build(config, path)
+
+    @classmethod
+    def _build(cls, config, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # the asset files of every layer and trait code, the atlas on disk is used as it is while
+        # their hash matches the one it was built from
+        constraints = config.constraints
+        assets = []
+        digest = hashlib.sha256()
+        for layer_index, trait_name in enumerate(constraints.layer_names):
+            trait_folder = config.get_assets_path() / trait_name
+            digest.update("{}:{}\n".format(trait_name, len(constraints.vocabularies[layer_index])).encode())
+            for trait_value in config.get_live_traits(trait_name):
+                asset_path = trait_folder / (trait_value + "." + config.get_filetype())
+                if trait_value == "None" or not asset_path.is_file():
+                    continue
+                code = constraints.code_maps[layer_index][trait_value]
+                assets.append((layer_index, code, asset_path))
+                digest.update("{}={}\n".format(code, hash_file(asset_path)).encode())
+        asset_hash = digest.hexdigest()
+
+        index = read_atlas_index(path)
+        if index is not None and index["hash"] == asset_hash and path.is_file():
+            return cls(path, [np.array(layer_rows, dtype=np.int64) for layer_rows in index["rows"]], index["modes"])
+
+        images = []
+        modes = []
+        rows = [np.full(len(vocabulary), -1, dtype=np.int64) for vocabulary in constraints.vocabularies]
+        for layer_index, code, asset_path in assets:
+            with Image.open(asset_path) as img:
+                modes.append(img.mode if img.mode in BASE_MODES else "RGBA")
+                images.append(np.asarray(img.convert("RGBA")))
+            rows[layer_index][code] = len(images) - 1
+
+        sizes = set(img.shape for img in images)
+        if len(sizes) > 1:
+            raise RuntimeError("all assets must have the same dimensions, found: {}".format(sorted(size[:2] for size in sizes)))
+        pixels = np.stack(images) if images else np.zeros((0, 0, 0, 4), dtype=np.uint8)
+        # a running server or render pool may have the old atlas mapped, so it is replaced instead
+        # of written over, and its index goes first so a crash in between leaves no stale match
+        if atlas_index_path(path).is_file():
+            os.remove(atlas_index_path(path))
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, 'wb') as f:
+            np.save(f, pixels)
+        os.replace(tmp_path, path)
+        write_atlas_index(path, {"hash": asset_hash, "rows": [layer_rows.tolist() for layer_rows in rows], "modes": modes})
+        return cls(path, rows, modes)
+
+    def __getstate__(self):
+        # pool workers get the path and reopen the memory map instead of receiving the pixels
+        state = self.__dict__.copy()
+        del state['pixels']
+        del state['_images']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pixels = np.load(self.path, mmap_mode='r')
+        self._images = {}
+
+    def check(self, constraints, codes):
+        for layer_index, trait_name in enumerate(constraints.layer_names):
+            layer_codes = np.unique(codes[:, layer_index])
+            missing = layer_codes[self.rows[layer_index][layer_codes] < 0]
+            missing = [constraints.vocabularies[layer_index][code] for code in missing if constraints.vocabularies[layer_index][code] != "None"]
+            if missing:
+                raise RuntimeError("no asset file found for (trait: {}) values: {}".format(trait_name, ", ".join(missing)))
+
+    def image(self, row):
+        # treated as read-only, composites start from a copy
+        if row not in self._images:
+            self._images[row] = Image.fromarray(np.array(self.pixels[row]))
+        return self._images[row]
+
+    def composite(self, codes, cache=None):
+        codes = tuple(codes)
+        start, bg = 0, None
+        if cache is not None:
+            start, bg = self._cached_prefix(codes, cache)
+
+        for layer_index in range(start, len(codes)):
+            row = self.rows[layer_index][codes[layer_index]]
+            if row >= 0:
+                img = self.image(row)
+                if bg is None:
+                    bg = img.copy() if self.modes[row] == "RGBA" else img.convert(self.modes[row])
+                else:
+                    bg.paste(img, (0, 0), img)
+            if cache is not None and bg is not None and layer_index < len(codes) - 1:
+                cache.put(codes[:layer_index + 1], bg.copy())
+        return bg
+
+    def composite_batch(self, codes):
+        # same result as pasting layer by layer, computed for a whole batch of tokens at once:
+        # each channel becomes (dst * (255 - alpha) + src * alpha) / 255 with PIL's rounding
+        n = len(codes)
+        frames = np.zeros((n,) + self.pixels.shape[1:], dtype=np.uint8)
+        base_modes = np.full(n, "RGBA", dtype=object)
+        based = np.zeros(n, dtype=bool)
+        modes = np.array(self.modes, dtype=object)
+        for layer_index in range(codes.shape[1]):
+            rows = self.rows[layer_index][codes[:, layer_index]]
+            present = rows >= 0
+
+            new_base = present & ~based
+            frames[new_base] = self.pixels[rows[new_base]]
+            base_modes[new_base] = modes[rows[new_base]]
+
+            on_top = present & based
+            if on_top.any():
+                src = self.pixels[rows[on_top]].astype(np.uint32)
+                alpha = src[..., 3:]
+                blended = frames[on_top].astype(np.uint32) * (255 - alpha) + src * alpha + 128
+                frames[on_top] = ((blended >> 8) + blended) >> 8
+            based |= present
+        return frames, base_modes
+
+    def _cached_prefix(self, codes, cache):
+        # longest already composited stack of lower layers, only the layers above it are pasted
+        for length in range(len(codes) - 1, 0, -1):
+            if cache.peek(codes[:length]) is not None:
+                return length, cache.get(codes[:length]).copy()
+        cache.misses += 1
+        return 0, None
+
+
+def atlas_index_path(path):
+    return Path(str(path) + ".json")
+
+
+def read_atlas_index(path):
+    # the asset hash, rows and modes the atlas at path was built with, None when unknown
+    try:
+        with open(atlas_index_path(path), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_atlas_index(path, index):
+    tmp_path = atlas_index_path(path).with_name(atlas_index_path(path).name + ".tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, atlas_index_path(path))
+
+
+def image_size(img):
+    return img.width * img.height * len(img.getbands())
@@ -0,0 +1,42 @@
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, max_bytes, size_of=len):
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key):
+        return self._entries.get(key)
+
+    def put(self, key, value):
+        size = self.size_of(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.current_bytes -= self.size_of(self._entries.pop(key))
+        self._entries[key] = value
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= self.size_of(evicted)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self._entries)
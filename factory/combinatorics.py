@@ -0,0 +1,174 @@
+import numpy as np
+
+# bytes the partial states of a count or an enumeration, or the candidate weights of one layer,
+# may take. Every state is as wide as the layer count, beyond this the space is left uncounted
+MAX_SPACE_BYTES = 64 * 1024 * 1024
+
+
+# every trait combination the sampler can produce under the configured rules, with its probability
+class FeasibleSpace:
+    def __init__(self, constraints):
+        self.constraints = constraints
+        self.layer_count = len(constraints.layer_names)
+
+        # layers without any rule are drawn independently of everything else, and so are
+        # groups of layers that share no rule with each other
+        self.free_layers = [index for index in range(self.layer_count) if not constraints.ruled[index]]
+        self.components = self._components()
+
+        # free layers are counted exactly, a ruled layer can at most take every one of its traits
+        self._free_size = 1
+        for index in self.free_layers:
+            self._free_size *= int(np.count_nonzero(constraints.weights[index] > 0))
+        self.bound = self._free_size
+        for layers in self.components:
+            for index in layers:
+                self.bound *= len(constraints.vocabularies[index])
+        self._size = None
+        self._counted = False
+        self._factors = None
+
+    def count(self):
+        # the exact number of feasible combinations, None when counting them takes too many states
+        if not self._counted:
+            self._size = self._free_size
+            for layers in self.components:
+                size = self._count_component(layers)
+                if size is None:
+                    self._size = None
+                    break
+                self._size *= size
+            self._counted = True
+        return self._size
+
+    def _components(self):
+        components = []
+        assigned = set()
+        for index in range(self.layer_count):
+            if not self.constraints.ruled[index] or index in assigned:
+                continue
+            component, pending = set(), [index]
+            while pending:
+                current = pending.pop()
+                if current not in component:
+                    component.add(current)
+                    pending.extend(self.constraints.related[current])
+            assigned |= component
+            components.append(sorted(component))
+        return components
+
+    def _layer_weights(self, index, states):
+        if self.constraints.constrained[index]:
+            return self.constraints.candidate_weights(index, states)
+        return np.tile(self.constraints.weights[index], (len(states), 1))
+
+    def _branch(self, index, states):
+        # every partial state extended by each trait it can draw on this layer, with equals rewrites
+        # applied. None once the weights or the branched states would outgrow MAX_SPACE_BYTES
+        if len(states) * len(self.constraints.weights[index]) * 8 > MAX_SPACE_BYTES:
+            return None
+        weights = self._layer_weights(index, states)
+        rows, codes = np.nonzero(weights > 0)
+        if len(rows) * self.layer_count * states.itemsize > MAX_SPACE_BYTES:
+            return None
+        branched = states[rows]
+        branched[:, index] = codes
+        self.constraints.apply_equals_updates(index, branched)
+        return rows, codes, weights, branched
+
+    def _count_component(self, layers):
+        # walk the layers in draw order and merge partial states that can no longer be told apart.
+        # Until the last layer that rewrites a lower one, identical states are merged as a set since
+        # two paths may end in the same trait set. After it, columns no later layer reads are dropped
+        # and the number of distinct dropped values is carried along as a count. None when the states
+        # outgrow MAX_SPACE_BYTES
+        last_rewrite = max([index for index in layers if self.constraints.equals_updates[index]], default=-1)
+        states = np.full((1, self.layer_count), -1, dtype=np.int64)
+        counts = np.ones(1, dtype=object)
+        summing = False
+        for position, index in enumerate(layers):
+            branched = self._branch(index, states)
+            if branched is None:
+                return None
+            rows, _, _, states = branched
+            counts = counts[rows]
+
+            if not summing and index >= last_rewrite:
+                states, first = np.unique(states, axis=0, return_index=True)
+                counts = counts[first]
+                summing = True
+
+            if summing:
+                needed = set()
+                for later in layers[position + 1:]:
+                    needed.update(other_index for other_index, *_ in self.constraints.parents[later])
+                    for updates in self.constraints.equals_updates[later].values():
+                        needed.update(other_index for other_index, _ in updates)
+                states[:, [done for done in layers[:position + 1] if done not in needed]] = -1
+                states, inverse = np.unique(states, axis=0, return_inverse=True)
+                merged = np.zeros(len(states), dtype=object)
+                np.add.at(merged, inverse.ravel(), counts)
+                counts = merged
+            else:
+                states = np.unique(states, axis=0)
+                counts = np.ones(len(states), dtype=object)
+        return int(counts.sum())
+
+    def _enumerate_component(self, layers):
+        states = np.full((1, self.layer_count), -1, dtype=np.int64)
+        probabilities = np.ones(1)
+        for index in layers:
+            branched = self._branch(index, states)
+            if branched is None:
+                return None
+            rows, codes, weights, states = branched
+            probabilities = probabilities[rows] * weights[rows, codes] / weights.sum(axis=1)[rows]
+            states, inverse = np.unique(states, axis=0, return_inverse=True)
+            probabilities = np.bincount(inverse.ravel(), weights=probabilities, minlength=len(states))
+
+        # candidates that hit a dead end are dropped by the sampler, so renormalise over the rest
+        if len(probabilities):
+            probabilities = probabilities / probabilities.sum()
+        return states[:, layers], probabilities
+
+    def factors(self):
+        # (layers, codes of every reachable state of those layers, state probabilities), independent
+        # of each other. None when a component has too many states to enumerate
+        if self._factors is None:
+            factors = []
+            for index in self.free_layers:
+                weights = self.constraints.weights[index]
+                codes = np.flatnonzero(weights > 0)
+                factors.append(([index], codes[:, None], weights[codes] / weights[codes].sum()))
+            for layers in self.components:
+                enumerated = self._enumerate_component(layers)
+                if enumerated is None:
+                    return None
+                factors.append((layers,) + enumerated)
+            self._factors = factors
+        return self._factors
+
+    def sample(self, count, rng):
+        # Gumbel top-k over every feasible combination draws `count` of them without replacement,
+        # in the same order as repeatedly drawing weighted candidates and discarding duplicates.
+        # None when the space is too large to enumerate
+        factors = self.factors()
+        if factors is None:
+            return None
+        shape = [len(states) for _, states, _ in factors]
+        total = int(np.prod(shape, dtype=object))
+        if count > total:
+            raise ValueError("cannot generate {} unique trait sets, the layers and rules only allow {} combinations".format(count, total))
+
+        log_probabilities = np.zeros(())
+        for _, _, probabilities in factors:
+            log_probabilities = np.add.outer(log_probabilities, np.log(probabilities))
+        keys = log_probabilities.ravel() + rng.gumbel(size=total)
+
+        chosen = np.argpartition(-keys, count - 1)[:count] if count < total else np.arange(total)
+        chosen = chosen[np.argsort(-keys[chosen], kind="stable")]
+
+        codes = np.empty((len(chosen), self.layer_count), dtype=np.int64)
+        for (layers, states, _), positions in zip(factors, np.unravel_index(chosen, shape)):
+            codes[:, layers] = states[positions]
+        return codes
@@ -1,15 +1,23 @@
+import hashlib
+import os
 from pathlib import Path
-from jsonschema import validate
-import yaml
+import pickle
 
 import factory.constants as constants
+from factory.constraints import ConstraintIndex
+from factory.profiling import profiler
 
 schema = """
 type: object
 properties:
+    name:
+        type: string
     count:
         type: number
         minimum: 1
+    seed:
+        type: integer
+        minimum: 0
     filetype:
         type: string
         enum: 
@@ -38,6 +46,72 @@ properties:
                                         type: integer
                     required: 
                         - name
+    render:
+        type: object
+        properties:
+            cache_size_mb:
+                type: number
+                minimum: 0
+            backend:
+                type: string
+                enum:
+                    - pil
+                    - numpy
+            sizes:
+                type: array
+                items:
+                    type: object
+                    properties:
+                        size:
+                            type: integer
+                            minimum: 1
+                        resample:
+                            type: string
+                            enum:
+                                - nearest
+                                - box
+                                - bilinear
+                                - hamming
+                                - bicubic
+                                - lanczos
+                    required:
+                        - size
+            sink:
+                type: string
+                enum:
+                    - files
+                    - tar
+            archive_size_mb:
+                type: number
+                minimum: 1
+    metadata:
+        type: object
+        properties:
+            store:
+                type: string
+                enum:
+                    - npz
+                    - parquet
+    encode:
+        type: object
+        properties:
+            filetype:
+                type: string
+                enum:
+                    - png
+                    - jpeg
+            compress_level:
+                type: integer
+                minimum: 0
+                maximum: 9
+            palette:
+                type: boolean
+            quality:
+                type: integer
+                minimum: 1
+                maximum: 95
+            background:
+                type: string
     rules:
         type: array
         items:
@@ -62,101 +136,189 @@ properties:
 """
 
 class Config:
-    def __init__(self, config_path):
+    # every value missing from the config file can be given as an argument (the scripts pass their
+    # flags) or through the environment, and is only asked for when neither has it
+    def __init__(self, config_path, collection_name=None, count=None, filetype=None, assets_path=None, seed=None, cache=True):
+        self._live_traits = {}
+
         cfg_file = Path(config_path)
         if not cfg_file.exists() or not cfg_file.is_file():
             raise RuntimeError("config file not found at {}".format(cfg_file.resolve()))
 
-        with open(cfg_file.resolve(), 'r') as f:
-            raw_cfg = yaml.safe_load(f)
+        with open(cfg_file.resolve(), 'rb') as f:
+            data = f.read()
+        filetype = filetype or os.getenv(constants.ENV_COLLECTION_FILETYPE)
+        assets_path = assets_path or os.getenv(constants.ENV_ASSETS_PATH)
+
+        # the compiled config and asset scan are kept on disk, keyed by the config file and the
+        # values it was compiled with, and used again as long as no asset folder changed
+        cache_path = self._cache_path(data, filetype, assets_path) if cache else None
+        with profiler.stage("config_load"):
+            compiled = load_compiled(cache_path)
+        if compiled is not None:
+            self.processed_cfg, self.rules, self._live_traits, self.constraints = compiled
+        elif self._compile(data, filetype, assets_path) and cache_path is not None:
+            save_compiled(cache_path, (self.processed_cfg, self.rules, self._live_traits, self.constraints), self._asset_dirs())
+
+        collection_name = collection_name or os.getenv(constants.ENV_COLLECTION_NAME) or self.processed_cfg[constants.COLLECTION_NAME_KEY]
+        if collection_name is None:
+            collection_name = input("What is the name of this collection? Your images will be generated in your collection folder in the ‘outputs’ folder.\n")
+        self.processed_cfg[constants.COLLECTION_NAME_KEY] = collection_name
+
+        count = count or os.getenv(constants.ENV_COLLECTION_COUNT) or self.processed_cfg[constants.COLLECTION_COUNT_KEY]
+        if count is None:
+            count = input("How many images would you like to generate?\n")
+        self.processed_cfg[constants.COLLECTION_COUNT_KEY] = int(count)
+
+        # unlike the other values a missing seed is not asked for, the collection is then random
+        if seed is None:
+            seed = os.getenv(constants.ENV_COLLECTION_SEED) or self.processed_cfg[constants.COLLECTION_SEED_KEY]
+        self.processed_cfg[constants.COLLECTION_SEED_KEY] = int(seed) if seed is not None else None
+
+    def _cache_path(self, data, filetype, assets_path):
+        # relative asset paths depend on the working directory, so it is part of the key
+        key = hashlib.sha256()
+        for part in (str(constants.CONFIG_CACHE_VERSION).encode(), data, os.getcwd().encode(), str(filetype).encode(), str(assets_path).encode()):
+            key.update(len(part).to_bytes(8, "little") + part)
+        return Path(constants.OUTPUT_DIR_NAME) / constants.CONFIG_CACHE_DIR_NAME / (key.hexdigest() + ".pickle")
+
+    def _asset_dirs(self):
+        # every layer folder and the folders below it, adding or removing a trait changes the
+        # modification time of the folder it is in
+        dirs = []
+        for layer in self.get_layers():
+            for root, _, _ in os.walk(self.get_assets_path() / layer[constants.LAYER_NAME_KEY]):
+                dirs.append(root)
+        return dirs
+
+    def _compile(self, data, filetype, assets_path):
+        # parses and validates the config file and scans the asset folders, returns False when a
+        # value had to be asked for, such a config is not cached
+        import yaml
+        from jsonschema import validate
+
+        with profiler.stage("config_compile"):
+            raw_cfg = yaml.safe_load(data)
             validate(raw_cfg, yaml.safe_load(schema))
+        cacheable = True
 
-            self.processed_cfg = {constants.ASSETS_KEY: {constants.ASSETS_PATH_KEY: '', constants.LAYERS_KEY: []}}
+        self.processed_cfg = {constants.ASSETS_KEY: {constants.ASSETS_PATH_KEY: '', constants.LAYERS_KEY: []}}
+        self.processed_cfg[constants.COLLECTION_NAME_KEY] = raw_cfg.get(constants.COLLECTION_NAME_KEY)
+        self.processed_cfg[constants.COLLECTION_COUNT_KEY] = raw_cfg.get(constants.COLLECTION_COUNT_KEY)
+        self.processed_cfg[constants.COLLECTION_SEED_KEY] = raw_cfg.get(constants.COLLECTION_SEED_KEY)
 
-            self.processed_cfg[constants.COLLECTION_NAME_KEY] = input("What is the name of this collection? Your images will be generated in your collection folder in the ‘outputs’ folder.\n")
+        if filetype is not None:
+            self.processed_cfg[constants.COLLECTION_FILETYPE_KEY] = filetype
+        elif constants.COLLECTION_FILETYPE_KEY not in raw_cfg:
+            self.processed_cfg[constants.COLLECTION_FILETYPE_KEY] = input("What is your collection's asset filetype?\n")
+            cacheable = False
+        else:
+            self.processed_cfg[constants.COLLECTION_FILETYPE_KEY] = raw_cfg[constants.COLLECTION_FILETYPE_KEY]
 
-            if constants.COLLECTION_COUNT_KEY not in raw_cfg:
-                self.processed_cfg[constants.COLLECTION_COUNT_KEY] = input("How many images would you like to generate?\n")
-            else:
-                self.processed_cfg[constants.COLLECTION_COUNT_KEY] = raw_cfg[constants.COLLECTION_COUNT_KEY]
+        self.processed_cfg[constants.RENDER_KEY] = dict(constants.RENDER_DEFAULTS)
+        self.processed_cfg[constants.RENDER_KEY].update(raw_cfg.get(constants.RENDER_KEY, {}))
 
-            if constants.COLLECTION_FILETYPE_KEY not in raw_cfg:
-                self.processed_cfg[constants.COLLECTION_FILETYPE_KEY] = input("What is your collection's asset filetype?\n")
-            else:
-                self.processed_cfg[constants.COLLECTION_FILETYPE_KEY] = raw_cfg[constants.COLLECTION_FILETYPE_KEY]
+        # output images are written in the asset filetype unless the encode section says otherwise
+        self.processed_cfg[constants.ENCODE_KEY] = dict(constants.ENCODE_DEFAULTS, **{constants.ENCODE_FILETYPE_KEY: self.processed_cfg[constants.COLLECTION_FILETYPE_KEY]})
+        self.processed_cfg[constants.ENCODE_KEY].update(raw_cfg.get(constants.ENCODE_KEY, {}))
+        self.processed_cfg[constants.METADATA_KEY] = dict(raw_cfg.get(constants.METADATA_KEY, {}))
 
-            if constants.ASSETS_KEY not in raw_cfg:
-                raise RuntimeError("no assets specified")
+        if constants.ASSETS_KEY not in raw_cfg:
+            raise RuntimeError("no assets specified")
 
-            if constants.ASSETS_PATH_KEY not in raw_cfg[constants.ASSETS_KEY]:
-                self.processed_cfg[constants.ASSETS_KEY][constants.ASSETS_PATH_KEY] = input("What is the path of your assets folder?\n")
-            else:
-                self.processed_cfg[constants.ASSETS_KEY][constants.ASSETS_PATH_KEY] = raw_cfg[constants.ASSETS_KEY][constants.ASSETS_PATH_KEY]
+        if assets_path is not None:
+            self.processed_cfg[constants.ASSETS_KEY][constants.ASSETS_PATH_KEY] = assets_path
+        elif constants.ASSETS_PATH_KEY not in raw_cfg[constants.ASSETS_KEY]:
+            self.processed_cfg[constants.ASSETS_KEY][constants.ASSETS_PATH_KEY] = input("What is the path of your assets folder?\n")
+            cacheable = False
+        else:
+            self.processed_cfg[constants.ASSETS_KEY][constants.ASSETS_PATH_KEY] = raw_cfg[constants.ASSETS_KEY][constants.ASSETS_PATH_KEY]
 
-            if constants.LAYERS_KEY not in raw_cfg[constants.ASSETS_KEY]:
-                raise RuntimeError("no layers specified")
+        if constants.LAYERS_KEY not in raw_cfg[constants.ASSETS_KEY]:
+            raise RuntimeError("no layers specified")
 
-            for index, layer in enumerate(raw_cfg[constants.ASSETS_KEY][constants.LAYERS_KEY]):
-                if constants.LAYER_NAME_KEY not in layer:
-                    raise RuntimeError("no layer name specified for layer at index {}".format(index))
-                
-                
-                assets_path: Path = self.get_assets_path() / layer[constants.LAYER_NAME_KEY]
-                if not assets_path.exists():
-                    raise RuntimeError("{} not found in 'assets' folder. Please double check that the layer directory name in the config matches the folder name in the 'assets' folder exactly".format(layer[constants.LAYER_NAME_KEY]))
-                if not assets_path.is_dir():
-                    raise RuntimeError("File found at the specified layer folder: {}. Please provide a valid folder with assets".format(layer[constants.LAYER_NAME_KEY]))
-                                        
-                if constants.LAYER_REQUIRED_KEY not in layer:
-                    layer[constants.LAYER_REQUIRED_KEY] = False
-                
-                valid_traits = self.get_live_traits(layer[constants.LAYER_NAME_KEY])
-                # If required is false, then the user can skip trait generation for this layer at some specified probability
-                if layer[constants.LAYER_REQUIRED_KEY] == False:
-                    valid_traits.append("None")
-                if constants.LAYER_WEIGHTS_KEY not in layer:
-                    weights = {}
-                    weight = 1 / len(valid_traits)
-                    for trait in valid_traits:
-                        weights[trait] = weight
-                    layer[constants.LAYER_WEIGHTS_KEY] = weights
-                elif isinstance(layer[constants.LAYER_WEIGHTS_KEY], dict):
-                    if sum(layer[constants.LAYER_WEIGHTS_KEY].values()) != 100:
-                        raise ValueError("rarity_weights do not sum to 100 for layer {}".format(layer['name']))
-                    for image_name in layer[constants.LAYER_WEIGHTS_KEY]:
-                        if image_name not in valid_traits:
-                            raise ValueError("invalid image name: {} provided for rarity_weights in layer: {}".format(image_name, layer['name']))
-                else:
-                    raise ValueError("invalid rarity_weights type: {} provided".format(type(layer[constants.LAYER_WEIGHTS_KEY])))
-                self.processed_cfg[constants.ASSETS_KEY][constants.LAYERS_KEY].append(layer)
+        for index, layer in enumerate(raw_cfg[constants.ASSETS_KEY][constants.LAYERS_KEY]):
+            if constants.LAYER_NAME_KEY not in layer:
+                raise RuntimeError("no layer name specified for layer at index {}".format(index))
+            
             
-            self.rules = {}
+            assets_path: Path = self.get_assets_path() / layer[constants.LAYER_NAME_KEY]
+            if not assets_path.exists():
+                raise RuntimeError("{} not found in 'assets' folder. Please double check that the layer directory name in the config matches the folder name in the 'assets' folder exactly".format(layer[constants.LAYER_NAME_KEY]))
+            if not assets_path.is_dir():
+                raise RuntimeError("File found at the specified layer folder: {}. Please provide a valid folder with assets".format(layer[constants.LAYER_NAME_KEY]))
+                                    
+            if constants.LAYER_REQUIRED_KEY not in layer:
+                layer[constants.LAYER_REQUIRED_KEY] = False
             
-            if constants.RULES_KEY in raw_cfg:
-                for rule in raw_cfg[constants.RULES_KEY]:
-                    filter_type = rule[constants.RULES_FILTER_KEY]
-                    if filter_type != constants.RULES_EQUALS_KEY and filter_type != constants.RULES_NOT_EQUALS_KEY:
-                        raise RuntimeError("invalid filter type {}".format(filter_type))
-                    
-                    if rule[constants.TRAIT_1_KEY][constants.RULE_TRAIT_NAME] not in self.rules:
-                        self.rules[rule[constants.TRAIT_1_KEY][constants.RULE_TRAIT_NAME]] = []
-                    self.rules[rule[constants.TRAIT_1_KEY][constants.RULE_TRAIT_NAME]].append(rule)
+            valid_traits = self.get_live_traits(layer[constants.LAYER_NAME_KEY])
+            # If required is false, then the user can skip trait generation for this layer at some specified probability
+            if layer[constants.LAYER_REQUIRED_KEY] == False:
+                valid_traits.append("None")
+            if constants.LAYER_WEIGHTS_KEY not in layer:
+                weights = {}
+                weight = 1 / len(valid_traits)
+                for trait in valid_traits:
+                    weights[trait] = weight
+                layer[constants.LAYER_WEIGHTS_KEY] = weights
+            elif isinstance(layer[constants.LAYER_WEIGHTS_KEY], dict):
+                if sum(layer[constants.LAYER_WEIGHTS_KEY].values()) != 100:
+                    raise ValueError("rarity_weights do not sum to 100 for layer {}".format(layer['name']))
+                for image_name in layer[constants.LAYER_WEIGHTS_KEY]:
+                    if image_name not in valid_traits:
+                        raise ValueError("invalid image name: {} provided for rarity_weights in layer: {}".format(image_name, layer['name']))
+            else:
+                raise ValueError("invalid rarity_weights type: {} provided".format(type(layer[constants.LAYER_WEIGHTS_KEY])))
+            self.processed_cfg[constants.ASSETS_KEY][constants.LAYERS_KEY].append(layer)
+        
+        self.rules = {}
+        
+        if constants.RULES_KEY in raw_cfg:
+            for rule in raw_cfg[constants.RULES_KEY]:
+                filter_type = rule[constants.RULES_FILTER_KEY]
+                if filter_type != constants.RULES_EQUALS_KEY and filter_type != constants.RULES_NOT_EQUALS_KEY:
+                    raise RuntimeError("invalid filter type {}".format(filter_type))
+                
+                if rule[constants.TRAIT_1_KEY][constants.RULE_TRAIT_NAME] not in self.rules:
+                    self.rules[rule[constants.TRAIT_1_KEY][constants.RULE_TRAIT_NAME]] = []
+                self.rules[rule[constants.TRAIT_1_KEY][constants.RULE_TRAIT_NAME]].append(rule)
 
-                    if rule[constants.TRAIT_2_KEY][constants.RULE_TRAIT_NAME] not in self.rules:
-                        self.rules[rule[constants.TRAIT_2_KEY][constants.RULE_TRAIT_NAME]] = []
-                    self.rules[rule[constants.TRAIT_2_KEY][constants.RULE_TRAIT_NAME]].append(rule)
+                if rule[constants.TRAIT_2_KEY][constants.RULE_TRAIT_NAME] not in self.rules:
+                    self.rules[rule[constants.TRAIT_2_KEY][constants.RULE_TRAIT_NAME]] = []
+                self.rules[rule[constants.TRAIT_2_KEY][constants.RULE_TRAIT_NAME]].append(rule)
 
+        live_traits = {layer[constants.LAYER_NAME_KEY]: self.get_live_traits(layer[constants.LAYER_NAME_KEY]) for layer in self.get_layers()}
+        with profiler.stage("rule_compile", items=sum(len(rules) for rules in self.rules.values()) // 2):
+            self.constraints = ConstraintIndex(self.get_layers(), self.rules, live_traits)
+        return cacheable
 
     def get_live_traits(self, dir_name):
-        trait_folder: Path = self.get_assets_path() / dir_name
-        if not trait_folder.exists() or not trait_folder.is_dir():
-            raise RuntimeError("no valid assets folder found at path: {}".format(trait_folder.resolve()))
-        all_trait_files = trait_folder.glob('**/*')
-        return [x.stem for x in all_trait_files if x.is_file() and not x.stem.startswith(".")]
+        # the asset folders are scanned once per config, later calls are served from the cache
+        if dir_name not in self._live_traits:
+            trait_folder: Path = self.get_assets_path() / dir_name
+            if not trait_folder.exists() or not trait_folder.is_dir():
+                raise RuntimeError("no valid assets folder found at path: {}".format(trait_folder.resolve()))
+            with profiler.stage("asset_scan"):
+                all_trait_files = trait_folder.glob('**/*')
+                self._live_traits[dir_name] = [x.stem for x in all_trait_files if x.is_file() and not x.stem.startswith(".")]
+        return list(self._live_traits[dir_name])
 
     def get_filetype(self):
         return self.processed_cfg[constants.COLLECTION_FILETYPE_KEY]
 
+    def get_output_filetype(self):
+        return self.processed_cfg[constants.ENCODE_KEY][constants.ENCODE_FILETYPE_KEY]
+
+    def get_render_option(self, key):
+        return self.processed_cfg[constants.RENDER_KEY][key]
+
+    def get_encode_option(self, key):
+        return self.processed_cfg[constants.ENCODE_KEY][key]
+
+    def get_metadata_store(self):
+        # on-disk format kept beside metadata.csv, None when only the CSV is written
+        return self.processed_cfg.get(constants.METADATA_KEY, {}).get(constants.METADATA_STORE_KEY)
+
     def get_layers(self):
         return self.processed_cfg[constants.ASSETS_KEY][constants.LAYERS_KEY]
 
@@ -167,69 +329,52 @@ class Config:
         return self.processed_cfg[constants.COLLECTION_NAME_KEY]
 
     def get_directory_name(self, trait_name):
-        for layer in self.get_layers():
-            if layer[constants.LAYER_NAME_KEY] == trait_name:
-                return layer[constants.LAYER_NAME_KEY]
-        raise RuntimeError("finding directory for trait: {}".format(trait_name))
+        if trait_name not in self.constraints.layer_index:
+            raise RuntimeError("finding directory for trait: {}".format(trait_name))
+        return trait_name
     
     def get_count(self):
         return self.processed_cfg[constants.COLLECTION_COUNT_KEY]
     
+    def get_seed(self):
+        return self.processed_cfg[constants.COLLECTION_SEED_KEY]
+
     def get_index(self, dir_name):
-        for index, layer in enumerate(self.processed_cfg[constants.ASSETS_KEY][constants.LAYERS_KEY]):
-            if layer[constants.LAYER_NAME_KEY] == dir_name:
-                return index
+        return self.constraints.layer_index.get(dir_name)
 
     def has_rule(self, trait_name):
-        if trait_name  in self.rules:
-            for rule in self.rules[trait_name]:
-                if trait_name == rule[constants.TRAIT_1_KEY][constants.RULE_TRAIT_NAME]:
-                    this_trait = constants.TRAIT_1_KEY
-                    other_trait = constants.TRAIT_2_KEY
-                else:
-                    this_trait = constants.TRAIT_2_KEY
-                    other_trait = constants.TRAIT_1_KEY
-                if self.get_index(rule[other_trait][constants.RULE_TRAIT_NAME]) < self.get_index(rule[this_trait][constants.RULE_TRAIT_NAME]):
-                    return True
-        return False
+        return self.constraints.has_rule(trait_name)
 
     # return trait_name, trait_value
     def has_equals_rule(self, trait_name, trait_value):
-        if trait_name in self.rules:
-            for rule in self.rules[trait_name]:
-                if rule[constants.RULES_FILTER_KEY] == constants.RULES_EQUALS_KEY:
-                    if trait_name == rule[constants.TRAIT_1_KEY][constants.RULE_TRAIT_NAME]:
-                        this_trait = constants.TRAIT_1_KEY
-                        other_trait = constants.TRAIT_2_KEY
-                    else:
-                        this_trait = constants.TRAIT_2_KEY
-                        other_trait = constants.TRAIT_1_KEY
-                    
-                    if rule[this_trait][constants.RULES_VALUE_KEY] == trait_value:
-                        yield rule[other_trait][constants.RULE_TRAIT_NAME], rule[other_trait][constants.RULES_VALUE_KEY]
-
-                
+        return self.constraints.equals_assignments(trait_name, trait_value)
 
     # trait_name, trait_value
     def get_valid_trait(self, trait_name, current_trait_set):
-        all_traits = self.get_live_traits(trait_name)
-        for rule in self.rules[trait_name]:
-            if trait_name == rule[constants.TRAIT_1_KEY][constants.RULE_TRAIT_NAME]:
-                this_trait = constants.TRAIT_1_KEY
-                other_trait = constants.TRAIT_2_KEY
-            else:
-                this_trait = constants.TRAIT_2_KEY
-                other_trait = constants.TRAIT_1_KEY
-            # check if other rule 'lower' in stack
-            if self.get_index(rule[other_trait][constants.RULE_TRAIT_NAME]) < self.get_index(rule[this_trait][constants.RULE_TRAIT_NAME]):
-                if rule[constants.RULES_FILTER_KEY] == constants.RULES_EQUALS_KEY:
-                    if rule[other_trait][constants.RULES_VALUE_KEY] == current_trait_set[rule[other_trait][constants.RULE_TRAIT_NAME]][0]:
-                        return [rule[this_trait][constants.RULES_VALUE_KEY]]
-                if rule[constants.RULES_FILTER_KEY] == constants.RULES_NOT_EQUALS_KEY:
-                        if isinstance(rule[other_trait][constants.RULES_VALUE_KEY], list):
-                            if current_trait_set[other_trait][0] in rule[other_trait][constants.RULES_VALUE_KEY]:
-                                all_traits.remove(rule[this_trait][constants.RULES_VALUE_KEY])
-                        if isinstance(rule[other_trait][constants.RULES_VALUE_KEY], str):
-                            if current_trait_set[rule[other_trait][constants.RULE_TRAIT_NAME]][0] == rule[other_trait][constants.RULES_VALUE_KEY]:
-                                all_traits.remove(rule[this_trait][constants.RULES_VALUE_KEY])
-        return all_traits
\ No newline at end of file
+        parent_values = {name: current_trait_set[name][0] for name in self.constraints.parent_names(trait_name)}
+        return self.constraints.valid_traits(trait_name, parent_values)
+
+
+def load_compiled(cache_path):
+    # the cached (processed config, rules, live traits, constraints), None when there is no
+    # cache entry, it cannot be read or an asset folder changed since it was written
+    if cache_path is None or not cache_path.is_file():
+        return None
+    try:
+        with open(cache_path, 'rb') as f:
+            entry = pickle.load(f)
+        for directory, mtime in entry["dirs"]:
+            if os.stat(directory).st_mtime_ns != mtime:
+                return None
+    except (OSError, EOFError, pickle.UnpicklingError, KeyError, TypeError, ValueError):
+        return None
+    return entry["compiled"]
+
+
+def save_compiled(cache_path, compiled, dirs):
+    entry = {"dirs": [(directory, os.stat(directory).st_mtime_ns) for directory in dirs], "compiled": compiled}
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
@@ -3,10 +3,30 @@ OUTPUT_DIR_NAME = "output"
 IMAGES_DIR_NAME = "images"
 METADATA_DIR_NAME = "metadata"
 METADATA_FILE_NAME = "metadata.csv"
+CACHE_DIR_NAME = "cache"
+ATLAS_FILE_NAME = "atlas.npy"
+MANIFEST_FILE_NAME = "manifest.json"
+PROFILE_FILE_NAME = "profile.json"
+FINAL_DIR_NAME = "final"
+CID_FILE_NAME = "IPFS CID"
+UPLOAD_CHECKPOINT_FILE_NAME = "upload_checkpoint.json"
+SHARDS_DIR_NAME = "shards"
+ARCHIVES_DIR_NAME = "archives"
+CONFIG_CACHE_DIR_NAME = ".config_cache"
+# bumped whenever the compiled config changes shape, older cache entries are then ignored
+CONFIG_CACHE_VERSION = 3
+
+# environment variables read for values missing from the config file
+ENV_COLLECTION_NAME = "FACTORY_COLLECTION_NAME"
+ENV_COLLECTION_COUNT = "FACTORY_COUNT"
+ENV_COLLECTION_SEED = "FACTORY_SEED"
+ENV_COLLECTION_FILETYPE = "FACTORY_FILETYPE"
+ENV_ASSETS_PATH = "FACTORY_ASSETS_PATH"
 
 # config constants
 COLLECTION_NAME_KEY = 'name'
 COLLECTION_COUNT_KEY = 'count'
+COLLECTION_SEED_KEY = 'seed'
 COLLECTION_FILETYPE_KEY = 'filetype'
 ASSETS_KEY = 'assets'
 ASSETS_PATH_KEY = 'path'
@@ -23,4 +43,44 @@ RULES_VALUE_KEY = 'value'
 RULES_EQUALS_KEY = 'equals'
 RULES_NOT_EQUALS_KEY = 'notequals'
 TRAIT_1_KEY = 'trait_1'
-TRAIT_2_KEY = 'trait_2'
\ No newline at end of file
+TRAIT_2_KEY = 'trait_2'
+
+# render
+RENDER_KEY = 'render'
+RENDER_CACHE_SIZE_KEY = 'cache_size_mb'
+RENDER_BACKEND_KEY = 'backend'
+RENDER_BACKEND_PIL = 'pil'
+RENDER_BACKEND_NUMPY = 'numpy'
+RENDER_SIZES_KEY = 'sizes'
+RENDER_SIZE_KEY = 'size'
+RENDER_RESAMPLE_KEY = 'resample'
+RENDER_DEFAULT_RESAMPLE = 'nearest'
+RENDER_SINK_KEY = 'sink'
+RENDER_SINK_FILES = 'files'
+RENDER_SINK_TAR = 'tar'
+RENDER_ARCHIVE_SIZE_KEY = 'archive_size_mb'
+RENDER_DEFAULTS = {
+    RENDER_CACHE_SIZE_KEY: 64,
+    RENDER_BACKEND_KEY: RENDER_BACKEND_PIL,
+    RENDER_SIZES_KEY: [],
+    RENDER_SINK_KEY: RENDER_SINK_FILES,
+    RENDER_ARCHIVE_SIZE_KEY: 256,
+}
+
+# metadata
+METADATA_KEY = 'metadata'
+METADATA_STORE_KEY = 'store'
+
+# encode
+ENCODE_KEY = 'encode'
+ENCODE_FILETYPE_KEY = 'filetype'
+ENCODE_COMPRESS_LEVEL_KEY = 'compress_level'
+ENCODE_PALETTE_KEY = 'palette'
+ENCODE_QUALITY_KEY = 'quality'
+ENCODE_BACKGROUND_KEY = 'background'
+ENCODE_DEFAULTS = {
+    ENCODE_COMPRESS_LEVEL_KEY: 6,
+    ENCODE_PALETTE_KEY: False,
+    ENCODE_QUALITY_KEY: 75,
+    ENCODE_BACKGROUND_KEY: '#ffffff',
+}
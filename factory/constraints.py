@@ -0,0 +1,189 @@
+import numpy as np
+
+import factory.constants as constants
+
+NO_RULE = np.iinfo(np.int64).max
+
+
+class ConstraintIndex:
+    def __init__(self, layers, rules, live_traits):
+        self.layer_names = [layer[constants.LAYER_NAME_KEY] for layer in layers]
+        self.layer_index = {name: index for index, name in enumerate(self.layer_names)}
+
+        self.vocabularies = []
+        self.code_maps = []
+        self.live_codes = []
+        for layer in layers:
+            trait_name = layer[constants.LAYER_NAME_KEY]
+            vocabulary = list(layer[constants.LAYER_WEIGHTS_KEY].keys())
+            vocabulary += [trait for trait in live_traits[trait_name] if trait not in vocabulary]
+            if "None" not in vocabulary:
+                vocabulary.append("None")
+            self.vocabularies.append(vocabulary)
+            self.code_maps.append({trait: code for code, trait in enumerate(vocabulary)})
+
+        # (this code, other index, other code, filter) in the order rules are checked for each layer
+        self._rules_by_layer = [[] for _ in self.layer_names]
+        for trait_name, layer_rules in rules.items():
+            this_index = self.layer_index[trait_name]
+            for rule in layer_rules:
+                this_trait, other_trait = _orient(trait_name, rule)
+                other_index = self.layer_index[rule[other_trait][constants.RULE_TRAIT_NAME]]
+                self._rules_by_layer[this_index].append((
+                    self._encode(this_index, rule[this_trait][constants.RULES_VALUE_KEY]),
+                    other_index,
+                    self._encode(other_index, rule[other_trait][constants.RULES_VALUE_KEY]),
+                    rule[constants.RULES_FILTER_KEY],
+                ))
+
+        self.ruled = [len(layer_rules) > 0 for layer_rules in self._rules_by_layer]
+        # layers tied to each layer by at least one rule, in either direction
+        self.related = [sorted({other_index for _, other_index, _, _ in layer_rules} - {index}) for index, layer_rules in enumerate(self._rules_by_layer)]
+        self.weights = []
+        self.constrained = []
+        self.parents = []
+        self.equals_updates = []
+        self._equals_pairs = []
+        for index, layer in enumerate(layers):
+            trait_name = layer[constants.LAYER_NAME_KEY]
+            size = len(self.vocabularies[index])
+            self.live_codes.append(np.array([self.code_maps[index][trait] for trait in live_traits[trait_name]], dtype=np.int64))
+
+            parents = {}
+            equals_updates = {}
+            equals_pairs = {}
+            for rank, (this_code, other_index, other_code, filter_type) in enumerate(self._rules_by_layer[index]):
+                if filter_type == constants.RULES_EQUALS_KEY:
+                    equals_pairs.setdefault(this_code, []).append((other_index, other_code))
+                if other_index >= index:
+                    continue
+                if other_index not in parents:
+                    other_size = len(self.vocabularies[other_index])
+                    parents[other_index] = (
+                        np.ones((other_size, size), dtype=bool),
+                        np.full(other_size, -1, dtype=np.int64),
+                        np.full(other_size, NO_RULE, dtype=np.int64),
+                    )
+                allowed, forced, forced_rank = parents[other_index]
+                if filter_type == constants.RULES_EQUALS_KEY:
+                    if forced_rank[other_code] == NO_RULE:
+                        forced[other_code] = this_code
+                        forced_rank[other_code] = rank
+                    # an equals pick on this layer also rewrites the lower layer it is tied to
+                    equals_updates.setdefault(this_code, []).append((other_index, other_code))
+                else:
+                    allowed[other_code, this_code] = False
+
+            # layers constrained by a lower layer only ever draw from the traits on disk
+            constrained = len(parents) > 0
+            candidates = self.live_codes[index] if constrained else [self.code_maps[index][trait] for trait in layer[constants.LAYER_WEIGHTS_KEY]]
+            layer_weights = np.zeros(size)
+            for code in candidates:
+                layer_weights[code] = layer[constants.LAYER_WEIGHTS_KEY].get(self.vocabularies[index][code], 0)
+
+            self.weights.append(layer_weights)
+            self.constrained.append(constrained)
+            self.parents.append([(other_index,) + tables for other_index, tables in sorted(parents.items())])
+            self.equals_updates.append(equals_updates)
+            self._equals_pairs.append(equals_pairs)
+
+    def _encode(self, layer_index, trait_value):
+        code_map = self.code_maps[layer_index]
+        if trait_value not in code_map:
+            code_map[trait_value] = len(self.vocabularies[layer_index])
+            self.vocabularies[layer_index].append(trait_value)
+        return code_map[trait_value]
+
+    def encode_metadata(self, metadata):
+        # trait values to codes in layer order, blank cells and missing layers are "None"
+        import pandas as pd
+
+        codes = np.empty((len(metadata), len(self.layer_names)), dtype=np.int64)
+        for index, trait_name in enumerate(self.layer_names):
+            if trait_name not in metadata:
+                codes[:, index] = self.code_maps[index]["None"]
+                continue
+            values = metadata[trait_name]
+            # columns already coded against this layer's vocabulary are used as they are
+            if isinstance(values.dtype, pd.CategoricalDtype) and list(values.cat.categories) == self.vocabularies[index]:
+                column = values.cat.codes.to_numpy()
+                if (column >= 0).all():
+                    codes[:, index] = column
+                    continue
+            values = values.astype(object).replace("", "None")
+            column = pd.Categorical(values, categories=self.vocabularies[index]).codes
+            if (column < 0).any():
+                raise RuntimeError("unable to locate trait (value: {}) for (trait: {})".format(values[column < 0].iloc[0], trait_name))
+            codes[:, index] = column
+        return codes
+
+    def has_rule(self, trait_name):
+        return self.constrained[self.layer_index[trait_name]]
+
+    def equals_assignments(self, trait_name, trait_value):
+        index = self.layer_index[trait_name]
+        code = self.code_maps[index].get(trait_value)
+        for other_index, other_code in self._equals_pairs[index].get(code, []):
+            yield self.layer_names[other_index], self.vocabularies[other_index][other_code]
+
+    def candidate_weights(self, layer_index, codes):
+        # per-row trait weights for a constrained layer given the already drawn lower layers,
+        # rows forced by an equals rule carry all of their weight on the forced trait
+        weights = self.weights[layer_index]
+        n = len(codes)
+        mask = np.ones((n, len(weights)), dtype=bool)
+        forced = np.full(n, -1)
+        forced_rank = np.full(n, NO_RULE)
+        for other_index, allowed, forced_table, rank_table in self.parents[layer_index]:
+            parent_codes = codes[:, other_index]
+            mask &= allowed[parent_codes]
+            rank = rank_table[parent_codes]
+            earlier = rank < forced_rank
+            forced[earlier] = forced_table[parent_codes][earlier]
+            forced_rank[earlier] = rank[earlier]
+
+        candidates = mask * weights
+        is_forced = forced != -1
+        candidates[is_forced] = 0
+        candidates[is_forced, forced[is_forced]] = 1
+        return candidates
+
+    def apply_equals_updates(self, layer_index, codes):
+        draws = codes[:, layer_index]
+        for this_code, updates in self.equals_updates[layer_index].items():
+            picked = draws == this_code
+            for other_index, other_code in updates:
+                codes[picked, other_index] = other_code
+
+    def valid_codes(self, trait_name, parent_codes):
+        index = self.layer_index[trait_name]
+        allowed = np.zeros(len(self.vocabularies[index]), dtype=bool)
+        allowed[self.live_codes[index]] = True
+        forced, rank = -1, NO_RULE
+        for other_index, allowed_table, forced_table, rank_table in self.parents[index]:
+            parent_code = parent_codes.get(other_index)
+            if parent_code is None:
+                continue
+            allowed &= allowed_table[parent_code]
+            if rank_table[parent_code] < rank:
+                forced, rank = forced_table[parent_code], rank_table[parent_code]
+        if forced != -1:
+            return [forced]
+        return list(np.flatnonzero(allowed))
+
+    def parent_names(self, trait_name):
+        return [self.layer_names[other_index] for other_index, *_ in self.parents[self.layer_index[trait_name]]]
+
+    def valid_traits(self, trait_name, parent_values):
+        parent_codes = {
+            self.layer_index[name]: self.code_maps[self.layer_index[name]].get(value)
+            for name, value in parent_values.items()
+        }
+        vocabulary = self.vocabularies[self.layer_index[trait_name]]
+        return [vocabulary[code] for code in self.valid_codes(trait_name, parent_codes)]
+
+
+def _orient(trait_name, rule):
+    if trait_name == rule[constants.TRAIT_1_KEY][constants.RULE_TRAIT_NAME]:
+        return constants.TRAIT_1_KEY, constants.TRAIT_2_KEY
+    return constants.TRAIT_2_KEY, constants.TRAIT_1_KEY
@@ -0,0 +1,116 @@
+import io
+import numpy as np
+from PIL import Image, ImageColor
+
+import factory.constants as constants
+from factory.profiling import profiler
+
+# output formats by filetype, with the modes each one can store as is
+FORMATS = {
+    "png": ("PNG", ("1", "L", "P", "RGB", "RGBA")),
+    "jpeg": ("JPEG", ("L", "RGB")),
+}
+
+RESAMPLE_FILTERS = {
+    "nearest": Image.NEAREST,
+    "box": Image.BOX,
+    "bilinear": Image.BILINEAR,
+    "hamming": Image.HAMMING,
+    "bicubic": Image.BICUBIC,
+    "lanczos": Image.LANCZOS,
+}
+
+
+class Encoder:
+    def __init__(self, filetype, compress_level=6, palette=False, quality=75, background="#ffffff"):
+        if filetype not in FORMATS:
+            raise ValueError("invalid output filetype: {}".format(filetype))
+        self.filetype = filetype
+        self.format, self.modes = FORMATS[filetype]
+        self.compress_level = compress_level
+        self.palette = palette
+        self.quality = quality
+        self.background = ImageColor.getrgb(background)[:3]
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.get_output_filetype(),
+            compress_level=config.get_encode_option(constants.ENCODE_COMPRESS_LEVEL_KEY),
+            palette=config.get_encode_option(constants.ENCODE_PALETTE_KEY),
+            quality=config.get_encode_option(constants.ENCODE_QUALITY_KEY),
+            background=config.get_encode_option(constants.ENCODE_BACKGROUND_KEY),
+        )
+
+    def settings(self):
+        # everything that changes the encoded bytes, part of a token's input hash
+        if self.format == "JPEG":
+            return "{} quality={} background={}".format(self.filetype, self.quality, self.background)
+        return "{} compress_level={} palette={}".format(self.filetype, self.compress_level, self.palette)
+
+    def prepare(self, img):
+        # conversions that happen before encoding, a palette image can be upscaled with
+        # nearest-neighbour and stays a palette image, so it is only converted once per token
+        if self.format == "PNG" and self.palette:
+            with profiler.stage("palette", items=1):
+                return to_palette(img)
+        return img
+
+    def encode(self, img):
+        with profiler.stage("encode", items=1):
+            buffer = io.BytesIO()
+            if self.format == "JPEG":
+                flatten(img, self.background).save(buffer, format=self.format, quality=self.quality)
+            else:
+                if img.mode not in self.modes:
+                    img = img.convert("RGBA")
+                img.save(buffer, format=self.format, compress_level=self.compress_level)
+            data = buffer.getvalue()
+        profiler.count("encoded_bytes", len(data))
+        return data
+
+
+def flatten(img, background):
+    # jpeg has no alpha channel, transparent pixels are blended onto the background color
+    # instead of being dropped with whatever color they happen to carry
+    if img.mode in ("L", "RGB"):
+        return img
+    if img.mode not in ("LA", "RGBA") and "transparency" not in img.info:
+        return img.convert("RGB")
+    img = img.convert("RGBA")
+    flat = Image.new("RGB", img.size, background)
+    flat.paste(img, mask=img)
+    return flat
+
+
+def to_palette(img):
+    # lossless: only images with at most 256 distinct colors are converted, each color keeps
+    # its exact value and alpha, so the palette image decodes to the same pixels
+    if img.mode not in ("RGB", "RGBA"):
+        return img
+    pixels = np.asarray(img)
+    channels = pixels.shape[2]
+    packed = pixels.reshape(-1, channels).astype(np.uint32)
+    keys = packed[:, 0] << 24 | packed[:, 1] << 16 | packed[:, 2] << 8
+    if channels == 4:
+        keys |= packed[:, 3]
+    colors, indices = np.unique(keys, return_inverse=True)
+    if len(colors) > 256:
+        return img
+
+    paletted = Image.fromarray(indices.reshape(pixels.shape[:2]).astype(np.uint8), "P")
+    rgb = np.stack([colors >> 24, colors >> 16, colors >> 8], axis=1).astype(np.uint8)
+    paletted.putpalette(rgb.tobytes())
+    if channels == 4:
+        alpha = (colors & 0xff).astype(np.uint8)
+        if (alpha < 255).any():
+            paletted.info["transparency"] = alpha.tobytes()
+    return paletted
+
+
+def resize(img, width, resample="nearest"):
+    # scales to the given width, keeping the aspect ratio of the native composite
+    if width == img.width:
+        return img
+    height = max(1, round(img.height * width / img.width))
+    return img.resize((width, height), RESAMPLE_FILTERS[resample])
@@ -1,125 +1,598 @@
 #!/usr/bin/env python
 
 from PIL import Image
+import functools
 import os
 from pathlib import Path
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
 import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
 from tqdm import tqdm
 import shutil
 
-import factory.pinata as pinata
+import factory.ipfs as ipfs
 import factory.constants as constants
 from factory.config import Config
+from factory.sampler import BatchSampler
+from factory.assets import AssetAtlas, image_size
+from factory.cache import LRUCache
+from factory.encoder import Encoder, resize
+from factory.manifest import Manifest, InputHasher, hash_bytes, combine_hashes
+from factory.profiling import profiler
+from factory.shards import shard_range, shard_dir, find_shards
+from factory.archive import ArchiveSink, ArchiveWriter, load_index, read_member, hash_members, expand, move_archives
 
+RENDER_BATCH_SIZE = 256
+# streaming mode: render batches waiting to be written and batches being rendered
+STREAM_QUEUE_SIZE = 16
+STREAM_MAX_IN_FLIGHT = 4 * os.cpu_count()
+# image folders pinned at the same time
+UPLOAD_MAX_WORKERS = 2
+
+# pandas, the stats, metadata store and upload modules (and through them requests and matplotlib)
+# are imported by the methods that use them, so importing this module and rendering stay light
 class Factory:
-    def __init__(self, config_path="./config.yaml", config=None, metadata=None):
+    # shard: (i, N) to render only the i-th of N contiguous token ranges into the collection's
+    # shards folder, merge_shards later combines the shards into the collection
+    def __init__(self, config_path="./config.yaml", config=None, metadata=None, shard=None):
         if config is not None:
             self.config = config
         else:
             self.config = Config(config_path)
-        self.metadata = pd.DataFrame(columns=[x[constants.LAYER_NAME_KEY] for x in self.config.get_layers()]) if metadata is None else metadata
-        self.pinata_client = pinata.PinataClient()
-
-    def generate(self, count):
-        hash_set = set()
-
-        current_count = 0
-        with tqdm(total=count) as pbar:
-            while current_count < count:
-                current_trait_set = pd.DataFrame(columns=list(self.metadata.columns))
-                for layer in self.config.get_layers():
-                    trait_name = layer[constants.LAYER_NAME_KEY]
-                    if self.config.has_rule(trait_name):
-                        valid_traits = self.config.get_valid_trait(trait_name, current_trait_set)
-                        valid_weights = []
-                        for trait_value in valid_traits:
-                            valid_weights.append(layer[constants.LAYER_WEIGHTS_KEY][trait_value])
-                        valid_weights = list(np.array(valid_weights) / sum(valid_weights) * 100)
-                    else:
-                        valid_traits, valid_weights = list(layer[constants.LAYER_WEIGHTS_KEY].keys()), list(layer[constants.LAYER_WEIGHTS_KEY].values())
-                    
-                    trait_value = np.random.default_rng().choice(valid_traits, 1, p=(np.array(valid_weights) / np.sum(valid_weights)).tolist()).tolist()[0]
-                    current_trait_set.at[0, trait_name] = trait_value
-                    for trait_name_to_update, new_trait_value in self.config.has_equals_rule(trait_name, trait_value):
-                        current_trait_set.at[0, trait_name_to_update] = new_trait_value    
-
-                trait_hash = hash(tuple(list(current_trait_set.iloc[0])))
-                if trait_hash in hash_set:
-                    continue
-                hash_set.add(trait_hash)
-                current_count += 1
-                self.metadata = pd.concat([self.metadata, current_trait_set], ignore_index=True)
-                pbar.update(1)
-                    
+        if metadata is None:
+            import pandas as pd
+            metadata = pd.DataFrame(columns=[x[constants.LAYER_NAME_KEY] for x in self.config.get_layers()])
+        self.metadata = metadata
+        self.shard = shard
+        self._pinata_client = None
+
+    @property
+    def pinata_client(self):
+        # created on first upload, render-only runs never need credentials or a session
+        if self._pinata_client is None:
+            import factory.pinata as pinata
+            self._pinata_client = pinata.PinataClient()
+        return self._pinata_client
+
+    def generate(self, count, seed=None):
+        import pandas as pd
+
+        # every shard samples the whole collection from the same seed, so all nodes agree on it
+        sampler = BatchSampler(self.config, seed=self._seed(seed))
+        with tqdm(total=count) as pbar, profiler.stage("generate", items=count):
+            codes = sampler.sample(count, progress=pbar.update)
+
+        trait_sets = sampler.decode(codes)
+        if len(self.metadata) == 0:
+            self.metadata = trait_sets
+        else:
+            self.metadata = pd.concat([self.metadata, trait_sets], ignore_index=True)
+
     def write_to_csv(self):
-        # Define output path to output/collection_name
-        op_path = os.path.join('output', self.config.get_collection_name(), 'metadata')
+        # Define output path to output/collection_name, or the shard folder in it
+        op_path = os.path.join(self._collection_path(), 'metadata')
 
         # Create output directory if it doesn't exist
         if not os.path.exists(op_path):
             os.makedirs(op_path)
         
-        filtered_none = self.metadata.replace("None", "")
-        filtered_none.insert(loc=0, column='filename', value=[str(x - 1) + "." + self.config.get_filetype() for x in range(1, len(filtered_none) + 1)])
-        filtered_none.to_csv(os.path.join(op_path, "metadata.csv"), index=False)
+        from factory.metadata import store_path, write_store
 
-    def generate_images(self):
-        # Create output directory if it doesn't exist
+        # a shard only writes its own rows, the store is written once the shards are merged
+        start, stop = shard_range(len(self.metadata), self.shard)
+        with profiler.stage("metadata_write", items=stop - start):
+            self._csv_rows(self.metadata.iloc[start:stop], start).to_csv(os.path.join(op_path, "metadata.csv"), index=False)
+            store = self.config.get_metadata_store()
+            if store and self.shard is None:
+                write_store(self.metadata, self.config.constraints, store_path(os.path.join(op_path, "metadata.csv"), store), store, os.path.join(op_path, "metadata.csv"))
 
-        self.images_path = (Path(constants.OUTPUT_DIR_NAME) / self.config.get_collection_name() / constants.IMAGES_DIR_NAME)
-        if self.images_path.exists() or self.images_path.is_file():
-            shutil.rmtree(self.images_path)
-        os.makedirs(self.images_path)
+    def _csv_rows(self, metadata, start):
+        import pandas as pd
+        from factory.metadata import blank_none
 
-        df_copy = self.metadata.copy()
-        df_copy.replace('', "None", inplace=True)
+        filtered_none = pd.DataFrame({column: blank_none(metadata[column]) for column in metadata})
+        filtered_none.insert(loc=0, column='filename', value=[str(x) + "." + self.config.get_output_filetype() for x in range(start, start + len(filtered_none))])
+        return filtered_none
 
-        assets_path = self.config.get_assets_path()
-        for trait in df_copy.columns:
-            trait_path = (Path(assets_path) / trait).resolve()
-            df_copy.loc[df_copy[trait] != "None", trait] = str(trait_path) + "/" + df_copy[trait] + "." + self.config.get_filetype()
-        
-        outputs = df_copy.index.map(lambda index: str(self.images_path.resolve()) + "/" + str(index) + "." + self.config.get_filetype())
-        df_copy.insert(loc=0, column='file_output', value=outputs)
+    def generate_images(self, backend=None):
+        codes = self.config.constraints.encode_metadata(self.metadata)
+        collection_path, atlas, initargs = self._prepare_render(backend)
+        atlas.check(self.config.constraints, codes)
+        # a shard renders its own token range, indices stay global
+        start, stop = shard_range(len(codes), self.shard)
 
-        with mp.Pool() as pool:
-            args = df_copy.values.tolist()
-            list(tqdm(pool.imap(save_image, args), total=len(args)))
+        # only tokens that are missing, changed or corrupt since the last run are rendered again
+        with profiler.stage("manifest_check", items=stop - start):
+            manifest = Manifest(collection_path / constants.MANIFEST_FILE_NAME)
+            input_hashes = InputHasher(self.config, self._render_settings())(codes[start:stop])
+            self._remove_stale_outputs(manifest, stop, start)
+            if self._archived():
+                # the newest archived copy of every output, a token missing any of them is rendered again
+                members = [load_index(collection_path / constants.ARCHIVES_DIR_NAME, directory.name) for directory, _, _ in self.outputs]
+                output_paths = [self._token_members(members, index) for index in range(start, stop)]
+                stale = manifest.stale_tokens(range(start, stop), input_hashes, output_paths, hash_outputs=hash_members)
+            else:
+                output_paths = [[str(directory / (str(index) + "." + self.encoder.filetype)) for directory, _, _ in self.outputs] for index in range(start, stop)]
+                stale = manifest.stale_tokens(range(start, stop), input_hashes, output_paths)
+            stale = np.array(stale, dtype=np.int64)
+        print("{} of {} images are up to date".format(stop - start - len(stale), stop - start))
 
-    def upload(self):
-        resp = self.pinata_client.upload_folder(os.path.join(constants.OUTPUT_DIR_NAME, str(self.config.get_collection_name()), constants.IMAGES_DIR_NAME), self.config.get_collection_name())
+        # render tokens sorted by their layer codes so each worker sees long runs of shared lower layers
+        order = stale[np.lexsort(codes[stale].T[::-1])]
+        batches = [(order[offset:offset + RENDER_BATCH_SIZE], codes[order[offset:offset + RENDER_BATCH_SIZE]]) for offset in range(0, len(order), RENDER_BATCH_SIZE)]
 
-        images_path = os.path.join(constants.OUTPUT_DIR_NAME, self.config.get_collection_name(), "final")
-        if not os.path.exists(images_path):
-            os.makedirs(images_path)
+        hits = 0
+        encoding = self._encoding_totals()
+        sink = self._open_sink(collection_path)
+        with mp.Pool(initializer=init_render_worker, initargs=initargs) as pool, tqdm(total=len(order)) as pbar, profiler.stage("render", items=len(order)):
+            for output_hashes, batch_hits, timings in pool.imap(render_batch, batches):
+                for index, (output_hash, cids, datas) in output_hashes:
+                    manifest.record(index, input_hashes[index - start], output_hash, cids)
+                    if sink is not None:
+                        sink.add(index, datas)
+                manifest.flush()
+                profiler.merge(timings)
+                hits += batch_hits
+                pbar.update(len(output_hashes))
+        if sink is not None:
+            with profiler.stage("archive_write"):
+                sink.close()
+        manifest.save()
+        self._report_cache_hits(initargs, hits, len(order))
+        self._report_encoding(encoding)
+        if self.shard is None:
+            self._report_cids()
+        else:
+            print("shard {} of {} holds images {} to {}".format(self.shard[0], self.shard[1], start, stop - 1))
 
-        with open(os.path.join(constants.OUTPUT_DIR_NAME, self.config.get_collection_name(), "final", "IPFS CID"), "a+") as f:
-            f.write(resp['IpfsHash'])
+    def merge_shards(self, plot=True):
+        # combines the shards copied into the collection's shards folder into the collection:
+        # images are moved into place, manifests and metadata rows are joined in token order and
+        # the stats are computed over the whole collection, the same files a single run writes.
+        # An interrupted merge can be run again, the shards folder is only removed at the end
+        import pandas as pd
+        from factory.metadata import categorical_frame, read_csv
 
-    def generate_stats(self):
-        stats_path = os.path.join(constants.OUTPUT_DIR_NAME, self.config.get_collection_name(), "stats")
-        if not os.path.exists(stats_path):
-            os.makedirs(stats_path)
+        collection_path = Path(constants.OUTPUT_DIR_NAME) / self.config.get_collection_name()
+        shard_paths = find_shards(collection_path)
+        frames = [read_csv(path / constants.METADATA_DIR_NAME / constants.METADATA_FILE_NAME) for path in shard_paths]
+        count = sum(len(frame) for frame in frames)
+        for index, (path, frame) in enumerate(zip(shard_paths, frames)):
+            start, stop = shard_range(count, (index, len(shard_paths)))
+            if len(frame) != stop - start:
+                raise RuntimeError("{} holds {} metadata rows, expected {} for a collection of {}".format(path, len(frame), stop - start, count))
+        # coded against the layer vocabularies, as the sampler leaves them
+        codes = self.config.constraints.encode_metadata(pd.concat(frames, ignore_index=True))
+        self.metadata = categorical_frame(self.config.constraints, codes)
+
+        with profiler.stage("merge", items=count):
+            manifest = Manifest(collection_path / constants.MANIFEST_FILE_NAME, load=False)
+            manifest.tokens = {}
+            for path in shard_paths:
+                manifest.tokens.update(Manifest(path / constants.MANIFEST_FILE_NAME).tokens)
+            self.outputs = self._outputs(collection_path)
+            for directory, _, _ in ([] if self._archived() else self.outputs):
+                os.makedirs(directory, exist_ok=True)
+            self._remove_stale_outputs(manifest, count)
+            for path in shard_paths:
+                for directory, _, _ in self.outputs:
+                    if self._archived():
+                        # archived shards are appended after the collection's archives, so their copies are the newest
+                        move_archives(path / constants.ARCHIVES_DIR_NAME, collection_path / constants.ARCHIVES_DIR_NAME, directory.name)
+                        continue
+                    if not (path / directory.name).is_dir():
+                        continue
+                    for entry in os.scandir(path / directory.name):
+                        os.replace(entry.path, directory / entry.name)
+            manifest.save()
+
+        self.shard = None
+        self.write_to_csv()
+        stats = self.generate_stats(plot=plot)
+        shutil.rmtree(collection_path / constants.SHARDS_DIR_NAME)
+        self._report_cids()
+        return stats
+
+    def generate_streaming(self, count, seed=None, backend=None):
+        # sample, write metadata and render at the same time: sampled batches go through a bounded
+        # queue, and only a bounded number of batches is in flight in the render pool, so memory
+        # stays flat however large count is (the sampler still keeps one integer key per token)
+        if self.shard is not None:
+            raise ValueError("streaming mode renders the whole collection, it cannot run as a shard")
+        collection_path, atlas, initargs = self._prepare_render(backend)
+        manifest = Manifest(collection_path / constants.MANIFEST_FILE_NAME, load=False)
+        manifest.reset()
+        self._remove_stale_outputs(manifest, count)
+        # every token is rendered again, older archives would only hold superseded copies
+        if self._archived():
+            shutil.rmtree(collection_path / constants.ARCHIVES_DIR_NAME, ignore_errors=True)
+        hasher = InputHasher(self.config, self._render_settings())
+
+        # drawn in the same batches as generate so a seed gives the same collection, split up for rendering
+        sampler = BatchSampler(self.config, seed=self._seed(seed))
+        batches = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+        def produce():
+            try:
+                for codes in sampler.iter_batches(count):
+                    for start in range(0, len(codes), RENDER_BATCH_SIZE):
+                        batches.put(codes[start:start + RENDER_BATCH_SIZE])
+                batches.put(None)
+            except Exception as e:
+                batches.put(e)
+
+        metadata_path = collection_path / constants.METADATA_DIR_NAME / constants.METADATA_FILE_NAME
+        metadata_path.parent.mkdir(parents=True, exist_ok=True)
+        in_flight = threading.BoundedSemaphore(STREAM_MAX_IN_FLIGHT)
+        errors = []
+        hits = [0]
+        encoding = self._encoding_totals()
+        sink = self._open_sink(collection_path)
+
+        with mp.Pool(initializer=init_render_worker, initargs=initargs) as pool, tqdm(total=count) as pbar, open(metadata_path, 'w', newline='') as csv_file, profiler.stage("stream", items=count):
+            def rendered(result, input_hashes):
+                # runs on the pool's result thread, an exception here would kill it and leave the
+                # loop below waiting forever, so it is kept for the main thread to raise
+                try:
+                    output_hashes, batch_hits, timings = result
+                    for (index, (output_hash, cids, datas)), input_hash in zip(output_hashes, input_hashes):
+                        manifest.record(index, input_hash, output_hash, cids)
+                        if sink is not None:
+                            sink.add(index, datas)
+                    profiler.merge(timings)
+                    hits[0] += batch_hits
+                    pbar.update(len(output_hashes))
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    in_flight.release()
+
+            def failed(error):
+                errors.append(error)
+                in_flight.release()
+
+            # started only once the pool has forked its workers
+            threading.Thread(target=produce, daemon=True).start()
+
+            written = 0
+            while not errors:
+                codes = batches.get()
+                if codes is None:
+                    break
+                if isinstance(codes, Exception):
+                    raise codes
+                with profiler.stage("metadata_write", items=len(codes)):
+                    self._csv_rows(sampler.decode(codes), written).to_csv(csv_file, index=False, header=written == 0)
+                    csv_file.flush()
+
+                indices = np.arange(written, written + len(codes))
+                written += len(codes)
+                order = np.lexsort(codes.T[::-1])
+                in_flight.acquire()
+                pool.apply_async(render_batch, ((indices[order], codes[order]),), callback=functools.partial(rendered, input_hashes=hasher(codes[order])), error_callback=failed)
+                manifest.flush()
+
+            pool.close()
+            pool.join()
+        if sink is not None:
+            with profiler.stage("archive_write"):
+                try:
+                    sink.close()
+                except Exception:
+                    # a failed writer is usually what stopped the run, its first error is raised below
+                    if not errors:
+                        raise
+        manifest.flush()
+        if errors:
+            raise errors[0]
+        self._report_cache_hits(initargs, hits[0], count)
+        self._report_encoding(encoding)
+        self._report_cids()
+        return written
+
+    def _seed(self, seed):
+        # an explicit seed, else the configured one, else a fresh one that is printed so the run
+        # can be repeated. Shards need a seed every node knows
+        if seed is None:
+            seed = self.config.get_seed()
+        if seed is None:
+            if self.shard is not None:
+                raise ValueError("a sharded run needs a collection seed, set seed in the config or pass --seed")
+            seed = np.random.SeedSequence().entropy
+            print("collection seed: {}".format(seed))
+        return seed
+
+    def _collection_path(self):
+        collection_path = Path(constants.OUTPUT_DIR_NAME) / self.config.get_collection_name()
+        return collection_path if self.shard is None else shard_dir(collection_path, self.shard)
+
+    def _prepare_render(self, backend):
+        collection_path = self._collection_path()
+        self.images_path = collection_path / constants.IMAGES_DIR_NAME
+        self.outputs = self._outputs(collection_path)
+        sink = self.config.get_render_option(constants.RENDER_SINK_KEY)
+        if sink not in (constants.RENDER_SINK_FILES, constants.RENDER_SINK_TAR):
+            raise ValueError("invalid render sink: {}".format(sink))
+        # archived images are sent back by the workers and written to the archives folder instead
+        for directory, _, _ in (self.outputs if sink == constants.RENDER_SINK_FILES else []):
+            if directory.is_file():
+                os.remove(directory)
+            os.makedirs(directory, exist_ok=True)
+
+        if backend is None:
+            backend = self.config.get_render_option(constants.RENDER_BACKEND_KEY)
+        if backend not in (constants.RENDER_BACKEND_PIL, constants.RENDER_BACKEND_NUMPY):
+            raise ValueError("invalid render backend: {}".format(backend))
+
+        self.encoder = Encoder.from_config(self.config)
+        atlas = AssetAtlas.build(self.config, collection_path / constants.CACHE_DIR_NAME / constants.ATLAS_FILE_NAME)
+        cache_bytes = int(self.config.get_render_option(constants.RENDER_CACHE_SIZE_KEY) * 1024 * 1024)
+        return collection_path, atlas, (atlas, [(str(directory.resolve()), width, resample) for directory, width, resample in self.outputs], self.encoder, cache_bytes, backend, sink)
+
+    def _archived(self):
+        return self.config.get_render_option(constants.RENDER_SINK_KEY) == constants.RENDER_SINK_TAR
+
+    def _open_sink(self, collection_path):
+        # None when the workers write every image as its own file
+        if not self._archived():
+            return None
+        max_bytes = int(self.config.get_render_option(constants.RENDER_ARCHIVE_SIZE_KEY) * 1024 * 1024)
+        writers = [ArchiveWriter(collection_path / constants.ARCHIVES_DIR_NAME, directory.name, max_bytes) for directory, _, _ in self.outputs]
+        return ArchiveSink(writers, self.encoder.filetype)
+
+    def _token_members(self, members, index):
+        # the archive member of every output of a token, None when any of them is missing
+        name = str(index) + "." + self.config.get_output_filetype()
+        if not all(name in output_members for output_members in members):
+            return None
+        return [output_members[name] for output_members in members]
 
-        for layer in self.config.get_layers():
-            self.metadata[layer[constants.LAYER_NAME_KEY]].value_counts().plot(kind='bar')
-            plt.savefig(os.path.join(stats_path, layer[constants.LAYER_NAME_KEY]+".png"), bbox_inches="tight")
+    def _report_cache_hits(self, initargs, hits, rendered):
+        if initargs[4] == constants.RENDER_BACKEND_PIL and rendered:
+            print("prefix cache hit rate: {:.1%}".format(hits / rendered))
+
+    def _outputs(self, collection_path):
+        # (directory, width, resample filter) of every image written per token, the native
+        # composite goes to images/ and every configured size to images_<size>/
+        outputs = [(collection_path / constants.IMAGES_DIR_NAME, None, None)]
+        for size in self.config.get_render_option(constants.RENDER_SIZES_KEY):
+            width = size[constants.RENDER_SIZE_KEY]
+            resample = size.get(constants.RENDER_RESAMPLE_KEY, constants.RENDER_DEFAULT_RESAMPLE)
+            outputs.append((collection_path / "{}_{}".format(constants.IMAGES_DIR_NAME, width), width, resample))
+        return outputs
+
+    def _render_settings(self):
+        sizes = ["{}:{}".format(width, resample) for _, width, resample in self.outputs[1:]]
+        return self.encoder.settings() + ("\nsizes=" + " ".join(sizes) if sizes else "")
+
+    def _encoding_totals(self):
+        encode = profiler.stages.get("encode", {})
+        return encode.get("items", 0), encode.get("seconds", 0.0), profiler.stages.get("encoded_bytes", {}).get("items", 0)
+
+    def _report_encoding(self, before):
+        # the profiler spans the whole process, only what this run encoded is reported
+        images, seconds, encoded_bytes = (now - then for now, then in zip(self._encoding_totals(), before))
+        if images:
+            print("encoded {} images as {}: {:.2f} ms and {:.0f} bytes per image".format(images, self.encoder.settings(), 1000 * seconds / images, encoded_bytes / images))
+
+    def _report_cids(self):
+        for name, cid in self.folder_cids().items():
+            print("IPFS CID of {}: {}".format(name, cid))
+
+    def folder_cids(self):
+        # IPFS CID of every image folder, known before anything is uploaded. Built from the CIDs the
+        # render workers recorded in the manifest, a folder the manifest does not fully cover is
+        # hashed from disk instead
+        collection_path = Path(constants.OUTPUT_DIR_NAME) / self.config.get_collection_name()
+        manifest = Manifest(collection_path / constants.MANIFEST_FILE_NAME)
+        suffix = "." + self.config.get_output_filetype()
+        cids = {}
+        for position, (directory, _, _) in enumerate(self._outputs(collection_path)):
+            if self._archived():
+                nodes = self._archived_nodes(collection_path, manifest, directory.name, position)
+                if nodes:
+                    cids[directory.name] = ipfs.to_cid(ipfs.tree_node(nodes)[0])
+                continue
+            if not directory.is_dir():
+                continue
+            nodes = {}
+            for entry in os.scandir(directory):
+                if entry.name.startswith("."):
+                    continue
+                token = manifest.tokens.get(entry.name[:-len(suffix)]) if entry.name.endswith(suffix) and entry.is_file() else None
+                if token is None or len(token.get("cids", [])) <= position:
+                    nodes = None
+                    break
+                cid, size = token["cids"][position]
+                nodes[entry.name] = (ipfs.from_cid(cid), size)
+            multihash = ipfs.tree_node(nodes)[0] if nodes is not None else ipfs.folder_nodes(directory)[0][0]
+            cids[directory.name] = ipfs.to_cid(multihash)
+        return cids
+
+    def _archived_members(self, collection_path, manifest, prefix):
+        # (name, archive member) of the newest copy of every image of the collection, by name
+        members = load_index(collection_path / constants.ARCHIVES_DIR_NAME, prefix)
+        suffix = "." + self.config.get_output_filetype()
+        return sorted((name, member) for name, member in members.items() if name.endswith(suffix) and name[:-len(suffix)] in manifest.tokens)
+
+    def _archived_nodes(self, collection_path, manifest, prefix, position):
+        # IPFS nodes of the archived images, from the manifest or hashed from the archives
+        suffix = "." + self.config.get_output_filetype()
+        nodes = {}
+        for name, member in self._archived_members(collection_path, manifest, prefix):
+            token_cids = manifest.tokens[name[:-len(suffix)]].get("cids", [])
+            if len(token_cids) > position:
+                nodes[name] = (ipfs.from_cid(token_cids[position][0]), token_cids[position][1])
+            else:
+                nodes[name] = ipfs.file_node(read_member(member))
+        return nodes
+
+    def expand_archives(self):
+        # writes the archived images out as loose files into the usual image folders
+        collection_path = Path(constants.OUTPUT_DIR_NAME) / self.config.get_collection_name()
+        manifest = Manifest(collection_path / constants.MANIFEST_FILE_NAME)
+        suffix = "." + self.config.get_output_filetype()
+        names = [index + suffix for index in manifest.tokens]
+        with profiler.stage("archive_expand", items=len(names)):
+            for directory, _, _ in self._outputs(collection_path):
+                expand(collection_path / constants.ARCHIVES_DIR_NAME, directory.name, directory, names)
+        return len(names)
+
+    def _remove_stale_outputs(self, manifest, stop, start=0):
+        # drop images and manifest entries of tokens that are no longer part of the collection,
+        # or of the shard's [start, stop) range
+        suffix = "." + self.config.get_output_filetype()
+        for directory, _, _ in self.outputs:
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory):
+                stem = entry.name[:-len(suffix)] if entry.name.endswith(suffix) else ""
+                if stem.isdigit() and str(int(stem)) == stem and start <= int(stem) < stop:
+                    continue
+                if entry.is_dir():
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+        if manifest.tokens is not None:
+            for index in list(manifest.tokens):
+                if not start <= int(index) < stop:
+                    manifest.forget(index)
+
+    def upload(self, max_workers=UPLOAD_MAX_WORKERS):
+        # every image folder is pinned as its own IPFS directory, finished folders are kept in a
+        # checkpoint so an interrupted upload only sends the folders that had not finished
+        from factory.upload import UploadCheckpoint
+
+        collection_path = Path(constants.OUTPUT_DIR_NAME) / self.config.get_collection_name()
+        final_path = collection_path / constants.FINAL_DIR_NAME
+        final_path.mkdir(parents=True, exist_ok=True)
+        checkpoint = UploadCheckpoint(final_path / constants.UPLOAD_CHECKPOINT_FILE_NAME)
+
+        uploads = []
+        for directory, width, _ in self._outputs(collection_path):
+            if width is None:
+                uploads.append((directory, self.config.get_collection_name(), constants.CID_FILE_NAME))
+            elif directory.is_dir() or self._archived():
+                uploads.append((directory, "{}_{}".format(self.config.get_collection_name(), width), "{} {}".format(constants.CID_FILE_NAME, directory.name)))
+        # from the CIDs the render workers recorded, so no image is hashed again before it is sent
+        cids = self.folder_cids()
+
+        def upload_one(upload):
+            directory, upload_name, _ = upload
+            if not self._archived():
+                return self.pinata_client.upload_folder(str(directory), upload_name, checkpoint=checkpoint, local_cid=cids.get(directory.name))
+            # archived images are sent straight from the archives, under the names they would have as files
+            manifest = Manifest(collection_path / constants.MANIFEST_FILE_NAME)
+            files = [(upload_name + "/" + name, member) for name, member in self._archived_members(collection_path, manifest, directory.name)]
+            return self.pinata_client.upload_files(files, cids.get(directory.name), str(collection_path / constants.ARCHIVES_DIR_NAME / directory.name), checkpoint=checkpoint)
+
+        with profiler.stage("upload", items=len(uploads)), ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(upload_one, uploads)
+            for (_, _, cid_file_name), resp in zip(uploads, results):
+                # a CID file keeps the CIDs of earlier uploads, one per line
+                with open(final_path / cid_file_name, "a+") as f:
+                    f.write(resp['IpfsHash'] + "\n")
+
+    def generate_stats(self, plot=True, processes=None):
+        # trait frequencies, rarity scores and ranks go to stats.json and rarity.csv, the per layer
+        # bar charts are optional
+        from factory.stats import CollectionStats
+
+        stats_path = os.path.join(constants.OUTPUT_DIR_NAME, self.config.get_collection_name(), "stats")
+        layer_names = [layer[constants.LAYER_NAME_KEY] for layer in self.config.get_layers()]
+        with profiler.stage("stats", items=len(self.metadata)):
+            stats = CollectionStats(self.metadata, layer_names)
+            stats.write(stats_path, [str(x) + "." + self.config.get_output_filetype() for x in range(len(self.metadata))])
+        if plot:
+            stats.plot(stats_path, processes)
+        return stats
     
     def row_count(self):
         return len(self.metadata)
 
+    def write_profile(self):
+        # machine readable timings of every stage in this run, worker stages are summed over workers
+        return profiler.write_report(self._collection_path() / constants.PROFILE_FILE_NAME, collection=self.config.get_collection_name())
+
+# per-process render state, set once by the pool initializer
+_worker = {}
+
+def init_render_worker(atlas, outputs, encoder, cache_bytes, backend=constants.RENDER_BACKEND_PIL, sink=constants.RENDER_SINK_FILES):
+    # forked workers inherit the parent's measurements, drop them so they are not merged back twice
+    profiler.collect()
+    _worker['backend'] = backend
+    _worker['sink'] = sink
+    _worker['atlas'] = atlas
+    _worker['outputs'] = outputs
+    _worker['encoder'] = encoder
+    _worker['cache'] = LRUCache(cache_bytes, size_of=image_size)
+
+# returns the hash, IPFS CIDs and, when archived, the encoded bytes of the images
 def save_image(args):
-    output_path = args[0]
+    index, codes = args
+    with profiler.stage("composite", items=1):
+        img = _worker['atlas'].composite(codes, _worker['cache'])
+    return write_image(img, index)
 
-    bg = None
-    for arg in args[1:]:
-        if arg != "None":
-            if bg is None:
-                bg = Image.open(arg)
-                continue
-            img = Image.open(arg)
-            bg.paste(img, (0, 0), img)
-    bg.save(output_path)
\ No newline at end of file
+# writes the composite at every configured size, returns the combined hash of the written images
+# and the (CID, cumulative size) of each, computed here while the encoded bytes are at hand. With
+# the tar sink nothing is written here, the encoded images are returned for the parent's archives
+def write_image(img, index):
+    encoder = _worker['encoder']
+    archived = _worker['sink'] == constants.RENDER_SINK_TAR
+    prepared = encoder.prepare(img)
+    output_hashes = []
+    cids = []
+    datas = []
+    for directory, width, resample in _worker['outputs']:
+        data = encoder.encode(scale_image(img, prepared, width, resample))
+        if archived:
+            datas.append(data)
+        else:
+            with profiler.stage("file_write", items=1):
+                with open(directory + "/" + str(index) + "." + encoder.filetype, 'wb') as f:
+                    f.write(data)
+        output_hashes.append(hash_bytes(data))
+        with profiler.stage("cid", items=1):
+            multihash, size = ipfs.file_node(data)
+        cids.append([ipfs.to_cid(multihash), size])
+    return combine_hashes(output_hashes), cids, datas if archived else None
+
+# the prepared composite at the given width, None keeps the native size
+def scale_image(img, prepared, width, resample):
+    if width is None:
+        return prepared
+    # nearest-neighbour keeps every pixel value, so the prepared image can be scaled as is
+    with profiler.stage("resize", items=1):
+        out = resize(prepared if resample == "nearest" else img, width, resample)
+    return out if resample == "nearest" else _worker['encoder'].prepare(out)
+
+# composites and encodes one token at one width without writing anything, for the render server
+def render_token(request):
+    codes, width, resample = request
+    with profiler.stage("composite", items=1):
+        img = _worker['atlas'].composite(codes, _worker['cache'])
+    encoder = _worker['encoder']
+    return encoder.encode(scale_image(img, encoder.prepare(img), width, resample))
+
+# renders one (token indices, layer codes) batch, returns (token index, (output hash, CIDs, data)) pairs,
+# prefix cache hits and the worker's stage timings for the batch
+def render_batch(batch):
+    indices, codes = batch
+    if _worker['backend'] == constants.RENDER_BACKEND_NUMPY:
+        with profiler.stage("composite", items=len(indices)):
+            frames, modes = _worker['atlas'].composite_batch(codes)
+        output_hashes = []
+        for index, frame, mode in zip(indices.tolist(), frames, modes):
+            img = Image.fromarray(frame)
+            if mode != "RGBA":
+                img = img.convert(mode)
+            output_hashes.append((index, write_image(img, index)))
+        return output_hashes, 0, profiler.collect()
+
+    cache = _worker['cache']
+    hits = cache.hits
+    output_hashes = [(index, save_image((index, token_codes))) for index, token_codes in zip(indices.tolist(), codes.tolist())]
+    return output_hashes, cache.hits - hits, profiler.collect()
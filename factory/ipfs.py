@@ -0,0 +1,198 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+
+# IPFS CIDv0 of files and folders as `ipfs add` builds them with its defaults: dag-pb nodes with
+# UnixFS data, 256KiB chunks in a balanced tree of up to 174 links, and folders that switch to a
+# HAMT sharded directory once their links take 256KiB or more
+
+CHUNK_SIZE = 262144
+MAX_LINKS = 174
+HAMT_SHARDING_SIZE = 262144
+HAMT_FANOUT = 256
+HAMT_HASH_MURMUR3 = 0x22
+
+UNIXFS_DIRECTORY = 1
+UNIXFS_FILE = 2
+UNIXFS_HAMT_SHARD = 5
+
+BASE58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+MASK_64 = (1 << 64) - 1
+
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _field(number, value):
+    # length delimited protobuf field
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def _uint_field(number, value):
+    return _varint(number << 3) + _varint(value)
+
+
+def _unixfs(kind, data=None, filesize=None, blocksizes=(), hash_type=None, fanout=None):
+    out = _uint_field(1, kind)
+    if data is not None:
+        out += _field(2, data)
+    if filesize is not None:
+        out += _uint_field(3, filesize)
+    for blocksize in blocksizes:
+        out += _uint_field(4, blocksize)
+    if hash_type is not None:
+        out += _uint_field(5, hash_type)
+    if fanout is not None:
+        out += _uint_field(6, fanout)
+    return out
+
+
+def _node(data, links=()):
+    # links: (multihash, name, cumulative size), returns (multihash, cumulative size) of the block
+    block = b"".join(_field(2, _field(1, multihash) + _field(2, name.encode()) + _uint_field(3, size)) for multihash, name, size in links)
+    block += _field(1, data)
+    return b"\x12\x20" + hashlib.sha256(block).digest(), len(block) + sum(size for _, _, size in links)
+
+
+def to_cid(multihash):
+    # CIDv0 is the base58btc encoded sha2-256 multihash
+    value = int.from_bytes(multihash, "big")
+    out = ""
+    while value:
+        value, remainder = divmod(value, 58)
+        out = BASE58_ALPHABET[remainder] + out
+    return BASE58_ALPHABET[0] * (len(multihash) - len(multihash.lstrip(b"\0"))) + out
+
+
+def from_cid(cid):
+    value = 0
+    for char in cid:
+        value = value * 58 + BASE58_ALPHABET.index(char)
+    return value.to_bytes(34, "big")
+
+
+def file_node(data):
+    # (multihash, cumulative size) of a file with the given content
+    chunks = [data[start:start + CHUNK_SIZE] for start in range(0, len(data), CHUNK_SIZE)] or [b""]
+    # (multihash, cumulative size, file bytes) of every node of the current tree level
+    # an empty file carries no data field at all
+    level = [_node(_unixfs(UNIXFS_FILE, chunk or None, len(chunk))) + (len(chunk),) for chunk in chunks]
+    while len(level) > 1:
+        parents = []
+        for start in range(0, len(level), MAX_LINKS):
+            children = level[start:start + MAX_LINKS]
+            filesize = sum(child[2] for child in children)
+            data = _unixfs(UNIXFS_FILE, filesize=filesize, blocksizes=[child[2] for child in children])
+            parents.append(_node(data, [(multihash, "", size) for multihash, size, _ in children]) + (filesize,))
+        level = parents
+    return level[0][:2]
+
+
+def file_cid(data):
+    return to_cid(file_node(data)[0])
+
+
+def directory_node(entries):
+    # entries: (name, multihash, cumulative size) of every file or subfolder
+    entries = sorted(entries, key=lambda entry: entry[0].encode())
+    estimated_size = sum(len(name.encode()) + len(multihash) for name, multihash, _ in entries)
+    if estimated_size >= HAMT_SHARDING_SIZE:
+        return _shard_node([(name, multihash, size, _murmur3_64(name.encode())) for name, multihash, size in entries], 0)
+    return _node(_unixfs(UNIXFS_DIRECTORY), [(multihash, name, size) for name, multihash, size in entries])
+
+
+def _shard_node(entries, depth):
+    # one byte of the name hash picks the slot on every level, slots with more than one
+    # entry become a shard of their own one level down
+    slots = {}
+    for entry in entries:
+        slots.setdefault(entry[3] >> (56 - 8 * depth) & 0xff, []).append(entry)
+    links = []
+    bitfield = 0
+    for index in sorted(slots):
+        bitfield |= 1 << index
+        prefix = "{:02X}".format(index)
+        if len(slots[index]) == 1:
+            name, multihash, size, _ = slots[index][0]
+            links.append((multihash, prefix + name, size))
+        else:
+            multihash, size = _shard_node(slots[index], depth + 1)
+            links.append((multihash, prefix, size))
+    bitfield_bytes = bitfield.to_bytes(HAMT_FANOUT // 8, "big").lstrip(b"\0")
+    return _node(_unixfs(UNIXFS_HAMT_SHARD, bitfield_bytes, hash_type=HAMT_HASH_MURMUR3, fanout=HAMT_FANOUT), links)
+
+
+def _rotl(value, shift):
+    return (value << shift | value >> (64 - shift)) & MASK_64
+
+
+def _fmix(value):
+    value ^= value >> 33
+    value = value * 0xff51afd7ed558ccd & MASK_64
+    value ^= value >> 33
+    value = value * 0xc4ceb9fe1a85ec53 & MASK_64
+    return value ^ value >> 33
+
+
+def _murmur3_64(data):
+    # first half of murmur3 x64 128 with seed 0, the hash HAMT directories place names with
+    c1, c2 = 0x87c37b91114253d5, 0x4cf5ad432745937f
+    h1 = h2 = 0
+    blocks = len(data) // 16
+    for block in range(blocks):
+        k1 = int.from_bytes(data[16 * block:16 * block + 8], "little")
+        k2 = int.from_bytes(data[16 * block + 8:16 * block + 16], "little")
+        h1 ^= _rotl(k1 * c1 & MASK_64, 31) * c2 & MASK_64
+        h1 = (_rotl(h1, 27) + h2) * 5 + 0x52dce729 & MASK_64
+        h2 ^= _rotl(k2 * c2 & MASK_64, 33) * c1 & MASK_64
+        h2 = (_rotl(h2, 31) + h1) * 5 + 0x38495ab5 & MASK_64
+    tail = data[16 * blocks:]
+    if len(tail) > 8:
+        h2 ^= _rotl(int.from_bytes(tail[8:], "little") * c2 & MASK_64, 33) * c1 & MASK_64
+    if tail:
+        h1 ^= _rotl(int.from_bytes(tail[:8], "little") * c1 & MASK_64, 31) * c2 & MASK_64
+    h1 ^= len(data)
+    h2 ^= len(data)
+    h1 = h1 + h2 & MASK_64
+    h2 = h2 + h1 & MASK_64
+    h1 = _fmix(h1)
+    h2 = _fmix(h2)
+    return h1 + h2 & MASK_64
+
+
+def _read_file_node(path):
+    with open(path, 'rb') as f:
+        return file_node(f.read())
+
+
+def folder_nodes(folder_path, max_workers=None):
+    # (multihash, cumulative size) of the folder and {relative path: (multihash, cumulative size)}
+    # of every visible file in it, the files are hashed in parallel
+    files = []
+    for root, dirs, names in os.walk(folder_path):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        files.extend(os.path.join(root, name) for name in names if not name.startswith("."))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        nodes = dict(zip((os.path.relpath(path, folder_path).replace(os.sep, "/") for path in files), executor.map(_read_file_node, files)))
+    return tree_node(nodes), nodes
+
+
+def tree_node(nodes):
+    # (multihash, cumulative size) of the folder holding the files at the given relative paths
+    children = {}
+    entries = []
+    for relative_path, (multihash, size) in nodes.items():
+        name, _, rest = relative_path.partition("/")
+        if rest:
+            children.setdefault(name, {})[rest] = (multihash, size)
+        else:
+            entries.append((name, multihash, size))
+    for name, child_nodes in children.items():
+        entries.append((name,) + tree_node(child_nodes))
+    return directory_node(entries)
@@ -0,0 +1,145 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+
+MANIFEST_VERSION = 1
+
+
+class Manifest:
+    # a snapshot of every token plus an append-only journal of the entries recorded since,
+    # so recording stays cheap and a crash loses at most the entries that were not flushed yet
+    def __init__(self, path, load=True):
+        self.path = Path(path)
+        self.journal_path = self.path.with_name(self.path.name + ".journal")
+        self.tokens = {} if load else None
+        self._pending = []
+        # entries are recorded from the render pool's callback thread while the main thread flushes
+        self._lock = threading.Lock()
+        if not load:
+            return
+        if self.path.is_file():
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.tokens = data["tokens"]
+        if self.journal_path.is_file():
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        index, entry = json.loads(line)
+                    except ValueError:
+                        # the last line may have been cut short by a crash
+                        break
+                    self.tokens[index] = entry
+
+    def record(self, index, input_hash, output_hash, cids=None):
+        # cids: [CID, cumulative size] of every output file, in output folder order
+        entry = {"inputs": input_hash, "output": output_hash}
+        if cids is not None:
+            entry["cids"] = cids
+        with self._lock:
+            if self.tokens is not None:
+                self.tokens[str(index)] = entry
+            self._pending.append((str(index), entry))
+
+    def forget(self, index):
+        self.tokens.pop(str(index), None)
+
+    def stale_tokens(self, indices, input_hashes, output_paths, hash_outputs=None):
+        # tokens whose inputs changed, or whose outputs are missing or no longer match what was written,
+        # output_paths holds the paths of every file a token is written to. Outputs kept elsewhere
+        # pass their locations instead, None for a token with a missing output, and the function
+        # that hashes them
+        candidates = []
+        stale = []
+        for index, input_hash, paths in zip(indices, input_hashes, output_paths):
+            entry = self.tokens.get(str(index))
+            if entry is None or entry["inputs"] != input_hash or paths is None or (hash_outputs is None and not all(os.path.isfile(path) for path in paths)):
+                stale.append(index)
+            else:
+                candidates.append((index, paths))
+
+        with ThreadPoolExecutor() as executor:
+            output_hashes = executor.map(hash_outputs or hash_files, [paths for _, paths in candidates])
+            for (index, _), output_hash in zip(candidates, output_hashes):
+                if output_hash != self.tokens[str(index)]["output"]:
+                    stale.append(index)
+        return sorted(stale)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.journal_path, 'a') as f:
+                f.write("".join(json.dumps(item) + "\n" for item in pending))
+
+    def save(self):
+        # fold the journal into a new snapshot, written to a temporary file first so a crash
+        # never leaves a truncated manifest behind. Tokens are kept in index order, so the
+        # snapshot does not depend on the order they were rendered in
+        with self._lock:
+            self._pending = []
+            self.tokens = dict(sorted(self.tokens.items(), key=lambda item: int(item[0])))
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp_path, 'w') as f:
+                json.dump({"version": MANIFEST_VERSION, "tokens": self.tokens}, f)
+            os.replace(tmp_path, self.path)
+            if self.journal_path.is_file():
+                os.remove(self.journal_path)
+
+    def reset(self):
+        with self._lock:
+            self._pending = []
+            for path in (self.path, self.journal_path):
+                if path.is_file():
+                    os.remove(path)
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def combine_hashes(hashes):
+    # a single output keeps its own hash, so manifests of single size collections stay valid
+    return hashes[0] if len(hashes) == 1 else hash_bytes("\n".join(hashes).encode())
+
+
+def hash_files(paths):
+    return combine_hashes([hash_file(path) for path in paths])
+
+
+class InputHasher:
+    # a token's inputs are its trait values, the content of the asset files they point at
+    # and any render settings that change the encoded output
+    def __init__(self, config, settings=""):
+        constraints = config.constraints
+        self.layer_parts = []
+        for layer_index, trait_name in enumerate(constraints.layer_names):
+            trait_folder = config.get_assets_path() / trait_name
+            parts = []
+            for trait_value in constraints.vocabularies[layer_index]:
+                asset_path = trait_folder / (trait_value + "." + config.get_filetype())
+                asset_hash = hash_file(asset_path) if trait_value != "None" and asset_path.is_file() else ""
+                parts.append("{}={}:{}".format(trait_name, trait_value, asset_hash))
+            self.layer_parts.append(parts)
+        self.prefix = "{}\n{}\n".format(config.get_filetype(), settings)
+
+    def __call__(self, codes):
+        return [
+            hash_bytes((self.prefix + "\n".join(self.layer_parts[layer_index][code] for layer_index, code in enumerate(row))).encode())
+            for row in codes.tolist()
+        ]
@@ -0,0 +1,142 @@
+import json
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from factory.profiling import profiler
+
+# on-disk formats kept beside metadata.csv, both store one integer code per trait
+METADATA_STORE_NPZ = "npz"
+METADATA_STORE_PARQUET = "parquet"
+# the CSV is parsed in chunks of this many rows so only one chunk is ever held as strings
+CSV_CHUNK_ROWS = 1 << 16
+
+
+def categorical_frame(constraints, codes):
+    # one categorical column per layer whose categories are the layer's trait vocabulary,
+    # so a column costs one small integer per token instead of a Python string
+    return pd.DataFrame({
+        name: pd.Categorical.from_codes(codes[:, layer_index], categories=constraints.vocabularies[layer_index])
+        for layer_index, name in enumerate(constraints.layer_names)
+    })
+
+
+def blank_none(column):
+    # "None" is written as an empty cell
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        if "None" in column.cat.categories and "" not in column.cat.categories:
+            return column.cat.rename_categories({"None": ""})
+        column = column.astype(object)
+    return column.replace("None", "")
+
+
+def store_path(metadata_path, store):
+    return Path(metadata_path).with_suffix("." + store)
+
+
+def csv_fingerprint(metadata_path):
+    # size and modification time of a CSV. A store keeps the one of the CSV it was written with and
+    # is only used while they match, whatever the two files' own times say after a copy
+    stat = os.stat(metadata_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def write_store(metadata, constraints, path, store, metadata_path):
+    # metadata_path: the CSV just written with the same rows
+    codes = constraints.encode_metadata(metadata)
+    path = Path(path)
+    fingerprint = csv_fingerprint(metadata_path)
+    if store == METADATA_STORE_NPZ:
+        dtype = np.int16 if max(len(vocabulary) for vocabulary in constraints.vocabularies) < (1 << 15) else np.int32
+        with open(path, 'wb') as f:
+            np.savez(f, codes=codes.astype(dtype), layers=json.dumps(constraints.layer_names), vocabularies=json.dumps(constraints.vocabularies), csv=json.dumps(fingerprint))
+    elif store == METADATA_STORE_PARQUET:
+        frame = categorical_frame(constraints, codes)
+        frame.attrs["csv"] = fingerprint
+        try:
+            frame.to_parquet(path, index=False)
+        except ImportError:
+            raise RuntimeError("the parquet metadata store needs pyarrow or fastparquet installed")
+    else:
+        raise ValueError("invalid metadata store: {}".format(store))
+
+
+def read_store(path, store):
+    # the stored rows, with the fingerprint of the CSV they were written with in attrs["csv"]
+    if store == METADATA_STORE_NPZ:
+        with np.load(path, allow_pickle=False) as data:
+            layer_names = json.loads(str(data["layers"]))
+            vocabularies = json.loads(str(data["vocabularies"]))
+            fingerprint = json.loads(str(data["csv"])) if "csv" in data else None
+            codes = data["codes"]
+        metadata = pd.DataFrame({
+            name: pd.Categorical.from_codes(codes[:, layer_index], categories=vocabularies[layer_index])
+            for layer_index, name in enumerate(layer_names)
+        })
+        metadata.attrs["csv"] = fingerprint
+        return metadata
+    if store == METADATA_STORE_PARQUET:
+        return pd.read_parquet(path)
+    raise ValueError("invalid metadata store: {}".format(store))
+
+
+def read_metadata(metadata_path, config):
+    # the store is used while it was written with the CSV as it is now, an edited CSV always wins
+    store = config.get_metadata_store()
+    path = store_path(metadata_path, store) if store else None
+    with profiler.stage("metadata_read"):
+        metadata = None
+        if path is not None and path.is_file():
+            metadata = read_store(path, store)
+            if metadata.attrs.get("csv") != csv_fingerprint(metadata_path):
+                metadata = None
+        if metadata is None:
+            metadata = read_csv(metadata_path)
+    with profiler.stage("metadata_validate", items=len(metadata)):
+        return validate_metadata(metadata, config)
+
+
+def read_csv(metadata_path):
+    chunks = list(pd.read_csv(metadata_path, keep_default_na=False, dtype="category", usecols=lambda column: column != "filename", chunksize=CSV_CHUNK_ROWS))
+    if len(chunks) == 1:
+        return chunks[0]
+    return pd.DataFrame({column: union_categoricals([chunk[column] for chunk in chunks]) for column in chunks[0]})
+
+
+def validate_metadata(metadata, config):
+    # checks the distinct values of every column against the traits on disk, found once per
+    # layer by the config, reports every unknown value at once, recodes the columns to the
+    # layer vocabularies and drops tokens without any trait
+    constraints = config.constraints
+    columns = {}
+    keep = np.zeros(len(metadata), dtype=bool)
+    missing = []
+    for trait_name in metadata:
+        layer_index = constraints.layer_index[config.get_directory_name(trait_name)]
+        column = metadata[trait_name]
+        if not isinstance(column.dtype, pd.CategoricalDtype):
+            column = column.astype("category")
+        categories = column.cat.categories.astype(str)
+        codes = column.cat.codes.to_numpy()
+        used = np.bincount(codes[codes >= 0], minlength=len(categories)) > 0
+
+        live_traits = set(config.get_live_traits(trait_name))
+        unknown = [value for value, is_used in zip(categories, used) if is_used and value not in ("", "None") and value not in live_traits]
+        if unknown:
+            missing.append("(trait: {}) values: {}".format(trait_name, ", ".join(unknown)))
+            continue
+
+        code_map = constraints.code_maps[layer_index]
+        # blank cells and missing values (code -1, the last entry) both mean no trait for this layer
+        recode = np.array([code_map.get("None" if value == "" else value, -1) for value in categories] + [code_map["None"]], dtype=np.int64)
+        columns[trait_name] = recode.astype(np.int16 if len(code_map) < (1 << 15) else np.int32)[codes]
+        keep |= columns[trait_name] != code_map["None"]
+    if missing:
+        raise RuntimeError("unable to locate traits {}".format("; ".join(missing)))
+
+    return pd.DataFrame({
+        trait_name: pd.Categorical.from_codes(column[keep], categories=constraints.vocabularies[constraints.layer_index[trait_name]])
+        for trait_name, column in columns.items()
+    })
@@ -1,34 +1,80 @@
+import json
 import os
-from pinatapy import PinataPy
 
 import requests
 
+import factory.ipfs as ipfs
+from factory.upload import MultipartStream, post_with_retries, folder_files
+
 API_ENDPOINT: str = "https://api.pinata.cloud/"
 
 class PinataClient:
-    def __init__(self):
+    def __init__(self, endpoint=None, retries=5, backoff=1.0, max_connections=4, timeout=(30, 600)):
         self._auth_headers = {
             "pinata_api_key": os.getenv("PINATA_API_KEY"),
             "pinata_secret_api_key": os.getenv("PINATA_API_SECRET"),
         }
         self.jwt = os.getenv("PINATA_JWT")
+        # the endpoint can point at a local stand-in server
+        self.endpoint = endpoint or os.getenv("PINATA_API_ENDPOINT") or API_ENDPOINT
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # one pooled session, connections are reused across uploads and threads
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _headers(self):
+        if self._auth_headers["pinata_api_key"] is None and self.jwt is not None:
+            return {"Authorization": "Bearer " + self.jwt}
+        return {k: v for k, v in self._auth_headers.items() if v is not None}
+
+    def upload_folder(self, folder_path, upload_name, options=None, checkpoint=None, local_cid=None):
+        # pins the folder as one IPFS directory called upload_name, the files are streamed from
+        # disk so only one of them is open at a time. The CID is computed locally first unless the
+        # caller already knows it, a folder whose CID was pinned before according to the checkpoint
+        # is not sent again
+        if os.path.isdir(folder_path):
+            files = [(upload_name + "/" + relative_path, path) for relative_path, path in folder_files(folder_path)]
+            if local_cid is None:
+                local_cid = ipfs.to_cid(ipfs.folder_nodes(folder_path)[0][0])
+        else:
+            files = [(os.path.basename(folder_path), folder_path)]
+            if local_cid is None:
+                with open(folder_path, 'rb') as f:
+                    local_cid = ipfs.file_cid(f.read())
+        if not files:
+            raise RuntimeError("nothing to upload in {}".format(folder_path))
+        return self.upload_files(files, local_cid, os.path.abspath(folder_path), options, checkpoint)
+
+    def upload_files(self, files, local_cid, key, options=None, checkpoint=None):
+        # files: (upload name, local path or (archive path, offset, size)) pairs whose IPFS CID
+        # is local_cid, key names the upload in the checkpoint
+        if not files:
+            raise RuntimeError("nothing to upload for {}".format(key))
+        if checkpoint is not None:
+            result = checkpoint.get(key, local_cid)
+            if result is not None:
+                return result
+
+        # pinataMetadata and pinataOptions are sent as JSON form fields
+        fields = {name: json.dumps(value) for name, value in (options or {}).items()}
+
+        def make_body():
+            body = MultipartStream(files, fields)
+            return body, {"Content-Type": body.content_type}
+
+        response = post_with_retries(self.session, self.endpoint + "pinning/pinFileToIPFS", make_body, self._headers(), self.retries, self.backoff, self.timeout)
+        if not response.ok:
+            self._error(response)
+        result = response.json()
+        if result.get("IpfsHash") != local_cid:
+            print("pinned CID {} of {} differs from the locally computed {}".format(result.get("IpfsHash"), key, local_cid))
+        if checkpoint is not None:
+            checkpoint.record(key, local_cid, result)
+        return result
 
-    def upload_folder(self, folder_path, upload_name, options=None):
-        url = API_ENDPOINT + "pinning/pinFileToIPFS"
-        headers = {k: self._auth_headers[k] for k in ["pinata_api_key", "pinata_secret_api_key"]}
-
-        def get_all_files(directory):
-            paths= []
-            for root, _, files_ in os.walk(os.path.abspath(directory)):
-                for file in files_:
-                    paths.append(os.path.join(root, file))
-            return paths
-    
-        files = [("file",(file[file.index("images/"):].replace("images/", upload_name + "/"), open(file, "rb"))) for file in get_all_files(folder_path)] if os.path.isdir(folder_path) else [     ("file", open(folder_path, "rb"))]
-
-        # if options != None:
-        #     if "pinataMetadata" in options:
-        #         headers["pinataMetadata"] = options["pinataMetadata"]
-        
-        response = requests.post(url=url, files=files, headers=headers)
-        return response.json() if response.ok else self._error(response)
+    def _error(self, response):
+        raise RuntimeError("pinata request failed with status {}: {}".format(response.status_code, response.text[:500]))
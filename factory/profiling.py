@@ -0,0 +1,59 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import json
+import os
+from pathlib import Path
+import platform
+import time
+
+REPORT_VERSION = 1
+
+
+class Profiler:
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name, items=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, items)
+
+    def add(self, name, seconds, items=0, calls=1):
+        stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "items": 0})
+        stage["seconds"] += seconds
+        stage["calls"] += calls
+        stage["items"] += items
+
+    def count(self, name, items):
+        self.add(name, 0.0, items, calls=0)
+
+    def merge(self, stages):
+        for name, stage in stages.items():
+            self.add(name, stage["seconds"], stage["items"], stage["calls"])
+
+    def collect(self):
+        # hands the measurements over and starts from zero, used to ship worker timings back to the parent
+        stages, self.stages = self.stages, {}
+        return stages
+
+    def write_report(self, path, **extra):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        report = {
+            "version": REPORT_VERSION,
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "stages": {name: dict(stage) for name, stage in sorted(self.stages.items())},
+        }
+        report.update(extra)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        return report
+
+
+# process-wide profiler, every stage of the factory records into it
+profiler = Profiler()
@@ -0,0 +1,103 @@
+import json
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+PLAN_FILE_NAME = ".renumber_plan.json"
+TEMP_PREFIX = ".renumber-"
+
+# plan phases, in the order they run
+PHASE_STAGE = "stage"
+PHASE_COMMIT = "commit"
+PHASE_METADATA = "metadata"
+
+
+class Renumbering:
+    # closes the gaps left by pruned images: the remaining images keep their order and are
+    # renamed to 0..n-1, and their metadata rows are moved along with them.
+    # Every move first goes to a temporary name and only then to its final one, so no file is
+    # ever overwritten. The plan is written to disk before anything moves, and an interrupted
+    # run picks it up again instead of listing the half renamed folder.
+    def __init__(self, images_path, metadata_path, suffix=".png"):
+        self.images_path = Path(images_path)
+        self.metadata_path = Path(metadata_path)
+        self.suffix = suffix
+        self.plan_path = self.images_path / PLAN_FILE_NAME
+        self.metadata_tmp_path = self.metadata_path.with_name(self.metadata_path.name + ".renumber")
+
+    def run(self):
+        plan = self._load_plan()
+        if plan is None:
+            plan = self._new_plan()
+            self._save_plan(plan)
+        old = np.array(plan["old"], dtype=np.int64)
+
+        if plan["phase"] == PHASE_STAGE:
+            for old_index, new_index in self._moves(old):
+                # a file already staged by an earlier run is gone from its old name
+                if os.path.exists(self._path(old_index)):
+                    os.rename(self._path(old_index), self._temp_path(new_index))
+            plan["phase"] = PHASE_COMMIT
+            self._save_plan(plan)
+
+        if plan["phase"] == PHASE_COMMIT:
+            for _, new_index in self._moves(old):
+                if os.path.exists(self._temp_path(new_index)):
+                    os.rename(self._temp_path(new_index), self._path(new_index))
+            # the metadata file is still the original one until the next phase replaces it
+            self._reindex_metadata(old).to_csv(self.metadata_tmp_path, index=False)
+            plan["phase"] = PHASE_METADATA
+            self._save_plan(plan)
+
+        if self.metadata_tmp_path.is_file():
+            os.replace(self.metadata_tmp_path, self.metadata_path)
+        os.remove(self.plan_path)
+        return len(old)
+
+    def _new_plan(self):
+        indices = []
+        for entry in os.scandir(self.images_path):
+            # without a plan nothing tells what a file under a temporary name is, staging would replace it
+            if entry.name.startswith(TEMP_PREFIX):
+                raise RuntimeError("{} is in the way of the renumbering, move it out of {}".format(entry.name, self.images_path))
+            stem = entry.name[:-len(self.suffix)] if entry.name.endswith(self.suffix) else ""
+            if entry.is_file() and stem.isdigit():
+                indices.append(int(stem))
+        indices.sort()
+        # checked before anything moves, an image without a metadata row cannot be renumbered
+        rows = len(pd.read_csv(self.metadata_path, usecols=[0]))
+        if indices and indices[-1] >= rows:
+            raise RuntimeError("image {}{} has no row in {}".format(indices[-1], self.suffix, self.metadata_path))
+        # old index of every remaining image, its position in this list is its new index
+        return {"phase": PHASE_STAGE, "old": indices}
+
+    def _reindex_metadata(self, old):
+        metadata = pd.read_csv(self.metadata_path, keep_default_na=False, dtype=str)
+        renumbered = metadata.iloc[old].reset_index(drop=True)
+        renumbered["filename"] = [str(index) + self.suffix for index in range(len(renumbered))]
+        return renumbered[["filename"] + [column for column in renumbered.columns if column != "filename"]]
+
+    def _moves(self, old):
+        # images that already carry their new index stay where they are
+        new = np.arange(len(old))
+        moved = old != new
+        return zip(old[moved].tolist(), new[moved].tolist())
+
+    def _path(self, index):
+        return self.images_path / (str(index) + self.suffix)
+
+    def _temp_path(self, index):
+        return self.images_path / (TEMP_PREFIX + str(index) + self.suffix)
+
+    def _load_plan(self):
+        if not self.plan_path.is_file():
+            return None
+        with open(self.plan_path, 'r') as f:
+            return json.load(f)
+
+    def _save_plan(self, plan):
+        tmp_path = self.plan_path.with_name(self.plan_path.name + ".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(plan, f)
+        os.replace(tmp_path, self.plan_path)
@@ -0,0 +1,144 @@
+import numpy as np
+
+from factory.combinatorics import FeasibleSpace
+from factory.profiling import profiler
+
+# rows drawn at once. The draws depend on it, so every mode samples with the same size to give a
+# seed the same collection
+BATCH_SIZE = 65536
+# draw a little more than is still missing so a batch usually covers duplicates and rejected rows
+OVERDRAW_FACTOR = 1.25
+# above this share of the feasible space, rejecting duplicates gets slow and the space is sampled directly
+EXHAUSTIVE_FRACTION = 0.5
+# the feasible space is only counted when count is above this share of its cheap upper bound
+COUNT_FRACTION = 0.1
+# trait sets drawn in a row without a new one before rejection sampling gives up
+MAX_STALLED_DRAWS = 1 << 20
+
+
+class BatchSampler:
+    def __init__(self, config, seed=None):
+        self.config = config
+        self.constraints = config.constraints
+        self.rng = np.random.default_rng(seed)
+        self.layer_names = self.constraints.layer_names
+        self.vocabularies = [np.array(vocabulary, dtype=object) for vocabulary in self.constraints.vocabularies]
+        self._radix = [len(vocabulary) for vocabulary in self.vocabularies]
+        space = 1
+        for size in self._radix:
+            space *= size
+        # keys of trait sets beyond int64 are kept as Python ints
+        self._key_dtype = np.int64 if space < np.iinfo(np.int64).max else object
+        self._space = None
+
+    @property
+    def space(self):
+        if self._space is None:
+            self._space = FeasibleSpace(self.constraints)
+        return self._space
+
+    def _draw_layer(self, layer_index, codes):
+        n = len(codes)
+        weights = self.constraints.weights[layer_index]
+        if not self.constraints.constrained[layer_index]:
+            return self.rng.choice(len(weights), size=n, p=weights / weights.sum()), np.ones(n, dtype=bool)
+
+        with profiler.stage("rule_evaluation", items=n):
+            candidates = self.constraints.candidate_weights(layer_index, codes)
+        cumulative = np.cumsum(candidates, axis=1)
+        totals = cumulative[:, -1]
+        draws = (cumulative <= (self.rng.random(n) * totals)[:, None]).sum(axis=1)
+        # guard against rounding past the last trait with a non-zero weight
+        last_valid = len(weights) - 1 - np.argmax(candidates[:, ::-1] > 0, axis=1)
+        return np.minimum(draws, last_valid), totals > 0
+
+    def draw(self, n):
+        with profiler.stage("sampling", items=n):
+            return self._draw(n)
+
+    def _draw(self, n):
+        codes = np.full((n, len(self.layer_names)), -1, dtype=np.int64)
+        valid = np.ones(n, dtype=bool)
+        for layer_index in range(len(self.layer_names)):
+            draws, drawable = self._draw_layer(layer_index, codes)
+            codes[:, layer_index] = draws
+            valid &= drawable
+            self.constraints.apply_equals_updates(layer_index, codes)
+        return codes[valid]
+
+    def keys(self, codes):
+        keys = np.zeros(len(codes), dtype=self._key_dtype)
+        for layer_index, size in enumerate(self._radix):
+            keys = keys * size + codes[:, layer_index].astype(self._key_dtype)
+        return keys
+
+    def iter_batches(self, count):
+        # yields unique trait sets in draw order, a batch at a time
+        if count > self.space.bound:
+            raise ValueError("cannot generate {} unique trait sets, the layers and rules allow at most {} combinations".format(count, self.space.bound))
+        size = None
+        if count / self.space.bound > COUNT_FRACTION:
+            with profiler.stage("feasible_space"):
+                size = self.space.count()
+        if size is not None and count > size:
+            raise ValueError("cannot generate {} unique trait sets, the layers and rules only allow {} combinations".format(count, size))
+        if size is not None and count / size > EXHAUSTIVE_FRACTION:
+            with profiler.stage("exhaustive_sampling", items=count):
+                codes = self.space.sample(count, self.rng)
+            if codes is not None:
+                for start in range(0, len(codes), BATCH_SIZE):
+                    yield codes[start:start + BATCH_SIZE]
+                return
+
+        # keys of every accepted trait set, kept sorted for binary search membership checks
+        seen = np.empty(0, dtype=self._key_dtype)
+        remaining = count
+        stalled = 0
+        while remaining > 0:
+            # draw more at once while nothing new turns up, so a nearly exhausted space is not drawn a few rows at a time
+            n = min(BATCH_SIZE, max(int(remaining * OVERDRAW_FACTOR) + 16, stalled))
+            codes = self.draw(n)
+            profiler.count("dedup_candidates", len(codes))
+            keys = self.keys(codes)
+            # keep the first occurrence of every new combination, in draw order
+            _, first = np.unique(keys, return_index=True)
+            first.sort()
+            positions = np.searchsorted(seen, keys[first])
+            known = np.zeros(len(first), dtype=bool)
+            in_range = positions < len(seen)
+            known[in_range] = seen[positions[in_range]] == keys[first][in_range]
+            first = first[~known][:remaining]
+            profiler.count("dedup_rejected", len(codes) - len(first))
+            if len(first) == 0:
+                stalled += n
+                # a draw without anything new is the first sign of an exhausted space, the count
+                # skipped above tells for sure unless the space is too large to count
+                with profiler.stage("feasible_space"):
+                    size = self.space.count()
+                if size is not None and count > size:
+                    raise ValueError("cannot generate {} unique trait sets, the layers and rules only allow {} combinations".format(count, size))
+                if stalled > MAX_STALLED_DRAWS:
+                    reason = "the feasible space is too large to count and is probably exhausted" if size is None else "the combinations left are too unlikely to draw"
+                    raise ValueError("only found {} of {} unique trait sets, {} draws in a row gave no new one: {}".format(count - remaining, count, stalled, reason))
+                continue
+            stalled = 0
+            new_keys = np.sort(keys[first])
+            seen = np.insert(seen, np.searchsorted(seen, new_keys), new_keys)
+            remaining -= len(first)
+            yield codes[first]
+
+    def sample(self, count, progress=None):
+        batches = []
+        for codes in self.iter_batches(count):
+            batches.append(codes)
+            if progress is not None:
+                progress(len(codes))
+        if not batches:
+            return np.empty((0, len(self.layer_names)), dtype=np.int64)
+        return np.concatenate(batches)
+
+    def decode(self, codes):
+        # pandas is only loaded once trait sets are turned into metadata
+        from factory.metadata import categorical_frame
+
+        return categorical_frame(self.constraints, codes)
@@ -0,0 +1,146 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import multiprocessing as mp
+from pathlib import Path
+import re
+import threading
+from urllib.parse import parse_qs, urlparse
+
+import factory.constants as constants
+from factory.assets import AssetAtlas
+from factory.cache import LRUCache
+from factory.encoder import Encoder, RESAMPLE_FILTERS
+from factory.factory import init_render_worker, render_token
+from factory.profiling import profiler
+
+# widths above this are refused, a single request should not be able to allocate gigabytes
+SERVER_MAX_SIZE = 4096
+# seconds a request waits for its render before it fails
+SERVER_RENDER_TIMEOUT = 60
+TOKEN_PATH = re.compile(r"^/tokens/(\d+)\.(\w+)$")
+CONTENT_TYPES = {"png": "image/png", "jpeg": "image/jpeg"}
+
+
+class RenderService:
+    # renders tokens on request instead of ahead of time. Only the layer codes of the collection
+    # are held here, the workers keep their own prefix composite cache and the encoded images
+    # are kept in an LRU cache shared by all requests
+    def __init__(self, config, codes, processes=None, cache_bytes=256 * 1024 * 1024):
+        self.config = config
+        self.codes = codes
+        self.encoder = Encoder.from_config(config)
+        self.sizes = {size[constants.RENDER_SIZE_KEY]: size.get(constants.RENDER_RESAMPLE_KEY, constants.RENDER_DEFAULT_RESAMPLE) for size in config.get_render_option(constants.RENDER_SIZES_KEY)}
+        collection_path = Path(constants.OUTPUT_DIR_NAME) / config.get_collection_name()
+        atlas = AssetAtlas.build(config, collection_path / constants.CACHE_DIR_NAME / constants.ATLAS_FILE_NAME)
+        atlas.check(config.constraints, codes)
+        composite_bytes = int(config.get_render_option(constants.RENDER_CACHE_SIZE_KEY) * 1024 * 1024)
+        self.pool = mp.Pool(processes, initializer=init_render_worker, initargs=(atlas, [], self.encoder, composite_bytes))
+        self.cache = LRUCache(cache_bytes)
+        # renders under way by cache key, concurrent requests for the same image wait on the first one
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def render(self, index, width=None, resample=None):
+        # the encoded image of a token, at its native size when width is None. A configured size
+        # uses its configured filter unless another one is asked for
+        if resample is None:
+            resample = self.sizes.get(width, constants.RENDER_DEFAULT_RESAMPLE)
+        # raises multiprocessing.TimeoutError when the render takes longer than SERVER_RENDER_TIMEOUT
+        key = (index, width, resample)
+        with self._lock:
+            data = self.cache.get(key)
+            if data is not None:
+                return data
+            pending = self._in_flight.get(key)
+            first = pending is None
+            if first:
+                pending = self._in_flight[key] = self.pool.apply_async(render_token, ((self.codes[index].tolist(), width, resample),))
+        try:
+            with profiler.stage("serve_render", items=1):
+                data = pending.get(SERVER_RENDER_TIMEOUT)
+            if first:
+                with self._lock:
+                    self.cache.put(key, data)
+        finally:
+            with self._lock:
+                if self._in_flight.get(key) is pending:
+                    del self._in_flight[key]
+        return data
+
+    def traits(self, index):
+        constraints = self.config.constraints
+        return {name: constraints.vocabularies[layer_index][code] for layer_index, (name, code) in enumerate(zip(constraints.layer_names, self.codes[index].tolist()))}
+
+    def status(self):
+        with self._lock:
+            return {
+                "collection": self.config.get_collection_name(),
+                "count": len(self.codes),
+                "filetype": self.encoder.filetype,
+                "sizes": sorted(self.sizes),
+                "cache": {"entries": len(self.cache), "bytes": self.cache.current_bytes, "hit_rate": self.cache.hit_rate()},
+            }
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    # GET /                         collection status as JSON
+    # GET /tokens/<n>.json          the token's traits
+    # GET /tokens/<n>.<filetype>    the token's image, ?size=<width>&resample=<filter> to scale it
+    service = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/":
+            return self._send(200, "application/json", json.dumps(self.service.status()).encode())
+        match = TOKEN_PATH.match(url.path)
+        if match is None:
+            return self._error(404, "not found")
+        index, extension = int(match.group(1)), match.group(2)
+        if index >= len(self.service.codes):
+            return self._error(404, "no token {}, the collection has {}".format(index, len(self.service.codes)))
+        if extension == "json":
+            return self._send(200, "application/json", json.dumps(self.service.traits(index)).encode())
+        if extension != self.service.encoder.filetype:
+            return self._error(404, "tokens are rendered as {}".format(self.service.encoder.filetype))
+
+        query = parse_qs(url.query)
+        width = query.get("size", [None])[0]
+        resample = query.get("resample", [None])[0]
+        if width is not None and (not width.isdigit() or not 0 < int(width) <= SERVER_MAX_SIZE):
+            return self._error(400, "size must be a width between 1 and {}".format(SERVER_MAX_SIZE))
+        if resample is not None and resample not in RESAMPLE_FILTERS:
+            return self._error(400, "resample must be one of {}".format(", ".join(RESAMPLE_FILTERS)))
+        try:
+            data = self.service.render(index, int(width) if width is not None else None, resample)
+        except mp.TimeoutError:
+            return self._error(504, "rendering token {} timed out".format(index))
+        except Exception as error:
+            # the details go to the server log, the client only learns that the render failed
+            self.log_error("rendering token %d failed: %r", index, error)
+            return self._error(500, "rendering token {} failed".format(index))
+        self._send(200, CONTENT_TYPES[extension], data)
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message):
+        self._send(status, "application/json", json.dumps({"error": message}).encode())
+
+
+def serve(service, host="127.0.0.1", port=8000):
+    handler = type("Handler", (RenderRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,51 @@
+import re
+from pathlib import Path
+
+import factory.constants as constants
+
+SHARD_DIR_PATTERN = re.compile(r"^shard_(\d+)_of_(\d+)$")
+
+
+def parse_shard(value):
+    # "i/N" with 0 <= i < N, as given on the command line
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", value)
+    if match is None:
+        raise ValueError("invalid shard: {}, expected i/N".format(value))
+    shard, shards = int(match.group(1)), int(match.group(2))
+    if shards < 1 or shard >= shards:
+        raise ValueError("invalid shard: {}, i must be between 0 and N - 1".format(value))
+    return shard, shards
+
+
+def shard_range(count, shard):
+    # the contiguous [start, stop) token range of a shard, None stands for the whole collection.
+    # Every node computes the same ranges from the count alone, so they cover every token once
+    if shard is None:
+        return 0, count
+    index, shards = shard
+    return count * index // shards, count * (index + 1) // shards
+
+
+def shard_dir(collection_path, shard):
+    return Path(collection_path) / constants.SHARDS_DIR_NAME / "shard_{}_of_{}".format(*shard)
+
+
+def find_shards(collection_path):
+    # the shard folders copied into the collection, in shard order, all of one N and none missing
+    shards_path = Path(collection_path) / constants.SHARDS_DIR_NAME
+    found = {}
+    if shards_path.is_dir():
+        for entry in shards_path.iterdir():
+            match = SHARD_DIR_PATTERN.match(entry.name)
+            if match is not None and entry.is_dir():
+                found[int(match.group(1)), int(match.group(2))] = entry
+    if not found:
+        raise RuntimeError("no shards found in {}".format(shards_path))
+    counts = {shards for _, shards in found}
+    if len(counts) > 1:
+        raise RuntimeError("shards of different runs found in {}: {}".format(shards_path, ", ".join(sorted("of {}".format(n) for n in counts))))
+    shards = counts.pop()
+    missing = [str(index) for index in range(shards) if (index, shards) not in found]
+    if missing:
+        raise RuntimeError("missing shards {} of {} in {}".format(", ".join(missing), shards, shards_path))
+    return [found[index, shards] for index in range(shards)]
@@ -0,0 +1,88 @@
+import json
+import multiprocessing as mp
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from factory.profiling import profiler
+
+STATS_VERSION = 1
+TRAITS_FILE_NAME = "stats.json"
+RARITY_FILE_NAME = "rarity.csv"
+
+
+class CollectionStats:
+    def __init__(self, metadata, layer_names):
+        # one vectorized pass per layer column: factorize the values, count them, and add the
+        # inverse frequency of every token's value to its rarity score
+        self.layer_names = list(layer_names)
+        self.count = len(metadata)
+        self.traits = {}
+        self.scores = np.zeros(self.count)
+        for layer_name in self.layer_names:
+            column = metadata[layer_name]
+            if isinstance(column.dtype, pd.CategoricalDtype) and (column.cat.codes >= 0).all():
+                # categorical columns are already coded, only the values that occur are kept
+                codes = column.cat.codes.to_numpy()
+                counts = np.bincount(codes, minlength=len(column.cat.categories))
+                present = np.flatnonzero(counts)
+                codes = np.searchsorted(present, codes)
+                values, counts = column.cat.categories.to_numpy()[present], counts[present]
+            else:
+                codes, values = pd.factorize(column.astype(str).to_numpy())
+                counts = np.bincount(codes, minlength=len(values))
+            self.traits[layer_name] = (values, counts)
+            if self.count:
+                self.scores += self.count / counts[codes]
+        # rank 1 is the rarest token, tokens with equal scores share a rank
+        self.ranks = pd.Series(self.scores).rank(method="min", ascending=False).to_numpy(dtype=np.int64) if self.count else np.zeros(0, dtype=np.int64)
+
+    def frequencies(self, layer_name):
+        # (value, count) pairs of a layer, most common first
+        values, counts = self.traits[layer_name]
+        order = np.argsort(-counts, kind="stable")
+        return [(values[index], int(counts[index])) for index in order]
+
+    def report(self):
+        return {
+            "version": STATS_VERSION,
+            "count": self.count,
+            "layers": {
+                layer_name: [{"value": value, "count": count, "frequency": count / self.count} for value, count in self.frequencies(layer_name)]
+                for layer_name in self.layer_names
+            },
+        }
+
+    def write(self, stats_path, filenames):
+        stats_path = Path(stats_path)
+        stats_path.mkdir(parents=True, exist_ok=True)
+        with open(stats_path / TRAITS_FILE_NAME, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        pd.DataFrame({"filename": filenames, "rarity_score": self.scores, "rank": self.ranks}).to_csv(stats_path / RARITY_FILE_NAME, index=False)
+
+    def plot(self, stats_path, processes=None):
+        # one chart per layer, each on its own figure, drawn in parallel
+        charts = [(layer_name, self.frequencies(layer_name), str(Path(stats_path) / (layer_name + ".png"))) for layer_name in self.layer_names]
+        with profiler.stage("stats_plot", items=len(charts)):
+            if processes == 1 or len(charts) < 2:
+                for chart in charts:
+                    plot_chart(chart)
+            else:
+                with mp.Pool(processes=min(processes or mp.cpu_count(), len(charts))) as pool:
+                    pool.map(plot_chart, charts)
+
+
+def plot_chart(chart):
+    # a standalone figure instead of the pyplot global one, so charts never draw over each other
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    layer_name, frequencies, path = chart
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    axes.bar(range(len(frequencies)), [count for _, count in frequencies])
+    axes.set_xticks(range(len(frequencies)))
+    axes.set_xticklabels([str(value) for value, _ in frequencies], rotation=90)
+    axes.set_xlabel(layer_name)
+    figure.savefig(path, bbox_inches="tight")
@@ -0,0 +1,122 @@
+import json
+import os
+from pathlib import Path
+import random
+import threading
+import time
+import uuid
+
+import requests
+
+READ_CHUNK_SIZE = 1 << 20
+# responses worth another attempt, anything else is a request the server will keep rejecting
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+class MultipartStream:
+    # a multipart/form-data body that is read from disk while it is sent, one file open at a
+    # time, the length is known upfront so the request carries a Content-Length header
+    def __init__(self, files, fields=None):
+        # files: (upload name, local path or (archive path, offset, size)) pairs, fields: name -> string value
+        self.boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=" + self.boundary
+        self._parts = []
+        for name, value in (fields or {}).items():
+            self._parts.append((self._header(name) + value.encode() + b"\r\n", None, 0, 0))
+        for upload_name, source in files:
+            header = self._header("file", upload_name) + b"Content-Type: application/octet-stream\r\n\r\n"
+            # a file inside an archive is sent from its offset
+            path, offset, size = source if isinstance(source, tuple) else (source, 0, os.path.getsize(source))
+            self._parts.append((header, str(path), offset, size))
+        self._closing = "--{}--\r\n".format(self.boundary).encode()
+        self._length = sum(len(header) + size + (2 if path is not None else 0) for header, path, _, size in self._parts) + len(self._closing)
+
+    def _header(self, name, filename=None):
+        disposition = 'form-data; name="{}"'.format(name)
+        if filename is not None:
+            disposition += '; filename="{}"'.format(filename.replace('"', "%22"))
+        header = "--{}\r\nContent-Disposition: {}\r\n".format(self.boundary, disposition)
+        return (header if filename is not None else header + "\r\n").encode()
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        # every iteration starts from the first part again, so a retried request resends the whole body
+        for header, path, offset, size in self._parts:
+            yield header
+            if path is None:
+                continue
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                while size > 0:
+                    chunk = f.read(min(READ_CHUNK_SIZE, size))
+                    if not chunk:
+                        raise RuntimeError("{} ended before all of its data was sent".format(path))
+                    size -= len(chunk)
+                    yield chunk
+            yield b"\r\n"
+        yield self._closing
+
+
+def post_with_retries(session, url, make_body, headers=None, retries=5, backoff=1.0, timeout=None):
+    # make_body returns (body, extra headers), called again for every attempt
+    for attempt in range(retries + 1):
+        body, body_headers = make_body()
+        try:
+            response = session.post(url, data=body, headers=dict(headers or {}, **body_headers), timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == retries:
+                raise RuntimeError("upload to {} failed after {} attempts: {}".format(url, attempt + 1, e))
+            delay = None
+        else:
+            if response.ok or response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                return response
+            delay = response.headers.get("Retry-After")
+        # exponential backoff with jitter, unless the server said how long to wait
+        if delay is not None and delay.isdigit():
+            delay = int(delay)
+        else:
+            delay = backoff * (2 ** attempt) * (0.5 + random.random())
+        time.sleep(delay)
+
+
+def folder_files(folder_path):
+    # (path relative to the folder, absolute path) of every visible file, in a stable order
+    folder_path = Path(folder_path).resolve()
+    files = []
+    for root, dirs, names in os.walk(folder_path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(names):
+            if not name.startswith("."):
+                path = Path(root) / name
+                files.append((path.relative_to(folder_path).as_posix(), path))
+    return files
+
+
+class UploadCheckpoint:
+    # results of finished uploads by key and the fingerprint (the local CID) of what was sent,
+    # rewritten atomically after every upload so an interrupted run only repeats the uploads
+    # that had not finished
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = {}
+        self._lock = threading.Lock()
+        if self.path.is_file():
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)
+
+    def get(self, key, fingerprint):
+        entry = self.entries.get(key)
+        if entry is not None and entry["fingerprint"] == fingerprint:
+            return entry["result"]
+        return None
+
+    def record(self, key, fingerprint, result):
+        with self._lock:
+            self.entries[key] = {"fingerprint": fingerprint, "result": result}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f, indent=2)
+            os.replace(tmp_path, self.path)
@@ -1,15 +1,48 @@
 #!/usr/bin/env python
+import argparse
+
 import factory.factory as factory
+from factory.config import Config
+from factory.shards import parse_shard
 
 if __name__ == '__main__':
-    image_factory = factory.Factory()
-    
-    print("Generating trait sets...")
-    image_factory.generate(image_factory.config.get_count())
-
-    print("Writing metadata CSV file...")
-    image_factory.write_to_csv()
-    
-    print("Generating images...")
-    image_factory.generate_images()
-    print("{} total images generated".format(image_factory.row_count()))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stream", action="store_true", help="sample, write metadata and render images at the same time with bounded memory")
+    parser.add_argument("--config", default="./config.yaml", help="path of the config file")
+    parser.add_argument("--name", help="collection name, asked for when neither this nor FACTORY_COLLECTION_NAME is set")
+    parser.add_argument("--count", type=int, help="number of images, overrides the count in the config file")
+    parser.add_argument("--seed", type=int, help="collection seed, the same seed and config always give the same collection")
+    parser.add_argument("--shard", type=parse_shard, help="i/N: render only the i-th (from 0) of N equal parts of the collection, run once per node with the same seed")
+    parser.add_argument("--merge", action="store_true", help="combine the shards copied into the collection's shards folder")
+    parser.add_argument("--expand", action="store_true", help="write the images of a collection rendered into tar archives out as loose files")
+    parser.add_argument("--no-plots", action="store_true", help="when merging, only write the rarity report, skip the per layer charts")
+    args = parser.parse_args()
+    if args.shard is not None and (args.stream or args.merge or args.expand):
+        parser.error("--shard cannot be combined with --stream, --merge or --expand")
+
+    image_factory = factory.Factory(config=Config(args.config, collection_name=args.name, count=args.count, seed=args.seed), shard=args.shard)
+
+    if args.expand:
+        print("Expanding archives...")
+        print("{} images written".format(image_factory.expand_archives()))
+    elif args.merge:
+        print("Merging shards...")
+        stats = image_factory.merge_shards(plot=not args.no_plots)
+        print("{} total images merged".format(stats.count))
+    elif args.stream:
+        print("Generating trait sets, metadata and images...")
+        count = image_factory.generate_streaming(image_factory.config.get_count())
+        print("{} total images generated".format(count))
+    else:
+        print("Generating trait sets...")
+        image_factory.generate(image_factory.config.get_count())
+
+        print("Writing metadata CSV file...")
+        image_factory.write_to_csv()
+        
+        print("Generating images...")
+        image_factory.generate_images()
+        if args.shard is None:
+            print("{} total images generated".format(image_factory.row_count()))
+
+    image_factory.write_profile()
@@ -1,15 +1,18 @@
 #!/usr/bin/env python
 
+import argparse
 from pathlib import Path
 import pandas as pd
 
 from factory.config import Config
 from factory.factory import Factory
+from factory.metadata import read_metadata
 import factory.constants as constants
 
 class Handler:
-    def __init__(self, config_path="./config.yaml"):
-        self.config = Config(config_path=config_path)
+    def __init__(self, config_path="./config.yaml", plot=True, collection_name=None):
+        self.config = Config(config_path=config_path, collection_name=collection_name)
+        self.plot = plot
         metadata_path = self._get_metadata_path()
         if not metadata_path.exists() or not metadata_path.is_file():
             self._handle_missing_collection()
@@ -40,24 +43,20 @@ class Handler:
         return Path(constants.OUTPUT_DIR_NAME) / self.config.get_collection_name() / constants.METADATA_DIR_NAME / constants.METADATA_FILE_NAME
     
     def _handle_existing_collection(self, metadata_path):
-        df: pd.DataFrame = pd.read_csv(metadata_path, keep_default_na=False)
-        df = df.drop(labels='filename', axis=1)
-        df = df[df.any(1)]
-        df = df.reset_index()
-        df = df.drop('index', axis=1)
-        for trait_name in df:
-            unique_vals = list(df[trait_name].unique())
-            unique_vals_filtered_none = filter(lambda trait_val: trait_val != "", unique_vals)
-            valid_files = self.config.get_live_traits(self.config.get_directory_name(trait_name))
-            for val in unique_vals_filtered_none:
-                if val not in valid_files:
-                    raise RuntimeError("unable to locate trait (value: {}) for (trait: {})".format(val, trait_name))
+        # categorical columns coded against the layer vocabularies, rows without any trait dropped
+        df: pd.DataFrame = read_metadata(metadata_path, self.config)
 
         factory: Factory = Factory(metadata=df, config=self.config)
         factory.generate_images()
-        factory.generate_stats()
+        factory.generate_stats(plot=self.plot)
         factory.write_to_csv()
+        factory.write_profile()
 
 if __name__ == '__main__':
-    handler = Handler()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--no-plots", action="store_true", help="only write the rarity report, skip the per layer charts")
+    parser.add_argument("--config", default="./config.yaml", help="path of the config file")
+    parser.add_argument("--name", help="collection name, asked for when neither this nor FACTORY_COLLECTION_NAME is set")
+    args = parser.parse_args()
+    handler = Handler(config_path=args.config, plot=not args.no_plots, collection_name=args.name)
 
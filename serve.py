@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+import argparse
+from pathlib import Path
+
+import factory.constants as constants
+from factory.config import Config
+from factory.sampler import BatchSampler
+from factory.server import RenderService, serve
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="render the tokens of a collection on request instead of ahead of time")
+    parser.add_argument("--config", default="./config.yaml", help="path of the config file")
+    parser.add_argument("--name", help="collection name, asked for when neither this nor FACTORY_COLLECTION_NAME is set")
+    parser.add_argument("--count", type=int, help="number of tokens, overrides the count in the config file")
+    parser.add_argument("--seed", type=int, help="collection seed, used when the collection has no metadata.csv yet")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, help="render processes, one per CPU by default")
+    parser.add_argument("--cache-mb", type=float, default=256, help="memory kept for encoded images")
+    args = parser.parse_args()
+
+    config = Config(args.config, collection_name=args.name, count=args.count, seed=args.seed)
+    metadata_path = Path(constants.OUTPUT_DIR_NAME) / config.get_collection_name() / constants.METADATA_DIR_NAME / constants.METADATA_FILE_NAME
+    if metadata_path.is_file():
+        from factory.metadata import read_metadata
+        codes = config.constraints.encode_metadata(read_metadata(metadata_path, config))
+    elif config.get_seed() is not None:
+        # the tokens the seed generates, without writing anything
+        codes = BatchSampler(config, seed=config.get_seed()).sample(config.get_count())
+    else:
+        parser.error("{} not found, pass --seed to serve the collection a seed generates".format(metadata_path))
+
+    service = RenderService(config, codes, processes=args.workers, cache_bytes=int(args.cache_mb * 1024 * 1024))
+    print("serving {} tokens at http://{}:{}/tokens/<n>.{}".format(len(codes), args.host, args.port, service.encoder.filetype))
+    serve(service, args.host, args.port)
@@ -0,0 +1,19 @@
+import pytest
+
+from benchmarks.synthetic import make_assets, make_config
+from factory.config import Config
+
+
+@pytest.fixture
+def synthetic_config(tmp_path, monkeypatch):
+    # builds a synthetic layer tree and its config in a temporary folder, which is also the
+    # working directory so the collection output lands there
+    monkeypatch.chdir(tmp_path)
+
+    def make(layer_count=4, traits_per_layer=4, rule_count=0, count=10, seed=0, image_size=8, filetype=None, equals_share=0.1):
+        assets_path = tmp_path / "assets"
+        layer_names = make_assets(assets_path, layer_count, traits_per_layer, image_size, seed)
+        make_config(tmp_path / "config.yaml", assets_path, layer_names, traits_per_layer, rule_count, count, seed, equals_share)
+        return Config(tmp_path / "config.yaml", collection_name="test", count=count, filetype=filetype, seed=seed, cache=False)
+
+    return make
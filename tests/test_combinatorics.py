@@ -0,0 +1,56 @@
+import time
+
+import numpy as np
+import pytest
+
+import factory.combinatorics as combinatorics
+from factory.combinatorics import FeasibleSpace
+from factory.sampler import BatchSampler
+
+
+def reachable(constraints):
+    # every trait set the sampler can end in, walked one partial trait set at a time
+    states = {tuple([-1] * len(constraints.layer_names))}
+    for index in range(len(constraints.layer_names)):
+        branched = set()
+        for state in states:
+            codes = np.array([state], dtype=np.int64)
+            weights = constraints.candidate_weights(index, codes)[0] if constraints.constrained[index] else constraints.weights[index]
+            for code in np.flatnonzero(weights > 0):
+                row = codes.copy()
+                row[0, index] = code
+                constraints.apply_equals_updates(index, row)
+                branched.add(tuple(row[0].tolist()))
+        states = branched
+    return states
+
+
+@pytest.mark.parametrize("seed", range(6))
+def test_count_matches_brute_force(synthetic_config, seed):
+    config = synthetic_config(layer_count=5, traits_per_layer=3, rule_count=4 + seed, seed=seed, equals_share=0.5)
+    expected = reachable(config.constraints)
+    space = FeasibleSpace(config.constraints)
+    assert space.count() == len(expected)
+    assert space.count() <= space.bound
+
+    # drawing the whole space gives every reachable trait set once
+    codes = BatchSampler(config, seed=seed).sample(len(expected))
+    assert {tuple(row) for row in codes.tolist()} == expected
+
+
+def test_count_above_the_space_fails_at_once(synthetic_config):
+    config = synthetic_config(layer_count=5, traits_per_layer=3, rule_count=6, seed=1, equals_share=0.5)
+    size = len(reachable(config.constraints))
+    start = time.perf_counter()
+    with pytest.raises(ValueError, match="only allow {} combinations".format(size)):
+        BatchSampler(config, seed=1).sample(size + 1)
+    assert time.perf_counter() - start < 1
+
+
+def test_uncountable_exhausted_space_fails(synthetic_config, monkeypatch):
+    # nothing fits in the counting budget, so only the stall limit can tell the space is exhausted
+    monkeypatch.setattr(combinatorics, "MAX_SPACE_BYTES", 0)
+    config = synthetic_config(layer_count=5, traits_per_layer=3, rule_count=6, seed=1, equals_share=0.5)
+    size = len(reachable(config.constraints))
+    with pytest.raises(ValueError, match="probably exhausted"):
+        BatchSampler(config, seed=1).sample(size + 1)
@@ -0,0 +1,91 @@
+from PIL import Image
+import pytest
+import yaml
+
+import factory.constants as constants
+from factory.config import Config
+
+
+@pytest.fixture
+def compiles(monkeypatch):
+    # counts the configs compiled from the file instead of loaded from the cache
+    calls = []
+    compile_config = Config._compile
+
+    def counted(self, *args):
+        calls.append(args)
+        return compile_config(self, *args)
+
+    monkeypatch.setattr(Config, "_compile", counted)
+    return calls
+
+
+def prepare(synthetic_config, compiles, **options):
+    # the fixture compiles the config once without the cache, that compile is not counted
+    synthetic_config(**options)
+    compiles.clear()
+
+
+def load(tmp_path):
+    return Config(tmp_path / "config.yaml", collection_name="test")
+
+
+def test_unchanged_config_is_loaded_from_the_cache(synthetic_config, tmp_path, compiles):
+    prepare(synthetic_config, compiles, rule_count=2)
+    first = load(tmp_path)
+    second = load(tmp_path)
+    assert len(compiles) == 1
+    assert second.get_live_traits("layer1") == first.get_live_traits("layer1")
+    assert second.rules == first.rules
+
+
+def test_changed_config_file_is_compiled_again(synthetic_config, tmp_path, compiles):
+    prepare(synthetic_config, compiles)
+    load(tmp_path)
+    raw_cfg = yaml.safe_load((tmp_path / "config.yaml").read_text())
+    raw_cfg[constants.ASSETS_KEY][constants.LAYERS_KEY][3][constants.LAYER_REQUIRED_KEY] = True
+    (tmp_path / "config.yaml").write_text(yaml.safe_dump(raw_cfg, sort_keys=False))
+    config = load(tmp_path)
+    assert len(compiles) == 2
+    assert config.get_layers()[3][constants.LAYER_REQUIRED_KEY] is True
+
+
+def test_changed_layer_folder_is_scanned_again(synthetic_config, tmp_path, compiles):
+    prepare(synthetic_config, compiles, image_size=4)
+    load(tmp_path)
+    Image.new("RGBA", (4, 4)).save(tmp_path / "assets" / "layer2" / "trait9.png")
+    config = load(tmp_path)
+    assert len(compiles) == 2
+    assert "trait9" in config.get_live_traits("layer2")
+
+
+def test_overrides_are_part_of_the_cache_key(synthetic_config, tmp_path, compiles, monkeypatch):
+    prepare(synthetic_config, compiles)
+    load(tmp_path)
+    monkeypatch.setenv(constants.ENV_COLLECTION_FILETYPE, "jpeg")
+    assert load(tmp_path).get_filetype() == "jpeg"
+    monkeypatch.delenv(constants.ENV_COLLECTION_FILETYPE)
+    (tmp_path / "assets").rename(tmp_path / "moved")
+    monkeypatch.setenv(constants.ENV_ASSETS_PATH, str(tmp_path / "moved"))
+    assert load(tmp_path).get_assets_path() == tmp_path / "moved"
+    assert len(compiles) == 3
+
+    # values applied after loading never need a new compile
+    monkeypatch.setenv(constants.ENV_COLLECTION_COUNT, "7")
+    monkeypatch.setenv(constants.ENV_COLLECTION_SEED, "11")
+    config = load(tmp_path)
+    assert (config.get_count(), config.get_seed()) == (7, 11)
+    assert len(compiles) == 3
+
+
+def test_prompted_config_is_not_cached(synthetic_config, tmp_path, compiles, monkeypatch):
+    prepare(synthetic_config, compiles)
+    raw_cfg = yaml.safe_load((tmp_path / "config.yaml").read_text())
+    del raw_cfg[constants.COLLECTION_FILETYPE_KEY]
+    (tmp_path / "config.yaml").write_text(yaml.safe_dump(raw_cfg, sort_keys=False))
+    answers = []
+    monkeypatch.setattr("builtins.input", lambda prompt: answers.append(prompt) or "png")
+    load(tmp_path)
+    load(tmp_path)
+    assert len(compiles) == 2
+    assert len(answers) == 2
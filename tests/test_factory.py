@@ -0,0 +1,79 @@
+from pathlib import Path
+import threading
+
+import pytest
+
+import factory.constants as constants
+from factory.archive import ArchiveWriter
+import factory.factory as factory_module
+from factory.factory import Factory
+
+
+def metadata_csv(config):
+    return (Path(constants.OUTPUT_DIR_NAME) / config.get_collection_name() / constants.METADATA_DIR_NAME / constants.METADATA_FILE_NAME).read_bytes()
+
+
+def test_streaming_matches_batch_metadata(synthetic_config):
+    # more tokens than one streaming render batch, drawn over several sampler batches
+    config = synthetic_config(layer_count=6, traits_per_layer=6, rule_count=5, count=5000, image_size=4)
+    batch_factory = Factory(config=config)
+    batch_factory.generate(5000, seed=7)
+    batch_factory.write_to_csv()
+    expected = metadata_csv(config)
+
+    assert Factory(config=config).generate_streaming(5000, seed=7) == 5000
+    assert metadata_csv(config) == expected
+
+
+def test_merge_shards_with_files_sink(synthetic_config):
+    config = synthetic_config(count=40, image_size=4)
+    for shard in range(2):
+        shard_factory = Factory(config=config, shard=(shard, 2))
+        shard_factory.generate(40, seed=3)
+        shard_factory.write_to_csv()
+        shard_factory.generate_images()
+
+    Factory(config=config).merge_shards(plot=False)
+    collection_path = Path(constants.OUTPUT_DIR_NAME) / config.get_collection_name()
+    assert not (collection_path / constants.ARCHIVES_DIR_NAME).exists()
+    assert not (collection_path / constants.SHARDS_DIR_NAME).exists()
+    assert sorted(path.name for path in (collection_path / constants.IMAGES_DIR_NAME).iterdir()) == sorted("{}.png".format(index) for index in range(40))
+
+
+def test_streaming_refuses_a_shard_before_touching_it(synthetic_config):
+    config = synthetic_config(count=20, image_size=4)
+    shard_factory = Factory(config=config, shard=(0, 2))
+    shard_factory.generate(20, seed=3)
+    shard_factory.write_to_csv()
+    shard_factory.generate_images()
+    shard_path = shard_factory._collection_path()
+    before = sorted(str(path.relative_to(shard_path)) for path in shard_path.rglob("*"))
+
+    with pytest.raises(ValueError):
+        shard_factory.generate_streaming(20, seed=3)
+    assert sorted(str(path.relative_to(shard_path)) for path in shard_path.rglob("*")) == before
+
+
+def test_streaming_fails_when_the_archive_sink_fails(synthetic_config, monkeypatch):
+    config = synthetic_config(layer_count=5, traits_per_layer=6, count=600, image_size=4)
+    config.processed_cfg[constants.RENDER_KEY][constants.RENDER_SINK_KEY] = constants.RENDER_SINK_TAR
+
+    def full_disk(self, name, data):
+        raise OSError("no space left on device")
+
+    monkeypatch.setattr(ArchiveWriter, "add", full_disk)
+    # one batch in flight at a time, so the loop waits on every render callback
+    monkeypatch.setattr(factory_module, "STREAM_MAX_IN_FLIGHT", 1)
+    errors = []
+
+    def run():
+        try:
+            Factory(config=config).generate_streaming(600, seed=3)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive()
+    assert len(errors) == 1 and isinstance(errors[0], OSError)
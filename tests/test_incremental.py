@@ -0,0 +1,61 @@
+import json
+import os
+from pathlib import Path
+
+from PIL import Image
+import pytest
+
+import factory.constants as constants
+from factory.factory import Factory
+
+COUNT = 60
+# mtime every output is set to before a rerun, a rendered image gets a newer one
+OLD_MTIME_NS = 1_000_000_000_000_000_000
+
+
+@pytest.fixture
+def rendered(synthetic_config):
+    config = synthetic_config(layer_count=4, traits_per_layer=4, count=COUNT, image_size=4)
+    image_factory = Factory(config=config)
+    image_factory.generate(COUNT, seed=5)
+    image_factory.write_to_csv()
+    image_factory.generate_images()
+    return image_factory
+
+
+def images_path(image_factory):
+    return Path(constants.OUTPUT_DIR_NAME) / image_factory.config.get_collection_name() / constants.IMAGES_DIR_NAME
+
+
+def rerender(image_factory):
+    # the indices of the images the next run writes
+    for entry in os.scandir(images_path(image_factory)):
+        os.utime(entry.path, ns=(OLD_MTIME_NS, OLD_MTIME_NS))
+    image_factory.generate_images()
+    return sorted(int(entry.name.split(".")[0]) for entry in os.scandir(images_path(image_factory)) if entry.stat().st_mtime_ns != OLD_MTIME_NS)
+
+
+def test_unchanged_collection_renders_nothing(rendered):
+    assert rerender(rendered) == []
+
+
+def test_changed_asset_renders_its_tokens(rendered, tmp_path):
+    Image.new("RGBA", (4, 4), (9, 8, 7, 255)).save(tmp_path / "assets" / "layer2" / "trait1.png")
+    expected = rendered.metadata.index[rendered.metadata["layer2"] == "trait1"].tolist()
+    assert expected
+    assert rerender(rendered) == expected
+
+
+def test_corrupt_and_missing_outputs_render_again(rendered):
+    with open(images_path(rendered) / "3.png", "r+b") as f:
+        f.truncate(10)
+    os.remove(images_path(rendered) / "17.png")
+    assert rerender(rendered) == [3, 17]
+
+
+def test_shrunk_collection_removes_stale_outputs(rendered):
+    rendered.metadata = rendered.metadata.iloc[:40]
+    assert rerender(rendered) == []
+    assert sorted(int(entry.name.split(".")[0]) for entry in os.scandir(images_path(rendered))) == list(range(40))
+    with open(Path(constants.OUTPUT_DIR_NAME) / rendered.config.get_collection_name() / constants.MANIFEST_FILE_NAME) as f:
+        assert sorted(map(int, json.load(f)["tokens"])) == list(range(40))
@@ -0,0 +1,124 @@
+import pytest
+
+import factory.ipfs as ipfs
+
+# CIDs `ipfs add` gives with its defaults
+EMPTY_FILE_CID = "QmbFMke1KXqnYyBBWxB74N4c5SBnJMVAiMNRcGu6x1AwQH"
+HELLO_WORLD_CID = "QmT78zSuBmuS4z925WZfrqQ1qHaJ56DQaTfyMUF7F8ff5o"
+EMPTY_DIRECTORY_CID = "QmUNLLsPACCz1vLxQVkXqqLX5R1X345qqfHbsf67hvA3Nn"
+# cumulative size of a leaf holding a full chunk, as `ipfs object links` lists it
+FULL_LEAF_SIZE = 262158
+
+
+@pytest.fixture
+def blocks(monkeypatch):
+    # (unixfs data, links) of every block built, by multihash
+    recorded = {}
+    node = ipfs._node
+
+    def recording(data, links=()):
+        multihash, size = node(data, links)
+        recorded[multihash] = (data, list(links))
+        return multihash, size
+
+    monkeypatch.setattr(ipfs, "_node", recording)
+    return recorded
+
+
+def fields(message):
+    # {field number: [values]} of a protobuf message with varint and length delimited fields only
+    out = {}
+    position = 0
+
+    def varint():
+        nonlocal position
+        value = shift = 0
+        while True:
+            byte = message[position]
+            position += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                return value
+
+    while position < len(message):
+        key = varint()
+        if key & 7 == 2:
+            length = varint()
+            value = message[position:position + length]
+            position += length
+        else:
+            value = varint()
+        out.setdefault(key >> 3, []).append(value)
+    return out
+
+
+def test_known_vectors():
+    assert ipfs.file_cid(b"") == EMPTY_FILE_CID
+    assert ipfs.file_cid(b"hello world\n") == HELLO_WORLD_CID
+    assert ipfs.to_cid(ipfs.directory_node([])[0]) == EMPTY_DIRECTORY_CID
+    assert ipfs.to_cid(ipfs.from_cid(HELLO_WORLD_CID)) == HELLO_WORLD_CID
+
+
+def test_folder_matches_its_files(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "empty.txt").write_bytes(b"")
+    (tmp_path / "sub" / "hello.txt").write_bytes(b"hello world\n")
+    (tmp_path / ".hidden").write_bytes(b"skipped")
+    root, nodes = ipfs.folder_nodes(tmp_path)
+    assert {name: ipfs.to_cid(multihash) for name, (multihash, _) in nodes.items()} == {"empty.txt": EMPTY_FILE_CID, "sub/hello.txt": HELLO_WORLD_CID}
+    sub = ipfs.directory_node([("hello.txt",) + nodes["sub/hello.txt"]])
+    assert root == ipfs.directory_node([("empty.txt",) + nodes["empty.txt"], ("sub",) + sub])
+
+
+def test_large_file_is_chunked(blocks):
+    data = bytes(range(256)) * (2 * ipfs.CHUNK_SIZE // 256) + b"tail"
+    multihash, size = ipfs.file_node(data)
+    root_data, links = blocks[multihash]
+    assert fields(root_data) == {1: [ipfs.UNIXFS_FILE], 3: [len(data)], 4: [ipfs.CHUNK_SIZE, ipfs.CHUNK_SIZE, 4]}
+    chunks = [data[:ipfs.CHUNK_SIZE], data[ipfs.CHUNK_SIZE:2 * ipfs.CHUNK_SIZE], b"tail"]
+    assert links == [(ipfs.file_node(chunk)[0], "", leaf_size) for chunk, leaf_size in zip(chunks, [FULL_LEAF_SIZE, FULL_LEAF_SIZE, 12])]
+    leaf_data, leaf_links = blocks[links[0][0]]
+    assert leaf_links == [] and fields(leaf_data) == {1: [ipfs.UNIXFS_FILE], 2: [chunks[0]], 3: [ipfs.CHUNK_SIZE]}
+    # the root block holds links of 44, 44 and 42 bytes and its 16 bytes of unixfs data in 18
+    assert size == 44 + 44 + 42 + 18 + 2 * FULL_LEAF_SIZE + 12
+
+
+def test_file_beyond_one_node_of_links_gets_another_level(blocks):
+    data = bytes(ipfs.CHUNK_SIZE * (ipfs.MAX_LINKS + 1))
+    multihash, _ = ipfs.file_node(data)
+    root_data, links = blocks[multihash]
+    assert fields(root_data)[4] == [ipfs.CHUNK_SIZE * ipfs.MAX_LINKS, ipfs.CHUNK_SIZE]
+    assert len(blocks[links[0][0]][1]) == ipfs.MAX_LINKS
+    # the last chunk sits at the same depth as the others, below a node of its own
+    assert blocks[links[1][0]][1] == [(ipfs.file_node(bytes(ipfs.CHUNK_SIZE))[0], "", FULL_LEAF_SIZE)]
+
+
+def test_large_directory_is_sharded(blocks):
+    file_multihash, file_size = ipfs.file_node(b"")
+    # names and multihashes of 1000 entries stay below the sharding size, 7000 do not
+    multihash, _ = ipfs.directory_node([("{}.png".format(index), file_multihash, file_size) for index in range(1000)])
+    assert fields(blocks[multihash][0]) == {1: [ipfs.UNIXFS_DIRECTORY]}
+    names = ["{}.png".format(index) for index in range(7000)]
+    multihash, _ = ipfs.directory_node([(name, file_multihash, file_size) for name in reversed(names)])
+
+    found = []
+
+    def walk(multihash, depth):
+        data, links = blocks[multihash]
+        unixfs = fields(data)
+        assert (unixfs[1], unixfs[5], unixfs[6]) == ([ipfs.UNIXFS_HAMT_SHARD], [ipfs.HAMT_HASH_MURMUR3], [ipfs.HAMT_FANOUT])
+        slots = [int(link_name[:2], 16) for _, link_name, _ in links]
+        assert slots == sorted(set(slots))
+        assert int.from_bytes(unixfs[2][0], "big") == sum(1 << slot for slot in slots)
+        for (child, link_name, _), slot in zip(links, slots):
+            if len(link_name) == 2:
+                walk(child, depth + 1)
+                continue
+            name = link_name[2:]
+            assert ipfs._murmur3_64(name.encode()) >> (56 - 8 * depth) & 0xff == slot
+            assert (child, blocks[child][0]) == (file_multihash, blocks[file_multihash][0])
+            found.append(name)
+
+    walk(multihash, 0)
+    assert sorted(found) == sorted(names)
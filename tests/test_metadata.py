@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import factory.constants as constants
+import factory.metadata as metadata_module
+from factory.factory import Factory
+from factory.metadata import METADATA_STORE_NPZ, METADATA_STORE_PARQUET, read_csv, read_metadata, read_store, store_path, write_store
+from factory.sampler import BatchSampler
+
+
+def written_collection(synthetic_config, store):
+    config = synthetic_config(layer_count=4, traits_per_layer=4, count=30)
+    config.processed_cfg[constants.METADATA_KEY] = {constants.METADATA_STORE_KEY: store}
+    image_factory = Factory(config=config)
+    image_factory.generate(30, seed=2)
+    image_factory.write_to_csv()
+    metadata_path = os.path.join(constants.OUTPUT_DIR_NAME, config.get_collection_name(), constants.METADATA_DIR_NAME, constants.METADATA_FILE_NAME)
+    return config, image_factory.metadata, metadata_path
+
+
+def test_unknown_values_are_reported_together(synthetic_config, tmp_path):
+    config = synthetic_config(layer_count=3, traits_per_layer=3)
+    pd.DataFrame({"filename": ["0.png", "1.png", "2.png"], "layer0": ["trait0", "nope", "trait1"], "layer1": ["trait0", "trait1", "gone"], "layer2": ["", "trait2", "missing"]}).to_csv(tmp_path / "metadata.csv", index=False)
+    with pytest.raises(RuntimeError) as error:
+        read_metadata(tmp_path / "metadata.csv", config)
+    for value in ("(trait: layer0) values: nope", "(trait: layer1) values: gone", "(trait: layer2) values: missing"):
+        assert value in str(error.value)
+
+
+@pytest.mark.parametrize("store", [METADATA_STORE_NPZ, METADATA_STORE_PARQUET])
+def test_store_round_trip(synthetic_config, store):
+    if store == METADATA_STORE_PARQUET:
+        pytest.importorskip("pyarrow")
+    config, metadata, metadata_path = written_collection(synthetic_config, store)
+    stored = read_store(store_path(metadata_path, store), store)
+    assert stored.astype(str).equals(metadata.astype(str))
+    assert read_metadata(metadata_path, config).astype(str).equals(metadata.astype(str))
+
+
+def test_store_is_used_while_the_csv_is_unchanged(synthetic_config, monkeypatch):
+    config, metadata, metadata_path = written_collection(synthetic_config, METADATA_STORE_NPZ)
+
+    def no_csv(path):
+        raise AssertionError("the CSV was parsed")
+
+    monkeypatch.setattr(metadata_module, "read_csv", no_csv)
+    assert read_metadata(metadata_path, config).astype(str).equals(metadata.astype(str))
+
+
+def test_edited_csv_wins_over_a_newer_store(synthetic_config):
+    config, metadata, metadata_path = written_collection(synthetic_config, METADATA_STORE_NPZ)
+    rows = pd.read_csv(metadata_path, keep_default_na=False, dtype=str)
+    rows.loc[0, "layer0"] = "trait3" if rows.loc[0, "layer0"] != "trait3" else "trait2"
+    rows.to_csv(metadata_path, index=False)
+    # as after cp -p or a checkout: the edited CSV looks older than the store
+    store_mtime = os.stat(store_path(metadata_path, METADATA_STORE_NPZ)).st_mtime_ns
+    os.utime(metadata_path, ns=(store_mtime - 10**9, store_mtime - 10**9))
+    assert read_metadata(metadata_path, config)["layer0"][0] == rows.loc[0, "layer0"]
+
+
+def test_chunked_csv_parsing(synthetic_config, tmp_path, monkeypatch):
+    # categories that only show up in later chunks are merged into one categorical column
+    monkeypatch.setattr(metadata_module, "CSV_CHUNK_ROWS", 7)
+    config = synthetic_config(layer_count=4, traits_per_layer=4, rule_count=2, count=50)
+    metadata = BatchSampler(config, seed=4).decode(BatchSampler(config, seed=4).sample(50))
+    Factory(config=config)._csv_rows(metadata, 0).to_csv(tmp_path / "metadata.csv", index=False)
+
+    parsed = read_csv(tmp_path / "metadata.csv")
+    expected = pd.read_csv(tmp_path / "metadata.csv", keep_default_na=False, dtype=str).drop(columns="filename")
+    assert all(isinstance(parsed[column].dtype, pd.CategoricalDtype) for column in parsed)
+    assert parsed.astype(str).equals(expected)
+    assert np.array_equal(config.constraints.encode_metadata(read_metadata(tmp_path / "metadata.csv", config)), config.constraints.encode_metadata(metadata))
@@ -0,0 +1,103 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+import factory.constants as constants
+from factory.assets import AssetAtlas
+from factory.encoder import Encoder, to_palette
+from factory.factory import init_render_worker, render_batch
+from factory.sampler import BatchSampler
+
+
+def translucent_assets(assets_path, layer_count, traits_per_layer, image_size):
+    # an opaque RGB background under layers whose alpha covers the whole 0-255 range
+    rng = np.random.default_rng(5)
+    for layer_index in range(layer_count):
+        for trait_index in range(traits_per_layer):
+            if layer_index == 0:
+                img = Image.fromarray(rng.integers(0, 256, (image_size, image_size, 3), dtype=np.uint8))
+            else:
+                img = Image.fromarray(rng.integers(0, 256, (image_size, image_size, 4), dtype=np.uint8))
+            img.save(assets_path / "layer{}".format(layer_index) / "trait{}.png".format(trait_index))
+
+
+def render(atlas, encoder, codes, backend, directory, mode=None):
+    directory.mkdir()
+    init_render_worker(atlas, [(str(directory), None, None)], encoder, 0, backend)
+    render_batch((np.arange(len(codes)), codes))
+    images = [Image.open(directory / "{}.png".format(index)) for index in range(len(codes))]
+    return [np.asarray(img.convert(mode) if mode else img) for img in images]
+
+
+def test_numpy_backend_matches_pil_paste(synthetic_config, tmp_path):
+    config = synthetic_config(layer_count=4, traits_per_layer=3, count=40, image_size=16)
+    translucent_assets(tmp_path / "assets", 4, 3, 16)
+    atlas = AssetAtlas.build(config, tmp_path / "atlas.npy")
+    encoder = Encoder.from_config(config)
+    codes = BatchSampler(config, seed=2).sample(40)
+
+    pasted = render(atlas, encoder, codes, constants.RENDER_BACKEND_PIL, tmp_path / "pil")
+    blended = render(atlas, encoder, codes, constants.RENDER_BACKEND_NUMPY, tmp_path / "numpy")
+    for pasted_pixels, blended_pixels in zip(pasted, blended):
+        assert pasted_pixels.shape == blended_pixels.shape
+        assert np.array_equal(pasted_pixels, blended_pixels)
+
+
+def test_atlas_is_reused_and_replaced(synthetic_config, tmp_path):
+    config = synthetic_config(layer_count=3, traits_per_layer=2, count=4, image_size=8)
+    atlas = AssetAtlas.build(config, tmp_path / "atlas.npy")
+    inode = (tmp_path / "atlas.npy").stat().st_ino
+    assert AssetAtlas.build(config, tmp_path / "atlas.npy").rows[1].tolist() == atlas.rows[1].tolist()
+    assert (tmp_path / "atlas.npy").stat().st_ino == inode
+
+    # a changed asset builds a new atlas next to the one still mapped
+    before = np.array(atlas.pixels)
+    Image.new("RGBA", (8, 8), (1, 2, 3, 128)).save(tmp_path / "assets" / "layer1" / "trait0.png")
+    rebuilt = AssetAtlas.build(config, tmp_path / "atlas.npy")
+    assert (tmp_path / "atlas.npy").stat().st_ino != inode
+    assert np.array_equal(atlas.pixels, before)
+    assert not np.array_equal(rebuilt.pixels, before)
+
+
+def test_palette_png_is_lossless(synthetic_config, tmp_path):
+    # 16x16 composites never have more than 256 colors, so every one of them is paletted
+    config = synthetic_config(layer_count=4, traits_per_layer=3, count=20, image_size=16)
+    translucent_assets(tmp_path / "assets", 4, 3, 16)
+    atlas = AssetAtlas.build(config, tmp_path / "atlas.npy")
+    codes = BatchSampler(config, seed=3).sample(20)
+    composites = render(atlas, Encoder.from_config(config), codes, constants.RENDER_BACKEND_PIL, tmp_path / "rgba", "RGBA")
+    config.processed_cfg[constants.ENCODE_KEY][constants.ENCODE_PALETTE_KEY] = True
+    paletted = render(atlas, Encoder.from_config(config), codes, constants.RENDER_BACKEND_PIL, tmp_path / "palette")
+    assert all(pixels.ndim == 2 for pixels in paletted)
+    for index, composite in enumerate(composites):
+        assert np.array_equal(np.asarray(Image.open(tmp_path / "palette" / "{}.png".format(index)).convert("RGBA")), composite)
+
+    # translucent colors keep their alpha through the palette's transparency table
+    pixels = np.random.default_rng(4).integers(0, 256, (16, 16, 4), dtype=np.uint8)
+    encoder = Encoder("png", palette=True)
+    decoded = Image.open(io.BytesIO(encoder.encode(encoder.prepare(Image.fromarray(pixels)))))
+    assert decoded.mode == "P"
+    assert np.array_equal(np.asarray(decoded.convert("RGBA")), pixels)
+    # more than 256 colors stay as they are
+    pixels = np.random.default_rng(4).integers(0, 256, (32, 32, 4), dtype=np.uint8)
+    assert to_palette(Image.fromarray(pixels)).mode == "RGBA"
+
+
+def test_jpeg_flattens_alpha_onto_the_background(synthetic_config):
+    config = synthetic_config()
+    config.processed_cfg[constants.ENCODE_KEY][constants.ENCODE_FILETYPE_KEY] = "jpeg"
+    config.processed_cfg[constants.ENCODE_KEY][constants.ENCODE_QUALITY_KEY] = 95
+    config.processed_cfg[constants.ENCODE_KEY][constants.ENCODE_BACKGROUND_KEY] = "#2060a0"
+    encoder = Encoder.from_config(config)
+    pixels = np.zeros((16, 48, 4), dtype=np.uint8)
+    # a transparent red, a half transparent white and an opaque green band
+    pixels[:, :16] = (255, 0, 0, 0)
+    pixels[:, 16:32] = (255, 255, 255, 128)
+    pixels[:, 32:] = (0, 255, 0, 255)
+    decoded = np.asarray(Image.open(io.BytesIO(encoder.encode(encoder.prepare(Image.fromarray(pixels))))), dtype=np.int64)
+    assert decoded.shape == (16, 48, 3)
+    background = np.array([0x20, 0x60, 0xa0])
+    expected = [background, background + (255 - background) * 128 // 255, np.array([0, 255, 0])]
+    for band, color in enumerate(expected):
+        assert np.abs(decoded[4:12, 16 * band + 4:16 * band + 12] - color).max() <= 4
@@ -0,0 +1,88 @@
+import os
+
+import pandas as pd
+import pytest
+
+import factory.renumber as renumber
+from factory.renumber import PLAN_FILE_NAME, Renumbering
+
+
+def make_edition(path, count, pruned):
+    # every image holds its original index, and so does its metadata row
+    images_path = path / "images"
+    images_path.mkdir(parents=True)
+    for index in range(count):
+        if index not in pruned:
+            (images_path / "{}.png".format(index)).write_bytes("image {}".format(index).encode())
+    pd.DataFrame({"filename": ["{}.png".format(index) for index in range(count)], "Eyes": ["eyes {}".format(index) for index in range(count)]}).to_csv(path / "metadata.csv", index=False)
+    return Renumbering(images_path, path / "metadata.csv")
+
+
+def check_edition(path, remaining):
+    images_path = path / "images"
+    assert sorted(os.listdir(images_path)) == sorted("{}.png".format(index) for index in range(len(remaining)))
+    metadata = pd.read_csv(path / "metadata.csv", keep_default_na=False, dtype=str)
+    assert metadata["filename"].tolist() == ["{}.png".format(index) for index in range(len(remaining))]
+    for new_index, old_index in enumerate(remaining):
+        assert (images_path / "{}.png".format(new_index)).read_bytes() == "image {}".format(old_index).encode()
+        assert metadata["Eyes"][new_index] == "eyes {}".format(old_index)
+
+
+def test_pruned_images_and_rows_line_up(tmp_path):
+    renumbering = make_edition(tmp_path, 10, {2, 3, 7})
+    assert renumbering.run() == 7
+    check_edition(tmp_path, [0, 1, 4, 5, 6, 8, 9])
+
+
+def test_moves_onto_names_still_taken(tmp_path):
+    # every image moves onto the name the next one still holds, nothing may be overwritten
+    renumbering = make_edition(tmp_path, 6, {0})
+    renumbering.run()
+    check_edition(tmp_path, [1, 2, 3, 4, 5])
+
+
+def test_temporary_name_taken_without_a_plan(tmp_path):
+    renumbering = make_edition(tmp_path, 4, {0})
+    (tmp_path / "images" / ".renumber-1.png").write_bytes(b"not ours")
+    with pytest.raises(RuntimeError, match="in the way"):
+        renumbering.run()
+    assert (tmp_path / "images" / ".renumber-1.png").read_bytes() == b"not ours"
+    assert sorted(os.listdir(tmp_path / "images")) == [".renumber-1.png", "1.png", "2.png", "3.png"]
+
+
+def failing_after(calls, function):
+    # the real function for the first calls, then a crash
+    count = [0]
+
+    def wrapped(*args):
+        count[0] += 1
+        if count[0] > calls:
+            raise OSError("crash")
+        return function(*args)
+
+    return wrapped
+
+
+@pytest.mark.parametrize("moves_before_crash", [0, 2, 5, 7, 9])
+def test_interrupted_moves_resume_from_the_plan(tmp_path, monkeypatch, moves_before_crash):
+    # 5 images move, so the crash hits staging (before 5 moves) or committing (after)
+    renumbering = make_edition(tmp_path, 8, {0, 3})
+    with monkeypatch.context() as patch:
+        patch.setattr(renumber.os, "rename", failing_after(moves_before_crash, os.rename))
+        with pytest.raises(OSError):
+            renumbering.run()
+    assert (tmp_path / "images" / PLAN_FILE_NAME).is_file()
+
+    Renumbering(tmp_path / "images", tmp_path / "metadata.csv").run()
+    check_edition(tmp_path, [1, 2, 4, 5, 6, 7])
+    assert not (tmp_path / "images" / PLAN_FILE_NAME).exists()
+
+
+def test_interrupted_metadata_write_resumes(tmp_path, monkeypatch):
+    renumbering = make_edition(tmp_path, 5, {1})
+    with monkeypatch.context() as patch:
+        patch.setattr(renumber.os, "replace", failing_after(3, os.replace))
+        with pytest.raises(OSError):
+            renumbering.run()
+    renumbering.run()
+    check_edition(tmp_path, [0, 2, 3, 4])
@@ -0,0 +1,73 @@
+import numpy as np
+import yaml
+
+import factory.constants as constants
+from factory.config import Config
+from factory.sampler import BatchSampler
+
+
+def test_keys_beyond_int64(synthetic_config):
+    # 22 layers of 10 traits allow more trait sets than int64 can number
+    config = synthetic_config(layer_count=22, traits_per_layer=10, rule_count=10, count=500)
+    sampler = BatchSampler(config, seed=1)
+    assert sampler.keys(np.zeros((1, 22), dtype=np.int64)).dtype == object
+
+    codes = sampler.sample(500)
+    assert codes.shape == (500, 22)
+    assert len(np.unique(codes, axis=0)) == 500
+
+
+def test_sample_is_unique_and_seeded(synthetic_config):
+    config = synthetic_config(layer_count=4, traits_per_layer=4, rule_count=3, count=50)
+    codes = BatchSampler(config, seed=3).sample(50)
+    assert len(np.unique(codes, axis=0)) == 50
+    assert np.array_equal(codes, BatchSampler(config, seed=3).sample(50))
+
+
+def test_marginals_follow_weights_and_rules_hold(synthetic_config, tmp_path):
+    synthetic_config(layer_count=9, traits_per_layer=8, count=10000)
+    raw_cfg = yaml.safe_load((tmp_path / "config.yaml").read_text())
+    raw_cfg[constants.RULES_KEY] = [
+        rule(constants.RULES_NOT_EQUALS_KEY, "layer2", "trait0", "layer3", "trait1"),
+        rule(constants.RULES_EQUALS_KEY, "layer0", "trait2", "layer4", "trait3"),
+    ]
+    (tmp_path / "config.yaml").write_text(yaml.safe_dump(raw_cfg, sort_keys=False))
+    config = Config(tmp_path / "config.yaml", collection_name="test", cache=False)
+    constraints = config.constraints
+    # the trait sets an equals rule leaves are still plenty for 10000 draws, so rejecting
+    # duplicates barely moves the marginals
+    codes = BatchSampler(config, seed=7).sample(10000)
+    assert len(np.unique(codes, axis=0)) == 10000
+
+    def code(layer_index, value):
+        return constraints.code_maps[layer_index][value]
+
+    def expected(layer_index):
+        weights = constraints.weights[layer_index]
+        return weights / weights.sum()
+
+    def frequencies(layer_index):
+        return np.bincount(codes[:, layer_index], minlength=len(constraints.weights[layer_index])) / len(codes)
+
+    # a rule only skews the upper layer of a notequals pair, one of these has explicit uneven weights
+    for layer_index in (1, 2, 5, 6, 7, 8):
+        assert np.abs(frequencies(layer_index) - expected(layer_index)).max() < 0.02
+    # an equals pick on the upper layer also rewrites the lower one
+    layer0 = expected(0)
+    share = layer0[code(0, "trait2")]
+    layer0 *= 1 - expected(4)[code(4, "trait3")]
+    layer0[code(0, "trait2")] = share + (1 - share) * expected(4)[code(4, "trait3")]
+    assert np.abs(frequencies(0) - layer0).max() < 0.02
+
+    assert not ((codes[:, 2] == code(2, "trait0")) & (codes[:, 3] == code(3, "trait1"))).any()
+    forced = codes[:, 0] == code(0, "trait2")
+    assert forced.any()
+    assert (codes[forced, 4] == code(4, "trait3")).all()
+
+
+def rule(filter_type, name_1, value_1, name_2, value_2):
+    return {
+        constants.RULES_FILTER_KEY: filter_type,
+        constants.TRAIT_1_KEY: {constants.RULE_TRAIT_NAME: name_1, constants.RULES_VALUE_KEY: value_1},
+        constants.TRAIT_2_KEY: {constants.RULE_TRAIT_NAME: name_2, constants.RULES_VALUE_KEY: value_2},
+    }
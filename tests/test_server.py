@@ -0,0 +1,114 @@
+from http.server import ThreadingHTTPServer
+import json
+import multiprocessing as mp
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import factory.server as server_module
+from factory.sampler import BatchSampler
+from factory.server import RenderRequestHandler, RenderService
+
+
+class StubResult:
+    def __init__(self, release, data):
+        self.release = release
+        self.data = data
+
+    def get(self, timeout=None):
+        if not self.release.wait(timeout):
+            raise mp.TimeoutError
+        if isinstance(self.data, Exception):
+            raise self.data
+        return self.data
+
+
+class StubPool:
+    # stands in for the render pool, renders only finish once release is set and then give data,
+    # or raise it when it is an exception
+    def __init__(self, release, data=b"image"):
+        self.release = release
+        self.data = data
+        self.calls = 0
+
+    def apply_async(self, fn, args):
+        self.calls += 1
+        return StubResult(self.release, self.data)
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
+@pytest.fixture
+def service(synthetic_config):
+    config = synthetic_config(count=5)
+    service = RenderService(config, BatchSampler(config, seed=1).sample(5), processes=1)
+    service.pool.terminate()
+    yield service
+    service.close()
+
+
+@pytest.fixture
+def get_error(service):
+    # (status, error message) of a failed request to a server for the service
+    handler = type("Handler", (RenderRequestHandler,), {"service": service, "log_message": lambda *args: None})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def get(path):
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen("http://127.0.0.1:{}{}".format(server.server_address[1], path), timeout=10)
+        return error.value.code, json.loads(error.value.read())["error"]
+
+    yield get
+    server.shutdown()
+    server.server_close()
+
+
+def test_concurrent_misses_render_once(service):
+    release = threading.Event()
+    service.pool = StubPool(release)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(service.render(2))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == [b"image"] * 4
+    assert service.pool.calls == 1
+    assert service.render(2) == b"image"
+    assert service.pool.calls == 1
+
+
+def test_render_timeout_is_a_504(service, get_error, monkeypatch):
+    # renders never finish
+    monkeypatch.setattr(server_module, "SERVER_RENDER_TIMEOUT", 0.1)
+    service.pool = StubPool(threading.Event())
+    status, message = get_error("/tokens/1.png")
+    assert status == 504
+    assert "timed out" in message
+    assert not service._in_flight
+
+
+def test_render_failure_is_a_500(service, get_error):
+    release = threading.Event()
+    release.set()
+    service.pool = StubPool(release, RuntimeError("/some/worker/path is broken"))
+    assert get_error("/tokens/1.png") == (500, "rendering token 1 failed")
+    assert not service._in_flight
+    assert len(service.cache) == 0
+
+
+@pytest.mark.parametrize("query", ["size=0", "size=abc", "size=-8", "size=4097", "resample=sharp"])
+def test_invalid_size_or_resample_is_a_400(service, get_error, query):
+    service.pool = StubPool(threading.Event())
+    status, message = get_error("/tokens/1.png?" + query)
+    assert status == 400
+    assert message.startswith("size must be" if query.startswith("size") else "resample must be")
+    assert service.pool.calls == 0
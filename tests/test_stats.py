@@ -0,0 +1,50 @@
+import json
+
+import pandas as pd
+import pytest
+
+from factory.stats import CollectionStats
+
+# counted by hand: blue 3 and red 1, crown 1 and cap 3 out of 4 tokens
+BACKGROUNDS = ["blue", "blue", "blue", "red"]
+HATS = ["crown", "cap", "cap", "cap"]
+# 4/3 + 4/1, 4/3 + 4/3, 4/3 + 4/3 and 4/1 + 4/3
+SCORES = [16 / 3, 8 / 3, 8 / 3, 16 / 3]
+
+
+@pytest.mark.parametrize("categorical", [False, True])
+def test_counts_scores_and_ranks(categorical):
+    metadata = pd.DataFrame({"background": BACKGROUNDS, "hat": HATS})
+    if categorical:
+        # a category no token uses is left out of the counts
+        metadata = pd.DataFrame({
+            "background": pd.Categorical(BACKGROUNDS, categories=["green", "red", "blue"]),
+            "hat": pd.Categorical(HATS, categories=["cap", "crown"]),
+        })
+    stats = CollectionStats(metadata, ["background", "hat"])
+    assert stats.frequencies("background") == [("blue", 3), ("red", 1)]
+    assert stats.frequencies("hat") == [("cap", 3), ("crown", 1)]
+    assert stats.scores.tolist() == pytest.approx(SCORES)
+    # the two rarest tokens share rank 1, the next two share rank 3
+    assert stats.ranks.tolist() == [1, 3, 3, 1]
+    assert stats.report()["layers"]["background"] == [
+        {"value": "blue", "count": 3, "frequency": 0.75},
+        {"value": "red", "count": 1, "frequency": 0.25},
+    ]
+
+
+def test_write(tmp_path):
+    stats = CollectionStats(pd.DataFrame({"background": BACKGROUNDS, "hat": HATS}), ["background", "hat"])
+    stats.write(tmp_path, ["{}.png".format(index) for index in range(4)])
+    with open(tmp_path / "stats.json") as f:
+        assert json.load(f)["count"] == 4
+    rarity = pd.read_csv(tmp_path / "rarity.csv")
+    assert rarity["filename"].tolist() == ["0.png", "1.png", "2.png", "3.png"]
+    assert rarity["rarity_score"].tolist() == pytest.approx(SCORES)
+    assert rarity["rank"].tolist() == [1, 3, 3, 1]
+
+
+def test_empty_collection():
+    stats = CollectionStats(pd.DataFrame({"background": pd.Series([], dtype=str)}), ["background"])
+    assert stats.frequencies("background") == []
+    assert stats.ranks.tolist() == []
@@ -0,0 +1,113 @@
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+
+import pytest
+
+import factory.ipfs as ipfs
+from factory.archive import ArchiveWriter, load_index
+from factory.pinata import PinataClient
+from factory.upload import READ_CHUNK_SIZE, UploadCheckpoint
+
+
+class StandInPinata(BaseHTTPRequestHandler):
+    # pins what it receives like pinFileToIPFS, after failing the first `failures` requests either
+    # with a 503 or by dropping the connection once the body is read
+    failures = 0
+    failure = "503"
+    requests = None
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.requests.append(body)
+        if len(self.requests) <= self.failures:
+            if self.failure == "drop":
+                self.close_connection = True
+                return
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        message = BytesParser().parsebytes(b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + body)
+        files = {part.get_filename().split("/", 1)[1]: part.get_payload(decode=True) for part in message.get_payload() if part.get_filename()}
+        type(self).received = files
+        result = json.dumps({"IpfsHash": ipfs.to_cid(ipfs.tree_node({name: ipfs.file_node(data) for name, data in files.items()})[0])}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(result)))
+        self.end_headers()
+        self.wfile.write(result)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def pinata():
+    def start(failures=0, failure="503"):
+        handler = type("Handler", (StandInPinata,), {"failures": failures, "failure": failure, "requests": []})
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        servers.append(server)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return handler, PinataClient(endpoint="http://127.0.0.1:{}/".format(server.server_address[1]), retries=2, backoff=0)
+
+    servers = []
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def image_folder(path):
+    # one file spans several read chunks of the streamed body
+    path.mkdir()
+    contents = {"0.png": b"first", "1.png": bytes(range(256)) * (READ_CHUNK_SIZE // 128 + 3), "2.png": b""}
+    for name, data in contents.items():
+        (path / name).write_bytes(data)
+    return contents
+
+
+@pytest.mark.parametrize("failure", ["503", "drop"])
+def test_upload_retries_after_a_failed_attempt(pinata, tmp_path, failure):
+    contents = image_folder(tmp_path / "images")
+    handler, client = pinata(failures=1, failure=failure)
+    result = client.upload_folder(str(tmp_path / "images"), "collection")
+    assert len(handler.requests) == 2
+    assert handler.received == contents
+    assert result["IpfsHash"] == ipfs.to_cid(ipfs.folder_nodes(tmp_path / "images")[0][0])
+
+
+def test_upload_resumes_from_the_checkpoint(pinata, tmp_path):
+    image_folder(tmp_path / "images")
+    handler, client = pinata(failures=3)
+    checkpoint = UploadCheckpoint(tmp_path / "checkpoint.json")
+    # every attempt fails, nothing is recorded
+    with pytest.raises(RuntimeError):
+        client.upload_folder(str(tmp_path / "images"), "collection", checkpoint=checkpoint)
+    assert not (tmp_path / "checkpoint.json").exists()
+
+    # the next run sends the folder, the one after only reads the checkpoint
+    result = client.upload_folder(str(tmp_path / "images"), "collection", checkpoint=checkpoint)
+    assert len(handler.requests) == 4
+    assert client.upload_folder(str(tmp_path / "images"), "collection", checkpoint=UploadCheckpoint(tmp_path / "checkpoint.json")) == result
+    assert len(handler.requests) == 4
+
+    # a changed folder has another CID and is sent again
+    (tmp_path / "images" / "0.png").write_bytes(b"changed")
+    client.upload_folder(str(tmp_path / "images"), "collection", checkpoint=checkpoint)
+    assert len(handler.requests) == 5
+
+
+def test_upload_streams_archive_members(pinata, tmp_path):
+    contents = image_folder(tmp_path / "images")
+    writer = ArchiveWriter(tmp_path / "archives", "images", 1 << 30)
+    for name, data in contents.items():
+        writer.add(name, data)
+    writer.close()
+    members = load_index(tmp_path / "archives", "images")
+
+    handler, client = pinata(failures=1)
+    local_cid = ipfs.to_cid(ipfs.folder_nodes(tmp_path / "images")[0][0])
+    result = client.upload_files([("collection/" + name, member) for name, member in sorted(members.items())], local_cid, "archives")
+    assert handler.received == contents
+    assert result["IpfsHash"] == local_cid